@@ -1,18 +1,25 @@
+import time
+RUN_STARTED = time.perf_counter()  # Before the imports, which are most of a cold start
 import os
 import streamlit as st
 from dotenv import load_dotenv
-import google.generativeai as genai
 import json
 import re
-import threading
 import uuid
 from ui import render_ui
-from utils import execute_delayed_action, load_pending_updates, save_pending_updates, load_scheduled_actions, save_scheduled_actions, json_to_natural_language, update_config, update_user_preference
-from update import background_task
-from mqtt import mqtt_background_task
-from filelock import FileLock
+from utils import execute_delayed_action, load_scheduled_actions, get_scheduler, json_to_natural_language, update_config, update_user_preference
+from state import get_store, get_default_data
+from intents import is_action_reply, resolve_local, response_cache
+from llm import get_backend, get_pipeline, ChatSession
+from prompt_context import PromptContext, wants_history
+from history import get_history
+from chat_history import ChatHistory
+from events import bus
+from workers import get_supervisor
+from persistence import read_json
+from recurrence import parse_recurrence, parse_delay, parse_time, next_fire_time, next_time_of_day, describe, DELAY_PATTERN, TIME_PATTERN
 from datetime import datetime
-import time
+import metrics
 
 # Streamlit Page Config (must be the first Streamlit command)
 st.set_page_config(page_title="ComfortAI", page_icon="🛜", layout="wide")
@@ -20,6 +27,8 @@ st.set_page_config(page_title="ComfortAI", page_icon="🛜", layout="wide")
 # Load environment variables
 load_dotenv()
 API_KEY = os.getenv("GEMINI_API_KEY")
+COLD_START_BUDGET = 3.0  # Seconds for the first run of the process, imports included
+RERUN_BUDGET = 0.15  # Seconds for any later run of the script
 
 # Predefined actions
 PREDEFINED_ACTIONS = {
@@ -55,198 +64,122 @@ PREDEFINED_ACTIONS = {
 
 # Data Management Module
 class DataManager:
+    """Thin facade over the process-wide state store; data.json is its checkpoint."""
+
     def __init__(self, data_path):
         self.data_path = data_path
-        self.lock_file = data_path + '.lock'
-        self.ensure_data_file()
-
-    def ensure_data_file(self):
-        with FileLock(self.lock_file):
-            if not os.path.exists(self.data_path):
-                os.makedirs(os.path.dirname(self.data_path), exist_ok=True)
-                default_data = {
-                    "sensors": {"light_level": 80, "temperature": 32, "humidity": 50},
-                    "action": {"fan": "on", "fan_speed": 100, "light": "off", "set_brightness": 0}
-                }
-                self.update_data(default_data)
+        self.store = get_store()
 
     def load_data(self):
-        with FileLock(self.lock_file):
-            try:
-                with open(self.data_path, 'r') as f:
-                    return json.load(f)
-            except Exception:
-                return self.get_default_data()
+        return self.store.load()
 
-    def update_data(self, data):
-        with FileLock(self.lock_file):
-            try:
-                with open(self.data_path, 'w') as f:
-                    json.dump(data, f, indent=2)
-                return True
-            except Exception as e:
-                st.error(f"Error updating data: {e}")
-                return False
+    def update_actions(self, actions, source="ui"):
+        """Merge actions into the action section; sensors ingested meanwhile are kept."""
+        try:
+            self.store.merge('action', actions, source=source)
+            return True
+        except Exception as e:
+            st.error(f"Error updating data: {e}")
+            return False
 
     def get_default_data(self):
-        return {
-            "sensors": {"light_level": 80, "temperature": 32, "humidity": 50},
-            "action": {"fan": "on", "fan_speed": 100, "light": "off", "set_brightness": 0}
-        }
+        return get_default_data()
 
-# Configure Gemini API
-genai.configure(api_key=API_KEY)
-model = genai.GenerativeModel('gemini-2.0-flash')
+# Model backend (Gemini, or a local fake with COMFORT_LLM_BACKEND=fake), created
+# once per process; the model client itself is set up on the first query
+backend = get_backend(API_KEY)
 
 # Initialize session state
 if "chat_session" not in st.session_state:
     try:
         with open('sys_prompt.md', 'r') as f:
             system_prompt = f.read()
-        st.session_state.chat_session = model.start_chat(history=[{
-            "role": "user",
-            "parts": [system_prompt]
-        }])
+        st.session_state.chat_session = ChatSession(backend, system_prompt)
     except FileNotFoundError:
         st.error("System prompt file (sys_prompt.md) not found.")
-        st.session_state.chat_session = model.start_chat(history=[])
+        st.session_state.chat_session = ChatSession(backend)
+
+# Each session drains its own cursor on the shared event bus
+if "event_subscription" not in st.session_state:
+    st.session_state.event_subscription = bus.subscribe(kinds=["schedule_executed"])
+
+if "pending_requests" not in st.session_state:
+    st.session_state.pending_requests = []
+
+if "prompt_context" not in st.session_state:
+    st.session_state.prompt_context = PromptContext(PREDEFINED_ACTIONS)
 
 if "display_history" not in st.session_state:
-    st.session_state.display_history = []
+    st.session_state.display_history = ChatHistory()
 
 if "rule_set" not in st.session_state:
     st.session_state.rule_set = "fixed_rule"
 
-if "last_check" not in st.session_state:
-    st.session_state.last_check = time.time()
-
-# Load session state from scheduler.json
-if os.path.exists("scheduler.json"):
-    st.session_state.scheduled_actions = load_scheduled_actions()
+# Load session state from the scheduler (rehydrated from scheduler.json)
+st.session_state.scheduled_actions = load_scheduled_actions()
 
 # Handle UI cancellation
 if "cancel_action" in st.session_state:
     action_id = st.session_state.cancel_action
-    scheduled_actions = load_scheduled_actions()
-    action_to_cancel = next((sa for sa in scheduled_actions if sa["id"] == action_id), None)
+    action_to_cancel = get_scheduler().cancel(action_id)
     if action_to_cancel:
+        get_store().log_command("cancel_schedule", source="ui", id=action_id)
         description = action_to_cancel["description"]
-        updated_actions = [sa for sa in scheduled_actions if sa["id"] != action_id]
-        save_scheduled_actions(updated_actions)
-        st.session_state.scheduled_actions = updated_actions
+        st.session_state.scheduled_actions = load_scheduled_actions()
         st.session_state.display_history.append({"role": "model", "text": f"Scheduled action canceled: {description}", "timestamp": time.time()})
     del st.session_state.cancel_action
     st.rerun()
 
-# Start background task
-if "background_task_started" not in st.session_state:
-    st.session_state.background_task_started = True
-    
-    bg_thread = threading.Thread(target=background_task, daemon=True)
-    bg_thread.start()
-    
-    mqtt_thread = threading.Thread(target=mqtt_background_task, daemon=True)
-    mqtt_thread.start()
+# Start the process-wide background workers (once per process, not per session)
+supervisor = get_supervisor()
+supervisor.ensure_started()
 
 # Data Manager
 data_manager = DataManager('data.json')
 data = data_manager.load_data()
 
-# Process user input
-def process_user_input(user_input, data, data_manager):
-    if user_input:
-        st.session_state.display_history.append({"role": "user", "text": user_input, "timestamp": time.time()})
-
-        try:
-            with FileLock("config.json.lock"):
-                config = json.load(open("config.json", 'r'))
-                active_rule_set = config.get('active_rule_set', 'fixed_rule')
-        except Exception:
-            active_rule_set = 'fixed_rule'
-
-        current_time = datetime.now().strftime('%H:%M')
-        context = (
-            f"Current system state:\n"
-            f"- Current Time: {current_time}\n"
-            f"- Sensors: Light: {data['sensors']['light_level']}, Temp: {data['sensors']['temperature']}°C, Humidity: {data['sensors']['humidity']}%\n"
-            f"- Actions: Fan: {data['action']['fan'].capitalize()}, Speed: {data['action']['fan_speed']}%, Light: {data['action']['light'].capitalize()}, Brightness: {data['action']['set_brightness']}%\n"
-            f"- Active Rule Set: {'Fixed Rules' if active_rule_set == 'fixed_rule' else 'User Preferences'}\n"
-            f"- Scheduled actions: {json.dumps(st.session_state.get('scheduled_actions', []), indent=2)}\n"
-            f"User query: {user_input}\n"
-            f"Predefined actions: {json.dumps(PREDEFINED_ACTIONS, indent=2)}\n"
-            f"Note: For scheduling, use predefined actions or specify actions like fan, light, fan_speed, or brightness with delay (seconds) or specific time (HH:MM)."
-        )
+# Act on the response text for a user query: schedule, apply actions or reply
+def handle_model_response(user_input, text, data, data_manager, active_rule_set):
+    try:
+        # Check for scheduling intent; recurring phrases ("every day at 23:00") win
+        recurrence = parse_recurrence(user_input)
+        delay_match = DELAY_PATTERN.search(user_input.lower())
+        time_match = TIME_PATTERN.search(user_input.lower())
+        schedule_time_str = None
+        delay_seconds = None
+
+        if recurrence or delay_match or time_match:
+            if recurrence:
+                schedule_time_str = recurrence.get("time")
+                delay_seconds = next_fire_time(recurrence) - time.time()
+            elif delay_match:
+                delay_seconds = parse_delay(delay_match)
+            elif time_match:
+                schedule_time_str = parse_time(time_match) or time_match.group(1)
+                try:
+                    now = datetime.now()
+                    delay_seconds = (next_time_of_day(schedule_time_str, now) - now).total_seconds()
+                    if delay_seconds < 0:
+                        raise ValueError("Scheduled time must be in the future.")
+                except ValueError as e:
+                    st.session_state.display_history.append({"role": "model", "text": f"Invalid time format or past time: {e}. Use HH:MM (e.g., 14:30).", "timestamp": time.time()})
+                    st.rerun()
+                    return data
+            display_time = describe(recurrence) if recurrence else (schedule_time_str if schedule_time_str else f"in {delay_seconds} seconds")
+
+            # Check for predefined action in user input
+            for action_name, actions in PREDEFINED_ACTIONS.items():
+                if action_name.lower() in user_input.lower():
+                    action_id = str(uuid.uuid4())  # Use UUID for unique ID
+                    scheduled_actions = load_scheduled_actions()
+                    if not any(sa["id"] == action_id for sa in scheduled_actions):
+                        execute_delayed_action(data, data_manager, actions, delay_seconds, active_rule_set, action_id, schedule_time_str, recurrence)
+                        description = json_to_natural_language(actions)
+                        st.session_state.display_history.append({"role": "model", "text": f"Scheduled to perform {action_name} ({description}) {display_time}.", "timestamp": time.time()})
+                    st.rerun()
+                    return data
 
-        try:
-            resp = st.session_state.chat_session.send_message(context)
-            text = resp.text.strip()
-
-            # Check for scheduling intent
-            delay_match = re.search(r"(?:in|after)\s+(\d+)\s*(?:seconds?|mins?|minutes?|hours?)", user_input.lower())
-            time_match = re.search(r"at\s+(\d{2}:\d{2})", user_input.lower())
-            schedule_time_str = None
-            delay_seconds = None
-
-            if delay_match or time_match:
-                if delay_match:
-                    delay_seconds = int(delay_match.group(1))
-                    if "hour" in user_input.lower():
-                        delay_seconds *= 3600
-                    elif "minute" in user_input.lower():
-                        delay_seconds *= 60
-                elif time_match:
-                    schedule_time_str = time_match.group(1)
-                    try:
-                        schedule_time = datetime.strptime(schedule_time_str, '%H:%M').time()
-                        now = datetime.now()
-                        schedule_datetime = datetime.combine(now.date(), schedule_time)
-                        if schedule_datetime < now:
-                            schedule_datetime = schedule_datetime.replace(day=now.day + 1)
-                        delay_seconds = (schedule_datetime - now).total_seconds()
-                        if delay_seconds < 0:
-                            raise ValueError("Scheduled time must be in the future.")
-                    except ValueError as e:
-                        st.session_state.display_history.append({"role": "model", "text": f"Invalid time format or past time: {e}. Use HH:MM (e.g., 14:30).", "timestamp": time.time()})
-                        st.rerun()
-                        return data
-
-                # Check for predefined action in user input
-                for action_name, actions in PREDEFINED_ACTIONS.items():
-                    if action_name.lower() in user_input.lower():
-                        action_id = str(uuid.uuid4())  # Use UUID for unique ID
-                        scheduled_actions = load_scheduled_actions()
-                        if not any(sa["id"] == action_id for sa in scheduled_actions):
-                            execute_delayed_action(data, data_manager, actions, delay_seconds, active_rule_set, action_id, schedule_time_str)
-                            description = json_to_natural_language(actions)
-                            display_time = schedule_time_str if schedule_time_str else f"in {delay_seconds} seconds"
-                            st.session_state.display_history.append({"role": "model", "text": f"Scheduled to perform {action_name} ({description}) {display_time}.", "timestamp": time.time()})
-                        st.rerun()
-                        return data
-
-                # Parse JSON response for actions
-                match = re.search(r'(\[\s*\{.*?\}\s*\]|\{.*?\})', text, re.DOTALL)
-                if match:
-                    json_text = match.group(0)
-                    try:
-                        actions = json.loads(json_text)
-                        if isinstance(actions, dict):
-                            actions = [actions]
-
-                        action_id = str(uuid.uuid4())  # Use UUID for unique ID
-                        scheduled_actions = load_scheduled_actions()
-                        if not any(sa["id"] == action_id for sa in scheduled_actions):
-                            execute_delayed_action(data, data_manager, actions, delay_seconds, active_rule_set, action_id, schedule_time_str)
-                            description = json_to_natural_language(actions)
-                            display_time = schedule_time_str if schedule_time_str else f"in {delay_seconds} seconds"
-                            st.session_state.display_history.append({"role": "model", "text": f"Scheduled to perform actions ({description}) {display_time}.", "timestamp": time.time()})
-                        st.rerun()
-                        return data
-                    except json.JSONDecodeError:
-                        st.session_state.display_history.append({"role": "model", "text": "Sorry, I couldn't process that scheduling request. Please try again.", "timestamp": time.time()})
-                        st.rerun()
-                        return data
-
-            # Handle immediate actions, rule set changes, or cancellations
+            # Parse JSON response for actions
             match = re.search(r'(\[\s*\{.*?\}\s*\]|\{.*?\})', text, re.DOTALL)
             if match:
                 json_text = match.group(0)
@@ -255,82 +188,190 @@ def process_user_input(user_input, data, data_manager):
                     if isinstance(actions, dict):
                         actions = [actions]
 
-                    # Filter actions by type
-                    device_actions = [act for act in actions if act.get('action_type') in ["fan", "light", "brightness", "fan_speed", "none"]]
-                    cancel_actions = [act for act in actions if act.get('action_type') == "cancel_scheduled" and act.get('action_value') == "all"]
-                    rule_set_actions = [act for act in actions if act.get('action_type') == "rule_set"]
-
-                    # Handle cancellations
-                    if cancel_actions:
-                        scheduled_actions = []
-                        save_scheduled_actions(scheduled_actions)
-                        st.session_state.scheduled_actions = scheduled_actions
-                        st.session_state.display_history.append({"role": "model", "text": "All scheduled actions have been canceled.", "timestamp": time.time()})
-
-                    # Handle rule set changes
-                    if rule_set_actions:
-                        active_rule_set = rule_set_actions[0].get('action_value')
-                        update_config(active_rule_set)
-                        st.session_state.display_history.append({"role": "model", "text": f"Rule set changed to {active_rule_set}", "timestamp": time.time()})
-
-                    # Handle device actions
-                    if device_actions:
-                        current_actions = data.get('action', {}).copy()
-                        for act in device_actions:
-                            atype, aval = act.get('action_type'), act.get('action_value')
-                            if atype == "fan":
-                                current_actions['fan'] = aval
-                                if aval == 'off': current_actions['fan_speed'] = 0
-                            elif atype == "light":
-                                current_actions['light'] = aval
-                                if aval == 'off': current_actions['set_brightness'] = 0
-                            elif atype == "brightness":
-                                lvl = int(aval)
-                                current_actions['set_brightness'] = lvl
-                                if lvl > 0: current_actions['light'] = 'on'
-                            elif atype == "fan_speed":
-                                lvl = int(aval)
-                                current_actions['fan_speed'] = lvl
-                                if lvl > 0: current_actions['fan'] = 'on'
-                        data['action'] = current_actions
-                        update_user_preference(data, device_actions)
-                        data_manager.update_data(data)
-                        data = data_manager.load_data()
-                        st.session_state['action_state'] = data['action']
-                        st.session_state.display_history.append({"role": "model", "text": json_to_natural_language(device_actions), "timestamp": time.time()})
-
+                    action_id = str(uuid.uuid4())  # Use UUID for unique ID
+                    scheduled_actions = load_scheduled_actions()
+                    if not any(sa["id"] == action_id for sa in scheduled_actions):
+                        execute_delayed_action(data, data_manager, actions, delay_seconds, active_rule_set, action_id, schedule_time_str, recurrence)
+                        description = json_to_natural_language(actions)
+                        st.session_state.display_history.append({"role": "model", "text": f"Scheduled to perform actions ({description}) {display_time}.", "timestamp": time.time()})
                     st.rerun()
                     return data
                 except json.JSONDecodeError:
-                    st.session_state.display_history.append({"role": "model", "text": "Sorry, I couldn't process that action. Please try again.", "timestamp": time.time()})
+                    st.session_state.display_history.append({"role": "model", "text": "Sorry, I couldn't process that scheduling request. Please try again.", "timestamp": time.time()})
                     st.rerun()
                     return data
 
-            # Handle conversational responses
-            st.session_state.display_history.append({"role": "model", "text": text, "timestamp": time.time()})
-            st.rerun()  # Force UI refresh after conversational response
-            return data
+        # Handle immediate actions, rule set changes, or cancellations
+        match = re.search(r'(\[\s*\{.*?\}\s*\]|\{.*?\})', text, re.DOTALL)
+        if match:
+            json_text = match.group(0)
+            try:
+                actions = json.loads(json_text)
+                if isinstance(actions, dict):
+                    actions = [actions]
+
+                # Filter actions by type
+                device_actions = [act for act in actions if act.get('action_type') in ["fan", "light", "brightness", "fan_speed", "none"]]
+                cancel_actions = [act for act in actions if act.get('action_type') == "cancel_scheduled" and act.get('action_value') == "all"]
+                rule_set_actions = [act for act in actions if act.get('action_type') == "rule_set"]
+
+                # Handle cancellations
+                if cancel_actions:
+                    get_scheduler().cancel_all()
+                    get_store().log_command("cancel_schedule", source="chat", id="all")
+                    st.session_state.scheduled_actions = []
+                    st.session_state.display_history.append({"role": "model", "text": "All scheduled actions have been canceled.", "timestamp": time.time()})
+
+                # Handle rule set changes
+                if rule_set_actions:
+                    active_rule_set = rule_set_actions[0].get('action_value')
+                    update_config(active_rule_set)
+                    st.session_state.display_history.append({"role": "model", "text": f"Rule set changed to {active_rule_set}", "timestamp": time.time()})
+
+                # Handle device actions
+                if device_actions:
+                    current_actions = data.get('action', {}).copy()
+                    for act in device_actions:
+                        atype, aval = act.get('action_type'), act.get('action_value')
+                        if atype == "fan":
+                            current_actions['fan'] = aval
+                            if aval == 'off': current_actions['fan_speed'] = 0
+                        elif atype == "light":
+                            current_actions['light'] = aval
+                            if aval == 'off': current_actions['set_brightness'] = 0
+                        elif atype == "brightness":
+                            lvl = int(aval)
+                            current_actions['set_brightness'] = lvl
+                            if lvl > 0: current_actions['light'] = 'on'
+                        elif atype == "fan_speed":
+                            lvl = int(aval)
+                            current_actions['fan_speed'] = lvl
+                            if lvl > 0: current_actions['fan'] = 'on'
+                    data['action'] = current_actions
+                    update_user_preference(data, device_actions)
+                    data_manager.update_actions(current_actions, source="chat")
+                    data = data_manager.load_data()
+                    st.session_state['action_state'] = data['action']
+                    st.session_state.display_history.append({"role": "model", "text": json_to_natural_language(device_actions), "timestamp": time.time()})
+
+                st.rerun()
+                return data
+            except json.JSONDecodeError:
+                st.session_state.display_history.append({"role": "model", "text": "Sorry, I couldn't process that action. Please try again.", "timestamp": time.time()})
+                st.rerun()
+                return data
+
+        # Handle conversational responses
+        st.session_state.display_history.append({"role": "model", "text": text, "timestamp": time.time()})
+        st.rerun()  # Force UI refresh after conversational response
+        return data
+
+    except Exception as e:
+        error_message = f"Sorry, something went wrong. Please try again. Error: {e}"
+        st.session_state.display_history.append({"role": "model", "text": error_message, "timestamp": time.time()})
+        st.rerun()
+        return data
 
-        except Exception as e:
-            error_message = f"Sorry, something went wrong. Please try again. Error: {e}"
-            st.session_state.display_history.append({"role": "model", "text": error_message, "timestamp": time.time()})
-            st.rerun()
-            return data
+# Process user input
+def process_user_input(user_input, data, data_manager):
+    if user_input:
+        st.session_state.display_history.append({"role": "user", "text": user_input, "timestamp": time.time()})
 
-    return data
+        active_rule_set = read_json("config.json", {}).get('active_rule_set', 'fixed_rule')
+
+        scheduled_actions = st.session_state.get('scheduled_actions', [])
+        text, _, cache_key = resolve_local(user_input, data, active_rule_set, scheduled_actions, PREDEFINED_ACTIONS)
+        if text is not None:
+            return handle_model_response(user_input, text, data, data_manager, active_rule_set)
 
-# Check for pending updates and scheduled actions in the main thread
-current_time = time.time()
-if current_time - st.session_state.last_check >= 0.1:
-    st.session_state.last_check = current_time
-    scheduled_actions = load_scheduled_actions()
-    st.session_state.scheduled_actions = scheduled_actions
-    updates = load_pending_updates()
-    if updates:
-        for update in sorted(updates, key=lambda x: x["timestamp"]):
-            st.session_state.display_history.append({"role": "model", "text": update["text"], "timestamp": update["timestamp"]})
-        save_pending_updates([])
+        # Ask the model on the pipeline; the reply is picked up by poll_pending_requests
+        chat = st.session_state.chat_session
+        prompt_context = st.session_state.prompt_context
+        snapshot = {"sensors": dict(data['sensors']), "action": dict(data['action'])}
+
+        def ask_model(on_chunk, deadline):
+            with chat.lock:
+                baseline = (prompt_context.static_sent, prompt_context.last_state)
+                kept = None
+                try:
+                    chat_session = chat.session
+                    prompt_context.trim_history(chat_session)
+                    kept = len(chat_session.history)
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise TimeoutError("request expired while waiting for the chat session")
+                    history = get_history().describe_recent() if wants_history(user_input) else None
+                    context = prompt_context.build(user_input, datetime.now().strftime('%H:%M'), snapshot, active_rule_set, scheduled_actions, history)
+                    text, resp = backend.send(chat_session, context, on_chunk, timeout=remaining)
+                    if time.time() > deadline:
+                        # The user was told this request timed out, so the late turn must not stay in the chat
+                        raise TimeoutError("model reply arrived after the deadline")
+                except Exception:
+                    # The model never saw this prompt (or the turn is dropped), so a retry must
+                    # resend it in full, and a stream aborted mid-reply leaves no half turn behind
+                    prompt_context.static_sent, prompt_context.last_state = baseline
+                    if kept is not None and len(chat_session.history) > kept:
+                        chat_session.history = list(chat_session.history)[:kept]
+                    raise
+                prompt_context.record_usage(context, resp)
+            if cache_key is not None and is_action_reply(text):
+                response_cache.put(cache_key, text)
+            return text
+
+        request = get_pipeline().submit(ask_model)
+        placeholder = {"role": "model", "text": "Thinking...", "timestamp": time.time()}
+        st.session_state.display_history.append(placeholder)
+        st.session_state.pending_requests.append({
+            "id": request.id, "user_input": user_input, "active_rule_set": active_rule_set, "placeholder": placeholder
+        })
         st.rerun()
 
+    return data
+
+# Stream partial replies into the chat and act on finished requests; returns (data, whether any are still in flight)
+def poll_pending_requests(data, data_manager):
+    pipeline = get_pipeline()
+    for item in list(st.session_state.pending_requests):
+        request = pipeline.get(item["id"])
+        if request is not None and not request.finished:
+            item["placeholder"]["text"] = request.partial or "Thinking..."
+            continue
+        st.session_state.pending_requests.remove(item)
+        pipeline.forget(item["id"])
+        st.session_state.display_history.remove(item["placeholder"])
+        if request is not None and request.status == "done":
+            data = handle_model_response(item["user_input"], request.text, data, data_manager, item["active_rule_set"])
+        else:
+            reason = "the request timed out" if request is None or request.timed_out else f"Error: {request.error}"
+            st.session_state.display_history.append({"role": "model", "text": f"Sorry, something went wrong. Please try again. ({reason})", "timestamp": time.time()})
+    return data, bool(st.session_state.pending_requests)
+
+# Pick up scheduler results from the event bus (no file I/O)
+st.session_state.scheduled_actions = load_scheduled_actions()
+subscription = st.session_state.event_subscription
+events = subscription.drain()
+if events:
+    missed = subscription.dropped - st.session_state.get("events_dropped_shown", 0)
+    if missed > 0:
+        st.session_state.display_history.append({"role": "model", "text": f"{missed} older scheduler notifications were missed while this page was idle.", "timestamp": time.time()})
+        st.session_state.events_dropped_shown = subscription.dropped
+    for event in events:
+        st.session_state.display_history.append({"role": "model", "text": event["text"], "timestamp": event["timestamp"]})
+    st.rerun()
+
+data, in_flight = poll_pending_requests(data, data_manager)
+
 # Render UI
-data = render_ui(data, data_manager, process_user_input)
\ No newline at end of file
+data = render_ui(data, data_manager, process_user_input)
+
+# Check this run against its overhead budget; the first run of the process is the cold start
+elapsed, cold = metrics.record_app_run(time.perf_counter() - RUN_STARTED)
+if elapsed > (COLD_START_BUDGET if cold else RERUN_BUDGET):
+    run = "cold" if cold else "rerun"
+    metrics.inc("comfort_app_runs_over_budget_total", run=run)
+    metrics.set_gauge("comfort_app_run_over_budget_seconds", elapsed, run=run)
+
+# Keep polling only while model replies are in flight; an idle session stays idle
+if in_flight:
+    time.sleep(0.25)
+    st.rerun()
\ No newline at end of file
@@ -0,0 +1,395 @@
+"""
+Benchmark harness for the rule engine, persistence layer and publish path.
+
+Runs against synthetic data in a throwaway directory and reports:
+  - rule evaluation: index compile time, tick latency and ticks/second for
+    rule sets of 10 to 100k rules across several rooms
+  - persistence: bytes written per evaluator tick (state checkpoints and
+    sensor history) and the cost of update_user_preference on large rule files
+  - scheduling: add/cancel cost and firing lag under a schedule load
+  - cold start: import time of app.py's modules in a fresh interpreter, and
+    which heavy modules (Gemini SDK, paho, NumPy) those imports pulled in
+  - publishing: action-to-publish latency through mqtt_background_task with
+    a fake in-process broker client
+
+    python bench.py
+    python bench.py --quick --save baseline.json
+    python bench.py --compare baseline.json > bench_output.txt
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+RULE_COUNTS = (10, 100, 1000, 10000, 100000)
+SENSORS = ("temperature", "humidity", "light_level")
+SENSOR_RANGES = {"temperature": (10, 40), "humidity": (20, 90), "light_level": (0, 100)}
+TIME_WINDOWS = ("", "06:00-18:00", "18:01-05:59")
+# Modules app.py imports besides Streamlit, and heavy ones that must stay out of a cold start
+APP_MODULES = ("ui", "utils", "state", "intents", "llm", "prompt_context", "history", "chat_history", "events", "workers", "metrics")
+HEAVY_MODULES = ("google.generativeai", "paho.mqtt.client", "numpy", "http.server")
+REGRESSION_TOLERANCE = 0.2  # Relative slowdown reported by --compare
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+def written_bytes():
+    """Bytes this process has passed to write() so far (Linux only), or None."""
+    try:
+        with open("/proc/self/io", "r") as f:
+            for line in f:
+                if line.startswith("wchar:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+def generate_rules(count):
+    """Rule set with `count` rules split across the sensors, in narrow bands with time windows."""
+    rule_set = {}
+    per_sensor = max(1, count // len(SENSORS))
+    for sensor in SENSORS:
+        low, high = SENSOR_RANGES[sensor]
+        step = (high - low) / per_sensor
+        entries = []
+        for i in range(per_sensor):
+            entries.append({
+                "label": f"{sensor}_{i}",
+                "min": round(low + i * step, 4),
+                "max": round(low + (i + 0.9) * step, 4),
+                "time": TIME_WINDOWS[i % len(TIME_WINDOWS)],
+                "actions": {"fan": random.choice(["on", "off"]), "fan_speed": random.randrange(0, 101, 10)}
+                if sensor != "light_level" else
+                {"light": random.choice(["on", "off"]), "set_brightness": random.randrange(0, 101, 10)},
+            })
+        rule_set[sensor] = entries
+    return {"fixed_rule": rule_set, "user_preference": rule_set}
+
+def random_sensors():
+    return {sensor: round(random.uniform(*SENSOR_RANGES[sensor]), 1) for sensor in SENSORS}
+
+def make_rooms(room_count):
+    from state import get_default_data, DEFAULT_ROOM
+    rooms = {DEFAULT_ROOM: get_default_data()}
+    for i in range(1, room_count):
+        rooms[f"room{i}"] = get_default_data()
+    return rooms
+
+def bench_rules(counts, rooms, ticks):
+    """Compile time, tick latency and ticks/second of update_room_actions."""
+    import update
+    results = {}
+    for count in counts:
+        rules = generate_rules(count)
+        start = time.perf_counter()
+        update.get_rule_index(rules, "fixed_rule")
+        compile_time = time.perf_counter() - start
+
+        room_data = make_rooms(rooms)
+        latencies = []
+        for _ in range(ticks):
+            for room in room_data.values():
+                room["sensors"] = random_sensors()
+            start = time.perf_counter()
+            update.update_room_actions(room_data, rules, "fixed_rule")
+            latencies.append(time.perf_counter() - start)
+        total = sum(latencies)
+        results[f"rules_{count}"] = {
+            "compile_ms": compile_time * 1000,
+            "tick_p50_us": percentile(latencies, 0.5) * 1e6,
+            "tick_p99_us": percentile(latencies, 0.99) * 1e6,
+            "ticks_per_s": ticks / total if total else 0.0,
+        }
+        print(f"rules={count:<7} rooms={rooms:<3} compile {compile_time * 1000:8.1f} ms  "
+              f"tick p50 {results[f'rules_{count}']['tick_p50_us']:9.1f} us  p99 {results[f'rules_{count}']['tick_p99_us']:9.1f} us  "
+              f"{results[f'rules_{count}']['ticks_per_s']:10.0f} ticks/s")
+    return results
+
+def bench_persistence(rooms, ticks):
+    """
+    Bytes written per simulated 1 Hz evaluator tick: action merges into the
+    state store and its journal, the write-behind checkpoint and the sensor
+    history.
+    """
+    from state import StateStore, CHECKPOINT_INTERVAL, DEFAULT_ROOM
+    from history import SensorHistory
+    from journal import Journal
+    import update
+
+    rules = generate_rules(1000)
+    store = StateStore(os.path.abspath("bench_data.json"), journal=Journal(os.path.abspath("bench_journal")))
+    history = SensorHistory(os.path.abspath("bench_history.db"))
+    store.update({**make_rooms(1)[DEFAULT_ROOM], "rooms": {room_id: data for room_id, data in make_rooms(rooms).items() if room_id != DEFAULT_ROOM}})
+    before = written_bytes()
+    start_time = time.time()
+    checkpoints = 0
+    start = time.perf_counter()
+    for tick in range(ticks):
+        now = start_time + tick
+        _, data = store.snapshot()
+        room_data = {DEFAULT_ROOM: {**data, "sensors": random_sensors()},
+                     **{room_id: {**room, "sensors": random_sensors()} for room_id, room in data.get("rooms", {}).items()}}
+        actions = update.update_room_actions(room_data, rules, "fixed_rule")
+        store.merge("action", actions[DEFAULT_ROOM])
+        store.merge_rooms("action", {room_id: room_actions for room_id, room_actions in actions.items() if room_id != DEFAULT_ROOM})
+        history.record({room_id: room["sensors"] for room_id, room in room_data.items()}, now)
+        history.maybe_flush(now)
+        if tick % CHECKPOINT_INTERVAL == 0:
+            checkpoints += store.checkpoint()
+    history.flush(start_time + ticks)
+    store.checkpoint()
+    elapsed = time.perf_counter() - start
+    after = written_bytes()
+    per_tick = (after - before) / ticks if before is not None and after is not None else None
+    shown = f"{per_tick:10.0f}" if per_tick is not None else "       n/a"
+    print(f"persistence rooms={rooms:<3} ticks={ticks:<5} bytes/tick {shown}  checkpoints {checkpoints}  {ticks / elapsed:8.0f} ticks/s")
+    return {"persistence": {"bytes_per_tick": per_tick, "ticks_per_s": ticks / elapsed}}
+
+def bench_user_preference(counts, calls):
+    """Latency of update_user_preference against rule.json files of growing size."""
+    try:
+        from utils import update_user_preference
+    except ImportError as e:
+        print(f"update_user_preference skipped: {e}")
+        return {}
+    results = {}
+    actions = [{"action_type": "fan", "action_value": "on"}, {"action_type": "fan_speed", "action_value": "60"}]
+    for count in counts:
+        with open("rule.json", "w") as f:
+            json.dump(generate_rules(count), f, indent=4)
+        latencies = []
+        for _ in range(calls):
+            start = time.perf_counter()
+            update_user_preference({"sensors": random_sensors()}, actions)
+            latencies.append(time.perf_counter() - start)
+        results[f"user_preference_{count}"] = {"first_ms": latencies[0] * 1000, "steady_ms": percentile(latencies[1:] or latencies, 0.5) * 1000}
+        print(f"update_user_preference rules={count:<7} first {latencies[0] * 1000:9.2f} ms  steady p50 {results[f'user_preference_{count}']['steady_ms']:9.2f} ms")
+    return results
+
+def bench_scheduler(loads, fire_count):
+    """Add/cancel cost for pending schedules of growing size and firing lag of due entries."""
+    from scheduler import Scheduler
+    results = {}
+    for load in loads:
+        scheduler = Scheduler(lambda entry: None, os.path.abspath(f"bench_scheduler_{load}.json"), os.path.abspath(f"bench_scheduler_{load}.json.lock"))
+        far = time.time() + 3600
+        before = written_bytes()
+        start = time.perf_counter()
+        ids = []
+        for i in range(load):
+            action_id = str(uuid.uuid4())
+            scheduler.add({"id": action_id, "scheduled_time": far + i, "actions": [], "description": "bench"})
+            ids.append(action_id)
+        add_time = (time.perf_counter() - start) / load
+        after = written_bytes()
+        start = time.perf_counter()
+        for action_id in ids[:min(100, load)]:
+            scheduler.cancel(action_id)
+        cancel_time = (time.perf_counter() - start) / min(100, load)
+        add_bytes = (after - before) / load if before is not None and after is not None else None
+        results[f"schedule_{load}"] = {"add_ms": add_time * 1000, "cancel_ms": cancel_time * 1000, "bytes_per_add": add_bytes}
+        shown = f"{add_bytes:10.0f}" if add_bytes is not None else "       n/a"
+        print(f"scheduler pending={load:<6} add {add_time * 1000:8.3f} ms  cancel {cancel_time * 1000:8.3f} ms  bytes/add {shown}")
+
+        # The same entries through add_many(), one rewrite of scheduler.json
+        scheduler = Scheduler(lambda entry: None, os.path.abspath(f"bench_scheduler_batch_{load}.json"), os.path.abspath(f"bench_scheduler_batch_{load}.json.lock"))
+        entries = [{"id": str(uuid.uuid4()), "scheduled_time": far + i, "actions": [], "description": "bench"} for i in range(load)]
+        before = written_bytes()
+        start = time.perf_counter()
+        scheduler.add_many(entries)
+        batch_time = time.perf_counter() - start
+        after = written_bytes()
+        batch_bytes = (after - before) / load if before is not None and after is not None else None
+        results[f"schedule_batch_{load}"] = {"add_ms": batch_time * 1000 / load, "bytes_per_add": batch_bytes}
+        shown = f"{batch_bytes:10.0f}" if batch_bytes is not None else "       n/a"
+        print(f"scheduler batch n={load:<9} add {batch_time * 1000 / load:8.3f} ms  total {batch_time * 1000:8.2f} ms  bytes/add {shown}")
+
+    lags = []
+    done = threading.Event()
+    def handler(entry):
+        lags.append(time.time() - entry["scheduled_time"])
+        if len(lags) >= fire_count:
+            done.set()
+    scheduler = Scheduler(handler, os.path.abspath("bench_scheduler_fire.json"), os.path.abspath("bench_scheduler_fire.json.lock"))
+    scheduler.start()
+    now = time.time()
+    for i in range(fire_count):
+        scheduler.add({"id": str(uuid.uuid4()), "scheduled_time": now + 0.5 + i * 1.0 / fire_count, "actions": [], "description": "bench"})
+    done.wait(10)
+    scheduler.stop()
+    results["schedule_fire"] = {"lag_p50_ms": percentile(lags, 0.5) * 1000, "lag_p99_ms": percentile(lags, 0.99) * 1000}
+    print(f"scheduler firing n={len(lags):<5} lag p50 {results['schedule_fire']['lag_p50_ms']:8.2f} ms  p99 {results['schedule_fire']['lag_p99_ms']:8.2f} ms")
+    return results
+
+class FakeResult:
+    rc = 0
+
+class FakeClient:
+    """Stands in for paho's Client: connects instantly and records publish times."""
+
+    def __init__(self, *args, **kwargs):
+        self.published = []
+        self.connected = False
+        self.on_connect = self.on_disconnect = self.on_message = None
+        self.cond = threading.Condition()
+
+    def connect(self, *args, **kwargs):
+        self.connected = True
+
+    def loop_start(self):
+        if self.on_connect:
+            self.on_connect(self, None, {}, 0)
+
+    def loop_stop(self):
+        pass
+
+    def disconnect(self):
+        self.connected = False
+
+    def is_connected(self):
+        return self.connected
+
+    def reconnect(self):
+        self.connected = True
+
+    def subscribe(self, *args, **kwargs):
+        pass
+
+    def publish(self, topic, payload, qos=0):
+        with self.cond:
+            self.published.append((time.perf_counter(), topic, json.loads(payload)))
+            self.cond.notify_all()
+        return FakeResult()
+
+def bench_publish(updates):
+    """Action-to-publish latency of mqtt_background_task with a fake broker client."""
+    try:
+        import mqtt
+    except ImportError as e:
+        print(f"publish path skipped: {e}")
+        return {}
+    from state import get_store
+    clients = []
+    def make_client():
+        clients.append(FakeClient())
+        return clients[-1]
+    mqtt.create_client = make_client  # Route the publisher to the fake broker
+    mqtt.MQTT_STATUS_FILE = os.path.abspath("bench_mqtt_status.json")
+
+    store = get_store()
+    stop_event = threading.Event()
+    thread = threading.Thread(target=mqtt.mqtt_background_task, args=(stop_event,), daemon=True)
+    thread.start()
+    deadline = time.time() + 5
+    while (not clients or not clients[0].published) and time.time() < deadline:
+        time.sleep(0.01)
+    if not clients:
+        print("publish path skipped: publisher did not start")
+        return {}
+    client = clients[0]
+
+    latencies = []
+    for i in range(updates):
+        speed = (i * 7) % 100 + 1
+        with client.cond:
+            seen = len(client.published)
+        start = time.perf_counter()
+        store.merge("action", {"fan_speed": speed})
+        with client.cond:
+            client.cond.wait_for(lambda: any(topic == "fan_speed" and payload == speed for _, topic, payload in client.published[seen:]), 5)
+            sent = next((at for at, topic, payload in client.published[seen:] if topic == "fan_speed" and payload == speed), None)
+        if sent is not None:
+            latencies.append(sent - start)
+    stop_event.set()
+    thread.join(5)
+    store.checkpoint()  # Leaves nothing for the exit-time checkpoint into the deleted directory
+    result = {"publish_p50_ms": percentile(latencies, 0.5) * 1000, "publish_p99_ms": percentile(latencies, 0.99) * 1000}
+    print(f"publish updates={len(latencies):<5} action-to-publish p50 {result['publish_p50_ms']:8.2f} ms  p99 {result['publish_p99_ms']:8.2f} ms")
+    return {"publish": result}
+
+def bench_cold_start(runs):
+    """Import time of the app's modules in fresh interpreters (best of `runs`)."""
+    here = os.path.dirname(os.path.abspath(__file__))
+    script = (
+        "import sys, time\n"
+        "start = time.perf_counter()\n"
+        f"for name in {APP_MODULES!r}:\n"
+        "    __import__(name)\n"
+        "print(time.perf_counter() - start)\n"
+        f"print(','.join(name for name in {HEAVY_MODULES!r} if name in sys.modules))\n"
+    )
+    timings, heavy = [], ""
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, "-c", script], cwd=here, capture_output=True, text=True)
+        if result.returncode != 0:
+            print(f"cold start skipped: {result.stderr.strip().splitlines()[-1] if result.stderr.strip() else result.returncode}")
+            return {}
+        lines = result.stdout.strip().splitlines()
+        timings.append(float(lines[0]))
+        heavy = lines[1] if len(lines) > 1 else ""
+    best = min(timings)
+    print(f"cold start imports {best * 1000:8.1f} ms  heavy modules loaded: {heavy or 'none'}")
+    return {"cold_start": {"import_ms": best * 1000}}
+
+def compare(results, baseline):
+    """Print metrics that got worse than the baseline by more than REGRESSION_TOLERANCE."""
+    regressions = 0
+    for name, metrics in results.items():
+        for metric, value in metrics.items():
+            old = baseline.get(name, {}).get(metric)
+            if value is None or not old:
+                continue
+            # Throughput regresses when it drops, everything else when it grows
+            change = (old - value) / old if metric.endswith("_per_s") else (value - old) / old
+            if change > REGRESSION_TOLERANCE:
+                regressions += 1
+                print(f"REGRESSION {name}.{metric}: {old:.2f} -> {value:.2f} ({change:+.0%})")
+    print(f"{regressions} regression(s) against baseline")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--quick", action="store_true", help="Smaller rule sets and fewer iterations")
+    parser.add_argument("--rooms", type=int, default=4, help="Rooms evaluated per tick")
+    parser.add_argument("--save", help="Write the results as JSON to this file")
+    parser.add_argument("--compare", help="Baseline JSON to check for regressions; exits non-zero on any")
+    args = parser.parse_args()
+
+    counts = RULE_COUNTS[:3] if args.quick else RULE_COUNTS
+    ticks = 200 if args.quick else 1000
+    random.seed(42)
+    cwd = os.getcwd()
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        # The modules use paths relative to the working directory
+        os.chdir(tmp)
+        with open("config.json", "w") as f:
+            json.dump({"active_rule_set": "fixed_rule"}, f)
+        results.update(bench_cold_start(3))
+        results.update(bench_rules(counts, args.rooms, ticks))
+        results.update(bench_persistence(args.rooms, ticks))
+        results.update(bench_user_preference(counts, 5 if args.quick else 20))
+        results.update(bench_scheduler((10, 100) if args.quick else (10, 100, 1000), 50 if args.quick else 200))
+        results.update(bench_publish(20 if args.quick else 100))
+        os.chdir(cwd)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.compare:
+        with open(args.compare, "r") as f:
+            baseline = json.load(f)
+        if compare(results, baseline):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import time
+from bisect import bisect_right
+
+# Configuration
+CHAT_WINDOW = 50  # Messages rendered at once; older ones are paged in on demand
+
+class ChatHistory:
+    """
+    Ordered chat history for one session.
+
+    Messages are kept sorted by timestamp as they are appended (almost always
+    at the end, so insertion is O(1) in practice), which spares render_ui a
+    full sort on every rerun. Messages without a timestamp get the current
+    time. The rendered HTML of each message is cached and rebuilt only when
+    its text changes, and render_html() materialises only the newest
+    `window` messages.
+    """
+
+    def __init__(self, messages=None):
+        self._messages = []
+        self._timestamps = []
+        self._html = {}  # id(message) -> (message, text, html)
+        for message in messages or []:
+            self.append(message)
+
+    def append(self, message):
+        message.setdefault("timestamp", time.time())
+        timestamp = message["timestamp"]
+        if not self._timestamps or timestamp >= self._timestamps[-1]:
+            self._messages.append(message)
+            self._timestamps.append(timestamp)
+        else:
+            i = bisect_right(self._timestamps, timestamp)
+            self._messages.insert(i, message)
+            self._timestamps.insert(i, timestamp)
+
+    def remove(self, message):
+        for i in range(len(self._messages) - 1, -1, -1):
+            if self._messages[i] is message:
+                del self._messages[i]
+                del self._timestamps[i]
+                self._html.pop(id(message), None)
+                return
+        raise ValueError("message not in history")
+
+    def __len__(self):
+        return len(self._messages)
+
+    def __iter__(self):
+        return iter(self._messages)
+
+    def __getitem__(self, index):
+        return self._messages[index]
+
+    def window(self, size):
+        return self._messages[-size:] if size else []
+
+    def message_html(self, message):
+        cached = self._html.get(id(message))
+        if cached is not None and cached[0] is message and cached[1] == message["text"]:
+            return cached[2]
+        cls = "chat-user" if message["role"] == "user" else "chat-model"
+        html = f'<div class="{cls}"><strong>{message["role"].capitalize()}:</strong><br>{message["text"]}</div>'
+        self._html[id(message)] = (message, message["text"], html)
+        return html
+
+    def render_html(self, window=CHAT_WINDOW):
+        """HTML of the newest `window` messages, newest first for the reversed flex container."""
+        parts = [self.message_html(message) for message in reversed(self.window(window))]
+        return '<div id="chat-container">' + "".join(parts) + '</div>'
@@ -0,0 +1,89 @@
+import threading
+import time
+from collections import deque
+from itertools import islice
+
+# Configuration
+EVENT_BUFFER_SIZE = 1000  # Events of each kind kept for subscribers that have not drained yet
+
+class Subscription:
+    """A reader's position in the event stream, optionally limited to some kinds."""
+
+    def __init__(self, bus, cursors, kinds=None):
+        self.bus = bus
+        self.cursors = cursors  # kind -> per-kind number of the last event read
+        self.kinds = set(kinds) if kinds else None
+        self.dropped = 0
+
+    def drain(self):
+        """Return the events published since the last drain, oldest first."""
+        events, dropped = self.bus.read_since(self.cursors, self.kinds)
+        self.dropped += dropped
+        return events
+
+class EventBus:
+    """
+    In-process event bus between the background threads and UI sessions.
+
+    Events carry a sequence number and live in one bounded ring buffer per
+    kind, so a burst of frequent "status" events cannot push rarer ones such
+    as "schedule_executed" out. Each subscriber keeps its own per-kind
+    cursors, so any number of sessions can drain the same events
+    independently and nobody has to clear them. A subscriber that falls more
+    than EVENT_BUFFER_SIZE events of one kind behind loses the oldest ones
+    and is told how many it missed.
+    """
+
+    def __init__(self, maxlen=EVENT_BUFFER_SIZE):
+        self.maxlen = maxlen
+        self._events = {}  # kind -> deque of (per-kind number, event)
+        self._counts = {}  # kind -> events published
+        self._seq = 0
+        self._latest = {}
+        self._lock = threading.Lock()
+
+    def publish(self, kind, text=None, **payload):
+        with self._lock:
+            self._seq += 1
+            count = self._counts[kind] = self._counts.get(kind, 0) + 1
+            event = {"seq": self._seq, "kind": kind, "text": text, "timestamp": time.time(), **payload}
+            ring = self._events.get(kind)
+            if ring is None:
+                ring = self._events[kind] = deque(maxlen=self.maxlen)
+            ring.append((count, event))
+            self._latest[kind] = event
+            return self._seq
+
+    def subscribe(self, kinds=None):
+        """Start a subscription that receives events published from now on."""
+        with self._lock:
+            return Subscription(self, dict(self._counts), kinds)
+
+    def read_since(self, cursors, kinds=None):
+        """
+        Return (events after the per-kind cursors oldest first, number of
+        events lost to overflow), advancing cursors in place.
+        """
+        with self._lock:
+            events = []
+            dropped = 0
+            for kind, ring in self._events.items():
+                if kinds is not None and kind not in kinds:
+                    continue
+                last = cursors.get(kind, 0)
+                if last >= self._counts[kind]:
+                    continue
+                first = ring[0][0]
+                dropped += max(0, first - last - 1)
+                events.extend(event for _, event in islice(ring, max(0, last + 1 - first), None))
+                cursors[kind] = self._counts[kind]
+        events.sort(key=lambda event: event["seq"])
+        return events, dropped
+
+    def latest(self, kind):
+        """Return the most recent event of a kind, or None."""
+        with self._lock:
+            return self._latest.get(kind)
+
+# Process-wide bus shared by the scheduler, evaluator, publisher and UI sessions
+bus = EventBus()
@@ -0,0 +1,165 @@
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+from state import DEFAULT_ROOM
+import metrics
+
+# Configuration
+HISTORY_FILE = 'history.db'
+FLUSH_INTERVAL = 30  # Seconds of 1 Hz samples buffered in memory before one batched insert
+RAW_RETENTION = 24 * 3600  # Seconds of 1 s samples kept
+MINUTE_RETENTION = 7 * 24 * 3600  # Seconds of 1 min rollups kept
+HOUR_RETENTION = 365 * 24 * 3600  # Seconds of 1 h rollups kept
+
+# Tables by resolution; every table stores min/max/sum/count so rollups compose
+TABLES = {1: "samples", 60: "rollup_1m", 3600: "rollup_1h"}
+
+class SensorHistory:
+    """
+    Embedded SQLite time-series store for sensor readings.
+
+    record() only appends to an in-memory buffer; flush() writes the buffer
+    in one transaction, rolls completed minutes up into rollup_1m and
+    completed hours into rollup_1h, and deletes rows past their retention.
+    The database runs in WAL mode with synchronous=NORMAL to keep SD-card
+    writes to one batched commit per FLUSH_INTERVAL.
+    """
+
+    def __init__(self, path=HISTORY_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._buffer = {}  # (room, metric, second) -> value
+        self._last_flush = time.time()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            for table in TABLES.values():
+                self._conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {table} (room TEXT, metric TEXT, ts INTEGER, "
+                    f"min REAL, max REAL, sum REAL, count INTEGER, PRIMARY KEY (room, metric, ts)) WITHOUT ROWID"
+                )
+            self._conn.execute("CREATE TABLE IF NOT EXISTS rollup_state (resolution INTEGER PRIMARY KEY, done_until INTEGER)")
+
+    def record(self, sensors_by_room, ts=None):
+        """Buffer one reading per room and metric; later readings in the same second win."""
+        second = int(ts if ts is not None else time.time())
+        with self._lock:
+            for room, sensors in sensors_by_room.items():
+                for metric, value in sensors.items():
+                    if isinstance(value, (int, float)):
+                        self._buffer[(room, metric, second)] = float(value)
+
+    def maybe_flush(self, now=None):
+        now = now if now is not None else time.time()
+        if now - self._last_flush >= FLUSH_INTERVAL:
+            self.flush(now)
+
+    def flush(self, now=None):
+        now = int(now if now is not None else time.time())
+        with self._lock:
+            rows = [(room, metric, second, value, value, value, 1) for (room, metric, second), value in self._buffer.items()]
+            self._buffer = {}
+            self._last_flush = now
+            metrics.inc("comfort_history_rows_written_total", len(rows))
+            with metrics.timed("comfort_history_flush_seconds"), self._conn:
+                self._conn.executemany("INSERT OR REPLACE INTO samples VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+                self._roll_up("samples", "rollup_1m", 60, now)
+                self._roll_up("rollup_1m", "rollup_1h", 3600, now)
+                for table, retention in (("samples", RAW_RETENTION), ("rollup_1m", MINUTE_RETENTION), ("rollup_1h", HOUR_RETENTION)):
+                    self._conn.execute(f"DELETE FROM {table} WHERE ts < ?", (now - retention,))
+
+    def _roll_up(self, source, target, resolution, now):
+        # Aggregate every completed bucket since the last roll-up of this resolution
+        row = self._conn.execute("SELECT done_until FROM rollup_state WHERE resolution = ?", (resolution,)).fetchone()
+        done_until = row[0] if row else 0
+        until = now // resolution * resolution
+        if until <= done_until:
+            return
+        self._conn.execute(
+            f"INSERT OR REPLACE INTO {target} "
+            f"SELECT room, metric, ts / {resolution} * {resolution} AS bucket, MIN(min), MAX(max), SUM(sum), SUM(count) "
+            f"FROM {source} WHERE ts >= ? AND ts < ? GROUP BY room, metric, bucket",
+            (done_until, until)
+        )
+        self._conn.execute("INSERT OR REPLACE INTO rollup_state VALUES (?, ?)", (resolution, until))
+
+    def query(self, metric, start, end, room=DEFAULT_ROOM, resolution=None):
+        """
+        Return [(ts, min, avg, max)] for a time range. The resolution defaults
+        to the finest table that still covers the whole range.
+        """
+        if resolution is None:
+            span, oldest = end - start, time.time() - start
+            if oldest <= RAW_RETENTION and span <= 2 * 3600:
+                resolution = 1
+            elif oldest <= MINUTE_RETENTION and span <= 3 * 24 * 3600:
+                resolution = 60
+            else:
+                resolution = 3600
+        low = int(start) // resolution * resolution
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT ts, min, sum / count, max FROM {TABLES[resolution]} "
+                f"WHERE room = ? AND metric = ? AND ts >= ? AND ts < ? ORDER BY ts",
+                (room, metric, low, int(end))
+            ).fetchall()
+            # Readings not flushed yet are merged in rather than committed, so
+            # reads never add SD-card writes
+            pending = {second: value for (buffered_room, buffered_metric, second), value in self._buffer.items()
+                       if resolution == 1 and buffered_room == room and buffered_metric == metric and low <= second < end}
+        if pending:
+            merged = {row[0]: row for row in rows}
+            merged.update((second, (second, value, value, value)) for second, value in pending.items())
+            rows = [merged[second] for second in sorted(merged)]
+        if resolution != 1:
+            # The newest, not yet rolled-up bucket lives only in the finer tables
+            finer = 1 if resolution == 60 else 60
+            last = rows[-1][0] + resolution if rows else int(start)
+            buckets = {}
+            for row in self.query(metric, last, end, room, finer) if last < end else []:
+                buckets.setdefault(row[0] // resolution * resolution, []).append(row)
+            for bucket, tail in sorted(buckets.items()):
+                rows.append((bucket, min(row[1] for row in tail), sum(row[2] for row in tail) / len(tail), max(row[3] for row in tail)))
+        return rows
+
+    def summary(self, metric, start, end, room=DEFAULT_ROOM):
+        """Return (min, avg, max) over a range, or None without data."""
+        rows = self.query(metric, start, end, room)
+        if not rows:
+            return None
+        return min(row[1] for row in rows), sum(row[2] for row in rows) / len(rows), max(row[3] for row in rows)
+
+    def describe_recent(self, metrics=("temperature", "humidity", "light_level"), room=DEFAULT_ROOM, now=None):
+        """Compact text summary of recent history for the chat context."""
+        now = datetime.fromtimestamp(now) if now is not None else datetime.now()
+        night_end = now.replace(hour=6, minute=0, second=0, microsecond=0)
+        if night_end > now:
+            night_end -= timedelta(days=1)
+        periods = [
+            ("last hour", now - timedelta(hours=1), now),
+            ("last night 18:00-06:00", night_end - timedelta(hours=12), night_end),
+            ("last 24 hours", now - timedelta(hours=24), now),
+        ]
+        lines = []
+        for label, start, end in periods:
+            parts = []
+            for metric in metrics:
+                stats = self.summary(metric, start.timestamp(), end.timestamp(), room)
+                if stats:
+                    parts.append(f"{metric} min {stats[0]:.1f}/avg {stats[1]:.1f}/max {stats[2]:.1f}")
+            if parts:
+                lines.append(f"{label}: " + ", ".join(parts))
+        return "\n".join(lines)
+
+# Process-wide history store fed by the evaluator loop
+_history = None
+_history_lock = threading.Lock()
+
+def get_history():
+    global _history
+    with _history_lock:
+        if _history is None:
+            _history = SensorHistory(HISTORY_FILE)
+        return _history
@@ -0,0 +1,111 @@
+import time
+
+# Configuration, overridable through the "hysteresis" section of config.json
+DEFAULT_DEAD_BANDS = {"temperature": 1, "humidity": 2, "light_level": 5}  # Reading changes smaller than this are ignored
+DEFAULT_MIN_DWELL = 10  # Seconds an actuator keeps a value before the rules may change it again
+ACTUATORS = {"fan": ("fan", "fan_speed"), "light": ("light", "set_brightness")}  # Keys that change together
+ACTUATOR_OF = {key: actuator for actuator, keys in ACTUATORS.items() for key in keys}
+
+class ActionStabilizer:
+    """
+    Debouncing stage between the rule evaluator and the action state.
+
+    Sensor readings pass through a per-sensor dead-band: the evaluator keeps
+    matching rules against the last accepted reading until a new one differs
+    from it by at least the band, so a reading hovering on a rule boundary
+    no longer flips the result every tick. Actuator changes then have to
+    respect a minimum dwell time per actuator (fan covers fan and fan_speed,
+    light covers light and set_brightness): a change proposed too soon after
+    the previous one is held back as a whole and applied once the dwell
+    expires, provided the rules still want it. Changes made outside the
+    evaluator (manual controls, scheduled actions) count as a change too.
+
+    config.json may carry {"hysteresis": {"dead_bands": {"temperature": 1},
+    "min_dwell": 30 or {"fan": 30, "light": 5}}}.
+    """
+
+    def __init__(self, settings=None):
+        self._settings = None
+        self._held = {}  # (room_id, sensor) -> accepted reading
+        self._last_value = {}  # (room_id, actuator) -> (values, changed_at)
+        self.deferred_until = None
+        self.suppressed = 0
+        self.configure(settings)
+
+    def configure(self, settings):
+        """Apply the hysteresis section of config.json; a no-op while it is unchanged."""
+        settings = settings or {}
+        if settings == self._settings:
+            return
+        self._settings = settings
+        self.dead_bands = {**DEFAULT_DEAD_BANDS, **settings.get("dead_bands", {})}
+        min_dwell = settings.get("min_dwell", DEFAULT_MIN_DWELL)
+        if isinstance(min_dwell, dict):
+            self.default_dwell, self.dwell = DEFAULT_MIN_DWELL, dict(min_dwell)
+        else:
+            self.default_dwell, self.dwell = min_dwell, {}
+
+    def filter_sensors(self, room_id, sensors):
+        """Return the readings the rules should see for one room."""
+        filtered = {}
+        for sensor_name, value in sensors.items():
+            key = (room_id, sensor_name)
+            held = self._held.get(key)
+            band = self.dead_bands.get(sensor_name, 0)
+            if held is None or not isinstance(value, (int, float)) or abs(value - held) >= band:
+                self._held[key] = held = value
+            filtered[sensor_name] = held
+        return filtered
+
+    def apply_dwell(self, room_id, current, proposed, now=None):
+        """
+        Return the actions to commit for one room: proposed, except for
+        actuators whose last change is younger than their minimum dwell.
+        An actuator's keys are held back or released together, so a fan is
+        never committed as off while keeping the speed it ran at.
+        """
+        now = now if now is not None else time.time()
+        result = dict(proposed)
+        groups = {}
+        for key in proposed:
+            groups.setdefault(ACTUATOR_OF.get(key, key), []).append(key)
+        for actuator, keys in groups.items():
+            state_key = (room_id, actuator)
+            wanted = tuple(proposed[key] for key in keys)
+            if any(key not in current for key in keys):
+                self._last_value[state_key] = (wanted, now)
+                continue
+            committed = tuple(current[key] for key in keys)
+            last = self._last_value.get(state_key)
+            if last is None or last[0] != committed:
+                # First sighting, or changed outside the evaluator
+                last = (committed, now if last is not None else float("-inf"))
+                self._last_value[state_key] = last
+            if wanted == committed:
+                continue
+            expires = last[1] + self.dwell.get(actuator, self.default_dwell)
+            if now < expires:
+                result.update((key, current[key]) for key in keys)
+                self.suppressed += 1
+                self.deferred_until = expires if self.deferred_until is None else min(self.deferred_until, expires)
+            else:
+                self._last_value[state_key] = (wanted, now)
+        return result
+
+    def apply(self, rooms, evaluate, now=None):
+        """
+        Run evaluate(rooms) on the dead-banded readings of every room and
+        filter its {room_id: actions} result through the dwell times.
+        """
+        now = now if now is not None else time.time()
+        self.deferred_until = None
+        filtered = {room_id: {**room, "sensors": self.filter_sensors(room_id, room.get("sensors", {}))}
+                    for room_id, room in rooms.items()}
+        proposed = evaluate(filtered)
+        return {room_id: self.apply_dwell(room_id, rooms[room_id].get("action", {}), actions, now)
+                for room_id, actions in proposed.items()}
+
+    def due(self, now=None):
+        """True when a held-back change may now be applied."""
+        now = now if now is not None else time.time()
+        return self.deferred_until is not None and now >= self.deferred_until
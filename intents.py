@@ -0,0 +1,185 @@
+import json
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from recurrence import (parse_recurrence, parse_time, CRON_PATTERN, DAILY_PATTERN, DELAY_PATTERN,
+                        SUN_PATTERN, TIME_PATTERN, WEEKDAYS_PATTERN)
+
+# Configuration
+RESPONSE_CACHE_SIZE = 256
+
+# Scheduling clauses are handled by process_user_input itself, so the ones
+# it will schedule are stripped before matching the command they apply to.
+# Anything it would not schedule (e.g. a one-off "at sunset") is kept, so
+# the command is not matched and run at once.
+RECURRENCE_CLAUSES = (SUN_PATTERN, TIME_PATTERN, DAILY_PATTERN, WEEKDAYS_PATTERN)
+SCHEDULE_PREFIX = re.compile(r"^\s*(?:please\s+)?schedule\s+(?:to\s+)?")
+SET_LEVEL_PATTERN = re.compile(
+    r"(?:please\s+)?(?:set|turn|change|put|make)?\s*(?:the\s+)?"
+    r"(fan speed|fan|light brightness|brightness|lights?)\s*(?:speed|brightness|level)?\s*"
+    r"(?:to|at)?\s*(\d{1,3})\s*(?:%|percent)?"
+)
+CANCEL_PATTERN = re.compile(
+    r"(?:please\s+)?(?:cancel|clear|remove|delete)\s+(?:all\s+)?(?:the\s+|my\s+)?(?:scheduled\s+)?"
+    r"(?:actions?|schedules?|timers?)"
+)
+RULE_SET_PATTERN = re.compile(r"(?:use|switch to|set|enable)\s+(?:the\s+)?(fixed rules?|user preferences?)")
+# Queries whose answer depends on earlier turns or on the schedule list are never cached
+CONTEXT_PATTERN = re.compile(
+    r"\b(?:yes|yeah|yep|no|nope|ok|okay|sure|it|that|this|those|them|again|same|instead|too|also|"
+    r"undo|previous|before|earlier|last)\b"
+)
+SCHEDULE_QUERY_PATTERN = re.compile(r"\b(?:schedul\w*|timers?|pending|planned|upcoming)\b")
+REPLY_JSON_PATTERN = re.compile(r'(\[\s*\{.*?\}\s*\]|\{.*?\})', re.DOTALL)
+DEVICE_ACTION_TYPES = {"fan", "light", "brightness", "fan_speed"}
+
+def normalize(text):
+    """Lower-case, drop punctuation and collapse whitespace."""
+    text = re.sub(r"[^\w\s:%]", " ", text.lower())
+    return re.sub(r"\s+", " ", text).strip()
+
+def strip_schedule(text):
+    """
+    The command part of a query, without the scheduling clause that
+    handle_model_response would act on: a recurrence, else a delay, else a
+    valid time of day. Cron clauses go before normalize(), which would drop
+    their "*" fields.
+    """
+    text = text.lower()
+    recurrence = parse_recurrence(text)
+    if recurrence is not None and recurrence["kind"] == "cron":
+        return strip_clauses(normalize(CRON_PATTERN.sub(" ", text)), ())
+    text = normalize(text)
+    if recurrence is not None:
+        return strip_clauses(text, RECURRENCE_CLAUSES)
+    if DELAY_PATTERN.search(text):
+        return strip_clauses(text, (DELAY_PATTERN,))
+    time_match = TIME_PATTERN.search(text)
+    if time_match and parse_time(time_match):
+        return strip_clauses(text, (TIME_PATTERN,))
+    return text
+
+def strip_clauses(text, patterns):
+    for pattern in (*patterns, SCHEDULE_PREFIX):
+        text = pattern.sub(" ", text)
+    return normalize(text)
+
+def match_intent(user_input, predefined_actions):
+    """
+    Resolve commands that need no language model: predefined actions,
+    "set fan/brightness to N%", cancelling all schedules and switching the
+    rule set. Returns a list of actions, or None when the input is not a
+    recognised command.
+    """
+    query = strip_schedule(user_input)
+    for name, actions in predefined_actions.items():
+        if normalize(name) == query:
+            return actions
+
+    match = SET_LEVEL_PATTERN.fullmatch(query)
+    if match:
+        level = int(match.group(2))
+        if level > 100:
+            return None
+        action_type = "fan_speed" if match.group(1).startswith("fan") else "brightness"
+        return [{"action_type": action_type, "action_value": str(level)}]
+
+    if CANCEL_PATTERN.fullmatch(query):
+        return [{"action_type": "cancel_scheduled", "action_value": "all"}]
+
+    match = RULE_SET_PATTERN.fullmatch(query)
+    if match:
+        rule_set = "fixed_rule" if match.group(1).startswith("fixed") else "user_preference"
+        return [{"action_type": "rule_set", "action_value": rule_set}]
+    return None
+
+def state_bucket(data, active_rule_set, scheduled_ids):
+    """
+    Coarse summary of the state a model answer may depend on. Queries asked
+    in the same bucket can reuse a cached answer. Actuator levels are kept
+    exact because relative commands ("increase the fan speed") answer with
+    a level computed from them, and so are the pending schedule ids.
+    """
+    sensors = data.get('sensors', {})
+    action = data.get('action', {})
+    return (
+        int(sensors.get('temperature', 0) // 2),
+        int(sensors.get('light_level', 0) // 10),
+        int(sensors.get('humidity', 0) // 10),
+        action.get('fan'),
+        action.get('light'),
+        action.get('fan_speed'),
+        action.get('set_brightness'),
+        active_rule_set,
+        scheduled_ids,
+        datetime.now().hour,
+    )
+
+class ResponseCache:
+    """Thread-safe LRU cache of model responses keyed by query and state bucket."""
+
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+# Shared by every session of the process
+response_cache = ResponseCache()
+
+def is_action_reply(text):
+    """True when a model reply parses into device actions only, the one kind worth caching."""
+    match = REPLY_JSON_PATTERN.search(text or "")
+    if not match:
+        return False
+    try:
+        actions = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return False
+    if isinstance(actions, dict):
+        actions = [actions]
+    return bool(actions) and all(isinstance(act, dict) and act.get("action_type") in DEVICE_ACTION_TYPES
+                                 for act in actions)
+
+def resolve_local(user_input, data, active_rule_set, scheduled_actions, predefined_actions, cache=response_cache):
+    """
+    Try to answer a query without the model, from the intent matcher or the
+    response cache. Returns (text, source, cache_key); text is None when the
+    model has to be asked, in which case an answer that passes
+    is_action_reply() should be stored in the cache under cache_key.
+    cache_key is None for queries that depend on the conversation or on the
+    schedule list, whose answers must not be reused.
+    """
+    actions = match_intent(user_input, predefined_actions)
+    if actions is not None:
+        if actions[0]["action_type"] == "cancel_scheduled" and not scheduled_actions:
+            return "There are no scheduled actions to cancel.", "intent", None
+        return json.dumps(actions), "intent", None
+
+    query = strip_schedule(user_input)
+    if CONTEXT_PATTERN.search(query) or SCHEDULE_QUERY_PATTERN.search(normalize(user_input)):
+        return None, "model", None
+    scheduled_ids = tuple(sorted(entry.get("id", "") for entry in scheduled_actions))
+    key = (query, state_bucket(data, active_rule_set, scheduled_ids))
+    text = cache.get(key)
+    if text is not None:
+        return text, "cache", key
+    return None, "model", key
@@ -0,0 +1,260 @@
+import hashlib
+import json
+import os
+import struct
+import threading
+import time
+import zlib
+from persistence import atomic_write_json, read_json, FSYNC_MODE, FSYNC_INTERVAL
+import metrics
+
+# Configuration
+JOURNAL_DIR = os.getenv("COMFORT_JOURNAL_DIR", "journal")
+JOURNAL_SEGMENT_BYTES = 4 * 1024 * 1024  # Log size that triggers compaction into a new snapshot
+JOURNAL_KEEP_SEGMENTS = 8  # Snapshot + log pairs kept for point-in-time replay
+RECORD_HEADER = struct.Struct(">II")  # Payload length, CRC32 of the payload
+EXPORT_FILE = "export.json"  # mtime and digest of the data.json the last checkpoint wrote
+
+def _segment_name(seq):
+    return f"{seq:020d}"
+
+def list_segments(directory):
+    """Return the start sequence numbers of the segments in directory, oldest first."""
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    return sorted(int(name[:-len(".snapshot.json")]) for name in names if name.endswith(".snapshot.json"))
+
+def read_snapshot(directory, start):
+    with open(os.path.join(directory, _segment_name(start) + ".snapshot.json"), 'r') as f:
+        return json.load(f)
+
+def _contains_record(buf):
+    """True if an intact record starts anywhere in buf."""
+    for pos in range(len(buf) - RECORD_HEADER.size):
+        length, crc = RECORD_HEADER.unpack_from(buf, pos)
+        start = pos + RECORD_HEADER.size
+        if not 0 < length <= len(buf) - start:
+            continue
+        payload = buf[start:start + length]
+        if payload[:1] == b"{" and payload[-1:] == b"}" and zlib.crc32(payload) == crc:
+            return True
+    return False
+
+def read_records(path):
+    """
+    Yield (offset_after, record) for every intact record of a log. Stops at
+    a torn or corrupt record that nothing intact follows, the tail left by
+    a crash mid-append. A bad record with intact ones after it is damage in
+    the middle of the log and raises ValueError, since skipping it would
+    silently drop every later command.
+    """
+    try:
+        f = open(path, 'rb')
+    except OSError:
+        return
+    with f:
+        offset = 0
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            length, crc = RECORD_HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                f.seek(offset + 1)
+                if _contains_record(f.read()):
+                    raise ValueError(f"corrupt record at offset {offset} of {path} is followed by intact records")
+                return
+            offset += RECORD_HEADER.size + length
+            yield offset, json.loads(payload)
+
+class Journal:
+    """
+    Append-only command journal for the state store.
+
+    The journal is a series of segments in one directory: a snapshot
+    (NNN.snapshot.json, the state after command NNN) and a log (NNN.log)
+    of the commands committed after it. Every record is a 4-byte length and
+    a CRC32 followed by the JSON command, so appending a change costs a few
+    hundred bytes instead of a rewrite of data.json, and a torn tail is
+    detected and dropped on recovery. Once the active log grows past
+    JOURNAL_SEGMENT_BYTES, compact() starts a new segment from a snapshot
+    of the current state and deletes all but the newest
+    JOURNAL_KEEP_SEGMENTS. Appends are fsynced according to
+    persistence.FSYNC_MODE. One process owns a journal directory.
+    """
+
+    def __init__(self, directory=JOURNAL_DIR):
+        self.directory = os.path.abspath(directory)
+        self.seq = 0
+        self._file = None
+        self._path = None
+        self._size = 0
+        self._last_sync = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def needs_compaction(self):
+        return self._size >= JOURNAL_SEGMENT_BYTES
+
+    def recover(self, apply):
+        """
+        Rebuild the latest state from the newest segment, applying each
+        logged command with apply(data, record). Returns the state, or None
+        when the journal is empty. A torn tail is truncated away so new
+        records follow the last intact one; corruption anywhere else raises
+        ValueError and leaves the log untouched.
+        """
+        with self._lock:
+            segments = list_segments(self.directory)
+            if not segments:
+                return None
+            start = segments[-1]
+            snapshot = read_snapshot(self.directory, start)
+            data, self.seq = snapshot["data"], snapshot["seq"]
+            path = os.path.join(self.directory, _segment_name(start) + ".log")
+            valid = 0
+            for valid, record in read_records(path):
+                data = apply(data, record)
+                self.seq = record["seq"]
+            self._open(path, valid)
+            return data
+
+    def quarantine(self):
+        """
+        Rename the newest segment to *.corrupt so the next recover() starts
+        from the one before it. Returns the renamed paths.
+        """
+        with self._lock:
+            segments = list_segments(self.directory)
+            if not segments:
+                return []
+            moved = []
+            suffix = f".corrupt-{int(time.time())}"
+            for name in (".snapshot.json", ".log"):
+                path = os.path.join(self.directory, _segment_name(segments[-1]) + name)
+                if os.path.exists(path):
+                    os.replace(path, path + suffix)
+                    moved.append(path + suffix)
+            return moved
+
+    def _open(self, path, size):
+        if self._file is not None:
+            self._file.close()
+        if os.path.exists(path) and os.path.getsize(path) != size:
+            with open(path, 'r+b') as f:
+                f.truncate(size)  # Drop a torn tail
+        self._file = open(path, 'ab')
+        self._path = path
+        self._size = size
+
+    def append(self, record):
+        """Append one command; returns its sequence number."""
+        with self._lock:
+            if self._file is None:
+                raise RuntimeError("journal has no snapshot yet, call compact() first")
+            self.seq += 1
+            payload = json.dumps({"seq": self.seq, "ts": time.time(), **record}, separators=(',', ':')).encode("utf-8")
+            try:
+                self._file.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)) + payload)
+                self._file.flush()
+            except BaseException:
+                # A torn record would hide every later one from recover()
+                self.seq -= 1
+                self._rollback()
+                raise
+            self._size += RECORD_HEADER.size + len(payload)
+            if FSYNC_MODE == "always" or (FSYNC_MODE == "batched" and time.monotonic() - self._last_sync >= FSYNC_INTERVAL):
+                os.fsync(self._file.fileno())
+                self._last_sync = time.monotonic()
+            metrics.inc("comfort_file_bytes_written_total", RECORD_HEADER.size + len(payload), file="journal")
+            return self.seq
+
+    def _rollback(self):
+        # Caller holds self._lock; cut the log back to its last intact record
+        try:
+            self._file.close()  # Also drops whatever is still buffered
+        except OSError:
+            pass
+        self._file = None
+        self._open(self._path, self._size)
+
+    def compact(self, data):
+        """Start a new segment from a snapshot of data (the state after the last appended command)."""
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            name = os.path.join(self.directory, _segment_name(self.seq))
+            atomic_write_json(name + ".snapshot.json", {"seq": self.seq, "ts": time.time(), "data": data})
+            if self._file is not None:
+                os.fsync(self._file.fileno())
+            self._open(name + ".log", 0)
+            for start in list_segments(self.directory)[:-JOURNAL_KEEP_SEGMENTS]:
+                for suffix in (".snapshot.json", ".log"):
+                    try:
+                        os.unlink(os.path.join(self.directory, _segment_name(start) + suffix))
+                    except OSError:
+                        pass
+
+    def sync(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+                os.fsync(self._file.fileno())
+                self._last_sync = time.monotonic()
+
+    def begin_export(self, data):
+        """
+        Record the digest of the data a checkpoint is about to write to
+        data.json, so a crash before mark_exported() still leaves the new
+        file recognisable as an export.
+        """
+        marker = read_json(os.path.join(self.directory, EXPORT_FILE)) or {}
+        atomic_write_json(os.path.join(self.directory, EXPORT_FILE),
+                          {"mtime_ns": marker.get("mtime_ns"), "pending": export_digest(data)}, durable=False)
+
+    def mark_exported(self, mtime_ns):
+        """Remember the mtime of the data.json a checkpoint just wrote."""
+        atomic_write_json(os.path.join(self.directory, EXPORT_FILE), {"mtime_ns": mtime_ns}, durable=False)
+
+    def is_export(self, mtime_ns, data):
+        """
+        True unless data.json (with this mtime and content) was edited since
+        the last checkpoint: it carries the recorded mtime, or the content a
+        checkpoint began writing. Without any record there is nothing to
+        tell an edit by, so it counts as an export.
+        """
+        marker = read_json(os.path.join(self.directory, EXPORT_FILE))
+        if not marker:
+            return True
+        return mtime_ns == marker.get("mtime_ns") or export_digest(data) == marker.get("pending")
+
+def export_digest(data):
+    return hashlib.sha1(json.dumps(data, sort_keys=True, separators=(',', ':')).encode("utf-8")).hexdigest()
+
+def replay(directory, apply, until=None):
+    """
+    Reconstruct the state as of `until` (a Unix timestamp, default: now)
+    from the kept segments. Returns (data, seq, ts) of the last command
+    applied, or None if the journal does not reach back that far.
+    """
+    until = until if until is not None else time.time()
+    for start in reversed(list_segments(directory)):
+        snapshot = read_snapshot(directory, start)
+        if snapshot["ts"] > until:
+            continue
+        data, seq, ts = snapshot["data"], snapshot["seq"], snapshot["ts"]
+        for _, record in read_records(os.path.join(directory, _segment_name(start) + ".log")):
+            if record["ts"] > until:
+                break
+            data, seq, ts = apply(data, record), record["seq"], record["ts"]
+        return data, seq, ts
+    return None
+
+def iter_commands(directory, since=None, until=None):
+    """Yield the logged commands of all kept segments between two timestamps."""
+    for start in list_segments(directory):
+        for _, record in read_records(os.path.join(directory, _segment_name(start) + ".log")):
+            if (since is None or record["ts"] >= since) and (until is None or record["ts"] <= until):
+                yield record
@@ -0,0 +1,64 @@
+"""
+Replay tool for the state journal.
+
+Reconstructs the sensor/action state at any point in time covered by the
+kept journal segments, or lists the commands logged in a time range.
+
+    python journal_replay.py --at "2025-06-01 21:30"
+    python journal_replay.py --at "2025-06-01 21:30" --output state_2130.json
+    python journal_replay.py --list --since "2025-06-01 21:00" --until "2025-06-01 22:00"
+"""
+import argparse
+import json
+import time
+from datetime import datetime
+from journal import JOURNAL_DIR, list_segments, read_snapshot, replay, iter_commands
+from state import apply_command
+
+def parse_time(value):
+    """Accept a Unix timestamp or an ISO date/time such as 2025-06-01 21:30."""
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.fromisoformat(value).timestamp()
+
+def describe(record):
+    when = datetime.fromtimestamp(record["ts"]).strftime('%Y-%m-%d %H:%M:%S')
+    detail = {key: value for key, value in record.items() if key not in ("seq", "ts", "op", "source")}
+    return f"{record['seq']:>8} {when} {record.get('source') or '-':<9} {record['op']:<15} {json.dumps(detail, separators=(',', ':'))[:120]}"
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", default=JOURNAL_DIR, help="Journal directory")
+    parser.add_argument("--at", help="Point in time to reconstruct (default: now)")
+    parser.add_argument("--output", help="Write the reconstructed state to this file instead of printing it")
+    parser.add_argument("--list", action="store_true", help="List the logged commands instead of replaying them")
+    parser.add_argument("--since", help="Start of the --list range")
+    parser.add_argument("--until", help="End of the --list range")
+    args = parser.parse_args()
+
+    if args.list:
+        for record in iter_commands(args.dir, parse_time(args.since), parse_time(args.until)):
+            print(describe(record))
+        return
+
+    until = parse_time(args.at) if args.at else time.time()
+    result = replay(args.dir, apply_command, until)
+    if result is None:
+        segments = list_segments(args.dir)
+        oldest = datetime.fromtimestamp(read_snapshot(args.dir, segments[0])["ts"]) if segments else None
+        print(f"The journal does not reach back to that time (oldest snapshot: {oldest or 'none'}).")
+        return
+    data, seq, ts = result
+    print(f"State after command {seq} ({datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')})")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(data, f, indent=2)
+        print(f"Wrote {args.output}")
+    else:
+        print(json.dumps(data, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+import metrics
+
+# Configuration
+LLM_BACKEND = os.getenv("COMFORT_LLM_BACKEND", "gemini")  # "gemini" or "fake"
+GEMINI_MODEL = 'gemini-2.0-flash'
+LLM_WORKERS = 4
+LLM_TIMEOUT = 60  # Seconds before a request is reported as timed out and its model call aborted
+LLM_RETRIES = 2  # Extra attempts after a failed call
+LLM_BACKOFF = 1.0  # Seconds before the first retry, doubled on each further one
+
+# --- Model Backends ---
+class GeminiBackend:
+    """
+    Chat backend on google.generativeai, streaming the reply as it arrives.
+    The SDK is imported and configured on the first start_session() call,
+    since importing it takes seconds on the kiosks.
+    """
+
+    def __init__(self, api_key, model_name=GEMINI_MODEL):
+        self.api_key = api_key
+        self.model_name = model_name
+        self._model = None
+        self._lock = threading.Lock()
+
+    @property
+    def model(self):
+        with self._lock:
+            if self._model is None:
+                import google.generativeai as genai
+                genai.configure(api_key=self.api_key)
+                self._model = genai.GenerativeModel(self.model_name)
+            return self._model
+
+    def start_session(self, system_prompt=None):
+        history = [{"role": "user", "parts": [system_prompt]}] if system_prompt else []
+        return self.model.start_chat(history=history)
+
+    def send(self, session, prompt, on_chunk=None, timeout=None):
+        """Send one message; returns (text, response). timeout bounds the call in seconds."""
+        request_options = {"timeout": timeout} if timeout is not None else None
+        response = session.send_message(prompt, stream=True, request_options=request_options)
+        deadline = time.time() + timeout if timeout is not None else None
+        text = ""
+        for chunk in response:
+            if deadline is not None and time.time() > deadline:
+                raise TimeoutError("model reply did not finish in time")
+            text += chunk.text
+            if on_chunk:
+                on_chunk(text)
+        response.resolve()
+        return text.strip(), response
+
+class FakeSession:
+    def __init__(self, history):
+        self.history = history
+
+class FakeBackend:
+    """
+    Local stand-in for tests and demos. responder maps a prompt to the reply
+    text; replies are streamed in chunk_size pieces with delay seconds
+    between them, and the first `failures` calls raise.
+    """
+
+    def __init__(self, responder=None, delay=0.0, chunk_size=16, failures=0):
+        self.responder = responder or (lambda prompt: "This is a fake model response.")
+        self.delay = delay
+        self.chunk_size = chunk_size
+        self.failures = failures
+        self.calls = 0
+
+    def start_session(self, system_prompt=None):
+        return FakeSession([{"role": "user", "parts": [system_prompt]}] if system_prompt else [])
+
+    def send(self, session, prompt, on_chunk=None, timeout=None):
+        self.calls += 1
+        if self.calls <= self.failures:
+            raise RuntimeError("Fake backend failure")
+        reply = self.responder(prompt)
+        text = ""
+        deadline = time.time() + timeout if timeout is not None else None
+        for i in range(0, len(reply), self.chunk_size):
+            time.sleep(self.delay)
+            if deadline is not None and time.time() > deadline:
+                raise TimeoutError("fake reply did not finish in time")
+            text += reply[i:i + self.chunk_size]
+            if on_chunk:
+                on_chunk(text)
+        session.history += [{"role": "user", "parts": [prompt]}, {"role": "model", "parts": [reply]}]
+        return reply.strip(), None
+
+def create_backend(api_key=None):
+    if LLM_BACKEND == "fake":
+        return FakeBackend(delay=0.05)
+    return GeminiBackend(api_key)
+
+# Process-wide backend, so Streamlit reruns do not rebuild it
+_backend = None
+_backend_lock = threading.Lock()
+
+def get_backend(api_key=None):
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = create_backend(api_key)
+        return _backend
+
+class ChatSession:
+    """
+    One conversation of a browser session. The backend session is started
+    on first use, which moves the model client setup from the first page
+    load to the first query (on a pipeline worker). Hold `lock` while using
+    `session`.
+    """
+
+    def __init__(self, backend, system_prompt=None):
+        self.backend = backend
+        self.system_prompt = system_prompt
+        self.lock = threading.Lock()
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = self.backend.start_session(self.system_prompt)
+        return self._session
+
+# --- Request Pipeline ---
+class LLMRequest:
+    """State of one submitted request, updated by the worker that runs it."""
+
+    def __init__(self, timeout):
+        self.id = str(uuid.uuid4())
+        self.status = "pending"  # pending, running, done, failed, expired
+        self.partial = ""
+        self.text = None
+        self.error = None
+        self.attempts = 0
+        self.created = time.time()
+        self.deadline = self.created + timeout
+
+    @property
+    def finished(self):
+        return self.status in ("done", "failed", "expired") or self.timed_out
+
+    @property
+    def timed_out(self):
+        return self.status == "expired" or (self.status in ("pending", "running") and time.time() > self.deadline)
+
+class LLMPipeline:
+    """
+    Runs model calls on a worker pool so the Streamlit script thread never
+    blocks on them. submit() takes a callable job(on_chunk, deadline)
+    returning the reply text; the job must bound its model call by the
+    deadline (a time.time() value). Failed attempts are retried with
+    exponential backoff until the deadline, and streamed partial text is
+    kept on the request for the UI to show while it polls. A request past
+    its deadline ends as "expired" and its late result is discarded.
+    """
+
+    def __init__(self, workers=LLM_WORKERS, timeout=LLM_TIMEOUT, retries=LLM_RETRIES, backoff=LLM_BACKOFF):
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="llm")
+        self._requests = {}
+        self._lock = threading.Lock()
+
+    def submit(self, job):
+        request = LLMRequest(self.timeout)
+        with self._lock:
+            self._requests[request.id] = request
+        self._executor.submit(self._run, request, job)
+        return request
+
+    def get(self, request_id):
+        with self._lock:
+            return self._requests.get(request_id)
+
+    def forget(self, request_id):
+        with self._lock:
+            self._requests.pop(request_id, None)
+
+    def _run(self, request, job):
+        request.status = "running"
+        delay = self.backoff
+        start = time.perf_counter()
+        while True:
+            request.attempts += 1
+            try:
+                text = job(lambda text: setattr(request, "partial", text), request.deadline)
+                if time.time() > request.deadline:
+                    # The user has already been told this request timed out
+                    request.status = "expired"
+                    metrics.observe("comfort_llm_seconds", time.perf_counter() - start, outcome="expired")
+                    return
+                request.text = text
+                request.status = "done"
+                metrics.observe("comfort_llm_seconds", time.perf_counter() - start, outcome="done")
+                return
+            except Exception as e:
+                request.error = e
+                metrics.inc("comfort_llm_errors_total")
+                if time.time() > request.deadline:
+                    request.status = "expired"
+                    metrics.observe("comfort_llm_seconds", time.perf_counter() - start, outcome="expired")
+                    return
+                if request.attempts > self.retries or time.time() + delay > request.deadline:
+                    request.status = "failed"
+                    metrics.observe("comfort_llm_seconds", time.perf_counter() - start, outcome="failed")
+                    return
+                time.sleep(delay)
+                delay *= 2
+
+# Process-wide pipeline shared by every session
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+def get_pipeline():
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            _pipeline = LLMPipeline()
+        return _pipeline
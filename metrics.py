@@ -0,0 +1,258 @@
+"""
+Low-overhead metrics for the background loops, exposed in the Prometheus
+text format.
+
+Set COMFORT_METRICS_PORT to serve /metrics (and /profile) on localhost.
+Set COMFORT_PROFILE_INTERVAL to a number of seconds (e.g. 0.01) to run a
+sampling profiler whose collapsed stacks are served on /profile, ready for
+flamegraph.pl or speedscope.
+"""
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# Configuration
+METRICS_PORT = os.getenv("COMFORT_METRICS_PORT")
+METRICS_HOST = os.getenv("COMFORT_METRICS_HOST", "127.0.0.1")
+PROFILE_INTERVAL = float(os.getenv("COMFORT_PROFILE_INTERVAL", "0") or 0)
+PROFILE_MAX_DEPTH = 40  # Frames kept per sampled stack
+# Histogram bucket upper bounds in seconds (or tokens for *_tokens metrics)
+TIME_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000, 32000)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.sum += value
+        self.count += 1
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+class Registry:
+    """
+    Counters, gauges and histograms keyed by name and label values. Every
+    update is a dict lookup and an addition under one lock, cheap enough for
+    the evaluator tick and every file write.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._help = {}
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(TOKEN_BUCKETS if name.endswith("_tokens") else TIME_BUCKETS)
+            histogram.observe(value)
+
+    @contextmanager
+    def timed(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format."""
+        with self._lock:
+            counters = sorted(self._counters.items())
+            gauges = sorted(self._gauges.items())
+            histograms = sorted((key, (h.buckets, list(h.counts), h.sum, h.count)) for key, h in self._histograms.items())
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if name in self._help:
+                    lines.append(f"# HELP {name} {self._help[name]}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for (name, labels), value in gauges:
+            header(name, "gauge")
+            lines.append(f"{name}{_labels(labels)} {value}")
+        for (name, labels), (buckets, counts, total, count) in histograms:
+            header(name, "histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{name}_bucket{_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{_labels(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{_labels(labels)} {total}")
+            lines.append(f"{name}_count{_labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+def _labels(labels):
+    if not labels:
+        return ""
+    escaped = (f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for key, value in labels)
+    return "{" + ",".join(escaped) + "}"
+
+# Process-wide registry
+registry = Registry()
+inc = registry.inc
+set_gauge = registry.set
+observe = registry.observe
+timed = registry.timed
+
+registry.describe("comfort_app_run_seconds", "Duration of one Streamlit script run, the first of the process labelled cold")
+registry.describe("comfort_app_runs_over_budget_total", "Script runs of app.py slower than their cold start or rerun budget")
+registry.describe("comfort_app_run_over_budget_seconds", "Duration of the last script run that exceeded its budget")
+registry.describe("comfort_eval_seconds", "Time spent evaluating the rules for one evaluator tick")
+registry.describe("comfort_lock_wait_seconds", "Time spent waiting to acquire a file lock")
+registry.describe("comfort_file_bytes_written_total", "Bytes written by atomic JSON writes")
+registry.describe("comfort_file_writes_total", "Atomic JSON writes")
+registry.describe("comfort_mqtt_publishes_total", "MQTT publishes by result")
+registry.describe("comfort_mqtt_publish_seconds", "Time spent in one publish_changes call")
+registry.describe("comfort_action_publish_latency_seconds", "Time from an action state change to its MQTT publish")
+registry.describe("comfort_scheduler_lag_seconds", "Delay between a scheduled action's due time and its execution")
+registry.describe("comfort_llm_seconds", "Model request latency by outcome")
+registry.describe("comfort_llm_prompt_tokens", "Prompt tokens per model turn")
+
+_app_runs = {"count": 0}
+
+def record_app_run(elapsed):
+    """Record one script run of app.py. Returns (elapsed, True for the process's first run)."""
+    with registry._lock:
+        _app_runs["count"] += 1
+        cold = _app_runs["count"] == 1
+    observe("comfort_app_run_seconds", elapsed, run="cold" if cold else "rerun")
+    return elapsed, cold
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all threads every `interval` seconds and counts
+    them as collapsed stacks ("outer;inner;leaf count" lines).
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = Counter()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(1)
+        self._thread = None
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            stacks = []
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                parts = []
+                while frame is not None and len(parts) < PROFILE_MAX_DEPTH:
+                    code = frame.f_code
+                    parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                parts.append(names.get(ident, str(ident)))
+                stacks.append(";".join(reversed(parts)))
+            with self._lock:
+                self.samples.update(stacks)
+
+    def collapsed(self):
+        with self._lock:
+            return "".join(f"{stack} {count}\n" for stack, count in self.samples.most_common())
+
+_profiler = None
+
+def start_profiler(interval=None):
+    global _profiler
+    if _profiler is None:
+        _profiler = SamplingProfiler(interval or PROFILE_INTERVAL or 0.01)
+    _profiler.start()
+    return _profiler
+
+def stop_profiler():
+    if _profiler is not None:
+        _profiler.stop()
+
+def _make_server():
+    # http.server is only imported when the endpoint is enabled
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body, content_type = registry.render(), "text/plain; version=0.0.4"
+            elif self.path == "/profile":
+                body = _profiler.collapsed() if _profiler is not None else "# profiler not running, set COMFORT_PROFILE_INTERVAL\n"
+                content_type = "text/plain"
+            else:
+                self.send_error(404)
+                return
+            payload = body.encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, format, *args):
+            pass  # Keep scrapes out of the console
+
+    return ThreadingHTTPServer((METRICS_HOST, int(METRICS_PORT)), MetricsHandler)
+
+_server = None
+_server_lock = threading.Lock()
+
+def start_from_env():
+    """Start the metrics endpoint and the profiler if configured; safe to call on every rerun."""
+    global _server
+    with _server_lock:
+        if PROFILE_INTERVAL > 0:
+            start_profiler(PROFILE_INTERVAL)
+        if _server is None and METRICS_PORT:
+            try:
+                _server = _make_server()
+            except OSError as e:
+                print(f"Could not start metrics endpoint on port {METRICS_PORT}: {e}")
+                _server = False  # Do not retry on every rerun
+                return None
+            threading.Thread(target=_server.serve_forever, name="metrics", daemon=True).start()
+        return _server or None
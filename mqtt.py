@@ -1,9 +1,13 @@
-import paho.mqtt.client as mqtt
 import json
+import math
 import time
 import os
 import re
-from filelock import FileLock
+import threading
+from persistence import atomic_write_json
+from state import get_store, DEFAULT_ROOM
+from events import bus
+import metrics
 
 # --- MQTT Broker Configuration ---
 MQTT_BROKER = "172.16.16.54"
@@ -11,31 +15,49 @@ MQTT_PORT = 1883
 MQTT_CLIENT_ID = "paho_continuous_publisher"
 MQTT_CONNECTION_TIMEOUT = 60
 MAX_RETRIES = 3
-PUBLISH_INTERVAL = 1  # 1 second interval
+PUBLISH_INTERVAL = 1  # Max seconds between connection checks while idle
+COALESCE_WINDOW = 0.05  # Quiet period that ends a burst of action changes
+COALESCE_MAX_DELAY = 0.25  # Publish a continuous burst at least this often
+
+# --- Sensor Ingestion Configuration ---
+# Devices publish to sensors/<device_id>/<metric> for the default room or
+# sensors/<room_id>/<device_id>/<metric> for any other room
+SENSOR_TOPIC_PREFIX = "sensors"
+SENSOR_METRICS = ("temperature", "humidity", "light_level")
+INGEST_FLUSH_INTERVAL = 0.5  # Seconds between applying buffered readings to the state
+SENSOR_STALE_AFTER = 120  # Ignore devices that have not reported for this long
 
 # --- File Configuration ---
-JSON_FILE = os.path.join(os.path.dirname(__file__), "data.json")
-JSON_LOCK_FILE = JSON_FILE + '.lock'
 MQTT_STATUS_FILE = os.path.join(os.path.dirname(__file__), "mqtt_status.json")
-MQTT_STATUS_LOCK_FILE = MQTT_STATUS_FILE + '.lock'
 
 # --- Utility Functions ---
+_last_status = {"message": None}
+
 def update_status(message):
+    """Write mqtt_status.json, skipping the write if the status did not change."""
+    if message == _last_status["message"]:
+        return
+    _last_status["message"] = message
+    bus.publish("mqtt_status", message)
     try:
-        with FileLock(MQTT_STATUS_LOCK_FILE):
-            with open(MQTT_STATUS_FILE, 'w') as f:
-                json.dump({
-                    "status": f"{message} | Last update: {time.strftime('%H:%M:%S')}"
-                }, f)
+        atomic_write_json(MQTT_STATUS_FILE, {
+            "status": f"{message} | Last update: {time.strftime('%H:%M:%S')}"
+        }, durable=False)  # Single writer, lock-free readers
     except Exception as e:
         print(f"Error updating MQTT status: {e}")
 
 def load_actions():
+    """
+    Return {topic: payload} for every actuator. The default room publishes to
+    the bare action keys ("fan"), other rooms to "<room_id>/<key>".
+    """
     try:
-        with FileLock(JSON_LOCK_FILE):
-            with open(JSON_FILE, 'r') as f:
-                data = json.load(f)
-                return data.get("action", {})
+        _, data = get_store().snapshot()
+        actions = dict(data.get("action", {}))
+        for room_id, room in data.get("rooms", {}).items():
+            for key, payload in room.get("action", {}).items():
+                actions[f"{room_id}/{key}"] = payload
+        return actions
     except Exception as e:
         update_status(f"Error loading actions: {str(e)}")
         return {}
@@ -43,44 +65,206 @@ def load_actions():
 def validate_topic(topic):
     return bool(re.match(r"^[a-zA-Z0-9_\/-]+$", topic))
 
+# --- Action Publisher ---
+class ActionPublisher:
+    """
+    Publishes action values to their MQTT topics, sending only the keys whose
+    value differs from what was last published successfully.
+    """
+
+    def __init__(self, client):
+        self.client = client
+        self.published = {}
+
+    def reset(self):
+        """Forget what was published so the next publish sends every topic."""
+        self.published = {}
+
+    def publish_changes(self, actions):
+        published_count = 0
+        start = time.perf_counter()
+        for topic, payload in actions.items():
+            if self.published.get(topic, object()) == payload:
+                continue
+            if not validate_topic(topic):
+                update_status(f"Invalid topic: {topic}")
+                continue
+            try:
+                result = self.client.publish(topic, json.dumps(payload), qos=1)
+                if result.rc == 0:
+                    self.published[topic] = payload
+                    published_count += 1
+                    metrics.inc("comfort_mqtt_publishes_total", result="ok")
+                else:
+                    metrics.inc("comfort_mqtt_publishes_total", result="failed")
+                    update_status(f"Publish failed for {topic}: Code {result.rc}")
+            except Exception as e:
+                metrics.inc("comfort_mqtt_publishes_total", result="error")
+                update_status(f"Publish error on {topic}: {str(e)}")
+        metrics.observe("comfort_mqtt_publish_seconds", time.perf_counter() - start)
+        return published_count
+
+# --- Sensor Ingestion ---
+class SensorIngestor:
+    """
+    Collects sensor telemetry from MQTT and feeds it into the state store.
+
+    Incoming messages only overwrite the latest reading of their device in an
+    in-memory buffer; flush() periodically averages the fresh readings of all
+    devices per metric and merges the result into the "sensors" section in a
+    single store update. A burst of hundreds of messages per second therefore
+    costs one dict assignment each and at most one state change per flush.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.Lock()
+        self._readings = {}  # (device_id, metric) -> (value, received_at)
+        self.received = 0
+        self.rejected = 0
+        self.flushes = 0
+
+    def ingest(self, topic, payload, received_at=None):
+        """Buffer one telemetry message. Returns False if it was rejected."""
+        parts = topic.split('/')
+        if len(parts) == 3:
+            parts.insert(1, DEFAULT_ROOM)
+        if len(parts) != 4 or parts[0] != SENSOR_TOPIC_PREFIX or parts[3] not in SENSOR_METRICS:
+            self.rejected += 1
+            return False
+        room_id, device_id, metric = parts[1:]
+        try:
+            value = json.loads(payload)
+            if isinstance(value, dict):
+                value = value["value"]
+            value = float(value)
+            if not math.isfinite(value):
+                raise ValueError("non-finite reading")  # NaN would poison the average
+        except (ValueError, KeyError, TypeError):
+            self.rejected += 1
+            return False
+        with self._lock:
+            self._readings[(room_id, device_id, metric)] = (value, received_at or time.time())
+            self.received += 1
+        return True
+
+    def on_message(self, client, userdata, message):
+        self.ingest(message.topic, message.payload)
+
+    def aggregate(self, now=None):
+        """Average the fresh readings of every device per room and metric."""
+        now = now or time.time()
+        totals = {}
+        with self._lock:
+            for key, (value, received_at) in list(self._readings.items()):
+                if now - received_at > SENSOR_STALE_AFTER:
+                    del self._readings[key]
+                    continue
+                room_id, _, metric = key
+                total, count = totals.get((room_id, metric), (0.0, 0))
+                totals[(room_id, metric)] = (total + value, count + 1)
+        sensors_by_room = {}
+        for (room_id, metric), (total, count) in totals.items():
+            sensors_by_room.setdefault(room_id, {})[metric] = total / count
+        return sensors_by_room
+
+    def flush(self, now=None):
+        """Merge the aggregated readings into the state of rooms whose values changed."""
+        _, data = self.store.snapshot()
+        rooms = data.get("rooms", {})
+        changed = {}
+        for room_id, sensors in self.aggregate(now).items():
+            current = data if room_id == DEFAULT_ROOM else rooms.get(room_id, {})
+            if any(current.get("sensors", {}).get(metric) != value for metric, value in sensors.items()):
+                changed[room_id] = sensors
+        if not changed:
+            return False
+        if DEFAULT_ROOM in changed:
+            self.store.merge("sensors", changed.pop(DEFAULT_ROOM), source="sensors")
+        # Known rooms first, so a new room the store rejects does not hold them back
+        known = {room_id: sensors for room_id, sensors in changed.items() if room_id in rooms}
+        if known:
+            self.store.merge_rooms("sensors", known, source="sensors")
+        if len(known) < len(changed):
+            self.store.merge_rooms("sensors", {room_id: sensors for room_id, sensors in changed.items() if room_id not in rooms}, source="sensors")
+        self.flushes += 1
+        return True
+
+    def run(self, stop_event):
+        while not stop_event.wait(INGEST_FLUSH_INTERVAL):
+            try:
+                self.flush()
+            except Exception as e:
+                update_status(f"Sensor ingestion error: {str(e)}")
+
+def wait_for_burst_end(store, version):
+    """
+    Wait until the store has been quiet for COALESCE_WINDOW seconds, so a
+    slider drag that produces many updates results in a single publish.
+    Gives up after COALESCE_MAX_DELAY to bound the added latency.
+    """
+    deadline = time.monotonic() + COALESCE_MAX_DELAY
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return version
+        new_version = store.wait_for_change(version, min(COALESCE_WINDOW, remaining))
+        if new_version == version:
+            return version
+        version = new_version
+
+def create_client():
+    """Create the paho client; paho is imported here so importing this module stays cheap."""
+    import paho.mqtt.client as mqtt
+    return mqtt.Client(client_id=MQTT_CLIENT_ID)
+
 # --- MQTT Publisher Background Task (Like update.py) ---
-def mqtt_background_task():
+def mqtt_background_task(stop_event=None):
     """
     Background task function that runs continuously, just like background_task in update.py
-    This function will be called by app.py as a background thread
+    This function will be called by app.py as a background thread.
+    It is woken by the state store as soon as the actions change.
     """
+    stop_event = stop_event or threading.Event()
     client = None
-    last_actions = {}
-    
+    store = get_store()
+    publisher = None
+    ingest_stop = threading.Event()  # Ends the ingestor with this task, however the task exits
+
     # Initialize MQTT client
     try:
-        client = mqtt.Client(client_id=MQTT_CLIENT_ID)
-        
+        client = create_client()
+        publisher = ActionPublisher(client)
+        ingestor = SensorIngestor(store)
+
         # Set up callbacks
         def on_connect(client, userdata, flags, rc):
+            # The broker or devices may have lost state, send everything again
+            publisher.reset()
+            # Both topic shapes; ingest() rejects anything else under the prefix
+            client.subscribe(f"{SENSOR_TOPIC_PREFIX}/#", qos=0)
             update_status(f"Connected: Code {rc}")
-        
+
         def on_disconnect(client, userdata, rc):
             update_status(f"Disconnected: Code {rc}")
-        
-        def on_publish(client, userdata, mid):
-            pass  # Status handled in main loop
-        
+
         client.on_connect = on_connect
         client.on_disconnect = on_disconnect
-        client.on_publish = on_publish
-        
-        # Initial connection
+        client.on_message = ingestor.on_message
+
+        # Initial connection; the ingestor only starts once it succeeded, so
+        # a supervisor retrying a dead broker does not pile up threads
         client.connect(MQTT_BROKER, MQTT_PORT, MQTT_CONNECTION_TIMEOUT)
         client.loop_start()
+        threading.Thread(target=ingestor.run, args=(ingest_stop,), name="ingestor", daemon=True).start()
         update_status("MQTT Publisher initialized")
-        
+
     except Exception as e:
         update_status(f"Initial connection failed: {str(e)}")
         return
-    
-    # Main publishing loop (similar to update.py's while loop)
-    while True:
+
+    version = None
+    while not stop_event.is_set():
         try:
             # Check connection
             if not client.is_connected():
@@ -90,47 +274,29 @@ def mqtt_background_task():
                     time.sleep(1)
                 except Exception as e:
                     update_status(f"Reconnection failed: {str(e)}")
-                    time.sleep(PUBLISH_INTERVAL)
+                    stop_event.wait(PUBLISH_INTERVAL)
                     continue
-            
-            # Load current actions
-            current_actions = load_actions()
-            
-            # Only publish if actions changed
-            if current_actions != last_actions:
-                published_count = 0
-                for topic, payload in current_actions.items():
-                    if validate_topic(topic):
-                        try:
-                            json_payload = json.dumps(payload)
-                            result = client.publish(topic, json_payload, qos=1)
-                            if result.rc == 0:
-                                published_count += 1
-                            else:
-                                update_status(f"Publish failed for {topic}: Code {result.rc}")
-                        except Exception as e:
-                            update_status(f"Publish error on {topic}: {str(e)}")
-                    else:
-                        update_status(f"Invalid topic: {topic}")
-                
+
+            # Publish whatever changed since the last successful publish
+            if store.version != version or not publisher.published:
+                version = wait_for_burst_end(store, store.version)
+                published_count = publisher.publish_changes(load_actions())
                 if published_count > 0:
+                    metrics.observe("comfort_action_publish_latency_seconds", time.time() - store.committed_at)
                     update_status(f"Published {published_count} topics successfully")
-                
-                last_actions = current_actions.copy()
-            else:
-                # Update status even when no changes (to show it's alive)
-                update_status("MQTT Publisher running - No changes to publish")
-            
-            time.sleep(PUBLISH_INTERVAL)
-            
+
+            # Sleep until the actions change again or it is time to check the connection
+            store.wait_for_change(version, PUBLISH_INTERVAL)
+
         except KeyboardInterrupt:
             update_status("Publisher stopped by user")
             break
         except Exception as e:
             update_status(f"Critical error: {str(e)}")
-            time.sleep(5)
-    
+            stop_event.wait(5)
+
     # Cleanup
+    ingest_stop.set()
     if client:
         client.loop_stop()
         client.disconnect()
@@ -138,4 +304,4 @@ def mqtt_background_task():
 
 # --- For standalone execution (optional) ---
 if __name__ == "__main__":
-    mqtt_background_task()
\ No newline at end of file
+    mqtt_background_task()
@@ -0,0 +1,163 @@
+import json
+import os
+import threading
+import time
+import uuid
+import filelock
+import metrics
+
+# Configuration
+# FSYNC_MODE applies to the frequently rewritten state files (data.json,
+# status files) and to journal appends: "always" fsyncs every write,
+# "batched" fsyncs at most once per FSYNC_INTERVAL seconds, "never" leaves
+# flushing to the OS. Outside "always" these files are renamed before their
+# data is on disk, so a power loss may leave them empty; the journal
+# recovers data.json. Rarely written files (rules, config, schedules) are
+# always fsynced before the rename.
+FSYNC_MODE = os.getenv("COMFORT_FSYNC_MODE", "batched")
+FSYNC_INTERVAL = float(os.getenv("COMFORT_FSYNC_INTERVAL", "5"))
+
+class FileLock(filelock.FileLock):
+    """filelock.FileLock that records how long each acquire waited, per lock file."""
+
+    def acquire(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().acquire(*args, **kwargs)
+        finally:
+            metrics.observe("comfort_lock_wait_seconds", time.perf_counter() - start, lock=os.path.basename(self.lock_file))
+
+_generations = {}
+_pending_sync = set()
+_sync_state = {"last": 0.0}
+_sync_lock = threading.Lock()
+
+def _fsync_path(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _fsync_dir(path):
+    # Makes the rename itself durable; not supported on every platform
+    try:
+        _fsync_path(os.path.dirname(os.path.abspath(path)))
+    except OSError:
+        pass
+
+def sync_pending():
+    """Flush every file written since the last batched fsync."""
+    with _sync_lock:
+        paths = list(_pending_sync)
+        _pending_sync.clear()
+        _sync_state["last"] = time.monotonic()
+    for path in paths:
+        try:
+            _fsync_path(path)
+            _fsync_dir(path)
+        except OSError:
+            pass  # File was replaced or removed since, nothing left to flush
+
+_snapshots = {}  # abspath -> ((mtime_ns, size, inode), parsed content)
+
+def read_json(path, default=None):
+    """
+    Read a JSON file written with atomic_write_json, without taking its lock.
+
+    Writers replace the file by rename, so a reader always opens one complete
+    version and never needs to exclude them. The parsed content is cached
+    per file and handed out again until the file's mtime, size or inode
+    changes, so callers must treat it as read-only. Returns default when the
+    file is missing; a file that does not parse (e.g. being edited by hand)
+    yields the last good snapshot.
+    """
+    key = os.path.abspath(path)
+    try:
+        st = os.stat(key)
+    except OSError:
+        return default
+    stamp = (st.st_mtime_ns, st.st_size, st.st_ino)
+    cached = _snapshots.get(key)
+    if cached is not None and cached[0] == stamp:
+        return cached[1]
+    try:
+        # Stat first, read second: the content is at least as new as the stamp
+        with open(key, 'r') as f:
+            data = json.load(f)
+    except (OSError, ValueError):
+        return cached[1] if cached is not None else default
+    _snapshots[key] = (stamp, data)
+    return data
+
+def _create_temp(path):
+    """
+    Create a temporary file next to path. It is created with mode 0666 so
+    the umask applies as for any new file, then given the permissions of
+    the file it will replace, if that exists.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    while True:
+        tmp_path = os.path.join(directory, f"{os.path.basename(path)}.{uuid.uuid4().hex[:8]}.tmp")
+        try:
+            fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+            break
+        except FileExistsError:
+            continue
+    try:
+        os.chmod(tmp_path, os.stat(path).st_mode & 0o7777)
+    except FileNotFoundError:
+        pass
+    except OSError:
+        os.close(fd)
+        os.unlink(tmp_path)
+        raise
+    return fd, tmp_path
+
+def atomic_write_json(path, data, indent=None, lock_file=None, durable=True):
+    """
+    Write JSON to path without ever exposing a missing or partial file.
+
+    The data goes to a temporary file in the same directory, which is then
+    renamed over path, so readers always see either the old or the new
+    content. A durable write fsyncs the data before the rename; hot files
+    pass durable=False and are fsynced according to FSYNC_MODE instead.
+    Returns the new generation number of path.
+    """
+    if lock_file:
+        with FileLock(lock_file):
+            return atomic_write_json(path, data, indent, durable=durable)
+
+    fd, tmp_path = _create_temp(path)
+    sync_now = durable or FSYNC_MODE == "always"
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f, indent=indent)
+            written = f.tell()
+            f.flush()
+            if sync_now:
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+    if sync_now:
+        _fsync_dir(path)
+    elif FSYNC_MODE == "batched":
+        with _sync_lock:
+            _pending_sync.add(path)
+            due = time.monotonic() - _sync_state["last"] >= FSYNC_INTERVAL
+        if due:
+            sync_pending()
+
+    name = os.path.basename(path)
+    metrics.inc("comfort_file_writes_total", file=name)
+    metrics.inc("comfort_file_bytes_written_total", written, file=name)
+    key = os.path.abspath(path)
+    with _sync_lock:
+        _generations[key] = _generations.get(key, 0) + 1
+        return _generations[key]
@@ -0,0 +1,134 @@
+import json
+import re
+import metrics
+
+# Configuration
+HISTORY_TOKEN_BUDGET = 6000  # Approximate tokens of chat history kept besides the system prompt
+SUMMARY_MAX_QUERIES = 10  # Dropped user queries listed in the history summary
+CHARS_PER_TOKEN = 4  # Rough estimate used when the API does not report usage
+SUMMARY_PREFIX = "Earlier conversation (summarized):"
+# Queries about the past get a sensor history summary added to the prompt
+HISTORY_QUERY_PATTERN = re.compile(
+    r"\b(?:last (?:night|hour|day|week)|yesterday|earlier|ago|history|trend|was it|was the|average|highest|lowest|since)\b",
+    re.IGNORECASE
+)
+
+def estimate_tokens(text):
+    return max(1, len(text) // CHARS_PER_TOKEN)
+
+def _content_role(content):
+    return content["role"] if isinstance(content, dict) else content.role
+
+def _content_text(content):
+    parts = content["parts"] if isinstance(content, dict) else content.parts
+    return " ".join(part if isinstance(part, str) else getattr(part, "text", "") for part in parts)
+
+def wants_history(user_input):
+    return bool(HISTORY_QUERY_PATTERN.search(user_input))
+
+def _state_lines(current_time, data, active_rule_set, scheduled_actions):
+    sensors, action = data['sensors'], data['action']
+    scheduled = [{"what": sa.get("description"), "when": sa.get("schedule_time_str") or f"in {int(sa.get('delay_seconds') or 0)}s"}
+                 for sa in scheduled_actions]
+    return {
+        "Current Time": current_time,
+        "Sensors": f"Light: {sensors['light_level']}, Temp: {sensors['temperature']}°C, Humidity: {sensors['humidity']}%",
+        "Actions": f"Fan: {action['fan'].capitalize()}, Speed: {action['fan_speed']}%, Light: {action['light'].capitalize()}, Brightness: {action['set_brightness']}%",
+        "Active Rule Set": 'Fixed Rules' if active_rule_set == 'fixed_rule' else 'User Preferences',
+        "Scheduled actions": json.dumps(scheduled, separators=(',', ':')),
+    }
+
+class PromptContext:
+    """
+    Builds the per-turn prompt for one chat session.
+
+    Static material (predefined actions and the scheduling note) is sent on
+    the first turn only, and later turns carry just the state lines that
+    changed since the previous turn. Before each turn the chat history is
+    trimmed to HISTORY_TOKEN_BUDGET, with the dropped turns replaced by a
+    short summary; trimming also resets the baseline so the next prompt
+    restates the full state. Prompt token counts are recorded per turn.
+    """
+
+    def __init__(self, predefined_actions, token_budget=HISTORY_TOKEN_BUDGET):
+        self.predefined_actions = predefined_actions
+        self.token_budget = token_budget
+        self.static_sent = False
+        self.last_state = None
+        self.turn_tokens = []
+        self.omitted_messages = 0
+        self.omitted_queries = []
+
+    def reset(self):
+        self.static_sent = False
+        self.last_state = None
+
+    def build(self, user_input, current_time, data, active_rule_set, scheduled_actions, history=None):
+        state = _state_lines(current_time, data, active_rule_set, scheduled_actions)
+        if self.last_state is None:
+            lines = ["Current system state:"] + [f"- {key}: {value}" for key, value in state.items()]
+        else:
+            changed = {key: value for key, value in state.items() if self.last_state.get(key) != value}
+            lines = ["State changes since last message:"] + [f"- {key}: {value}" for key, value in changed.items()]
+            if not changed:
+                lines = ["System state unchanged since last message."]
+        self.last_state = state
+        if history:
+            lines.append("Sensor history:")
+            lines.extend(f"- {line}" for line in history.splitlines())
+
+        lines.append(f"User query: {user_input}")
+        if not self.static_sent:
+            lines.append(f"Predefined actions: {json.dumps(self.predefined_actions, separators=(',', ':'))}")
+            lines.append("Note: For scheduling, use predefined actions or specify actions like fan, light, fan_speed, or brightness with delay (seconds) or specific time (HH:MM).")
+            self.static_sent = True
+        return "\n".join(lines)
+
+    def trim_history(self, chat_session):
+        """Cap the chat history to the token budget. Returns True if anything was dropped."""
+        history = list(chat_session.history)
+        if len(history) <= 1:
+            return False
+        system, turns = history[0], history[1:]
+        if turns and _content_text(turns[0]).startswith(SUMMARY_PREFIX):
+            turns = turns[1:]  # Rebuilt below from omitted_messages/omitted_queries
+        kept, used = [], 0
+        for content in reversed(turns):
+            tokens = estimate_tokens(_content_text(content))
+            if used + tokens > self.token_budget:
+                break
+            kept.append(content)
+            used += tokens
+        kept.reverse()
+        # Never start the kept window with a model reply
+        while kept and _content_role(kept[0]) != "user":
+            kept.pop(0)
+        dropped = turns[:len(turns) - len(kept)]
+        if not dropped:
+            return False
+
+        for content in dropped:
+            if _content_role(content) == "user":
+                text = _content_text(content)
+                query = next((line[len("User query: "):] for line in text.splitlines() if line.startswith("User query: ")), text)
+                self.omitted_queries.append(query[:80])
+        self.omitted_messages += len(dropped)
+        self.omitted_queries = self.omitted_queries[-SUMMARY_MAX_QUERIES:]
+        summary = f"{SUMMARY_PREFIX} {self.omitted_messages} messages omitted."
+        if self.omitted_queries:
+            summary += " Earlier user requests: " + "; ".join(self.omitted_queries)
+        chat_session.history = [system, {"role": "user", "parts": [summary]}] + kept
+        self.reset()
+        return True
+
+    def record_usage(self, prompt, response):
+        """Record the prompt token count of a turn, preferring the API's own figure."""
+        usage = getattr(response, "usage_metadata", None)
+        tokens = getattr(usage, "prompt_token_count", None) or estimate_tokens(prompt)
+        self.turn_tokens.append(tokens)
+        metrics.observe("comfort_llm_prompt_tokens", tokens)
+        return tokens
+
+    @property
+    def last_prompt_tokens(self):
+        return self.turn_tokens[-1] if self.turn_tokens else None
@@ -0,0 +1,192 @@
+import re
+from datetime import datetime, timedelta
+from persistence import read_json
+
+# Configuration
+SUN_TABLE_FILE = 'sun_times.json'  # Optional override of DEFAULT_SUN_TABLE, same shape
+# Typical local sunrise/sunset per month (Dhaka); good to a few minutes
+DEFAULT_SUN_TABLE = {
+    "1": {"sunrise": "06:40", "sunset": "17:30"},
+    "2": {"sunrise": "06:30", "sunset": "17:50"},
+    "3": {"sunrise": "06:05", "sunset": "18:05"},
+    "4": {"sunrise": "05:40", "sunset": "18:15"},
+    "5": {"sunrise": "05:15", "sunset": "18:30"},
+    "6": {"sunrise": "05:10", "sunset": "18:45"},
+    "7": {"sunrise": "05:20", "sunset": "18:45"},
+    "8": {"sunrise": "05:30", "sunset": "18:30"},
+    "9": {"sunrise": "05:45", "sunset": "18:00"},
+    "10": {"sunrise": "05:55", "sunset": "17:35"},
+    "11": {"sunrise": "06:10", "sunset": "17:15"},
+    "12": {"sunrise": "06:30", "sunset": "17:15"},
+}
+KINDS = ("daily", "weekdays", "sunrise", "sunset", "cron")
+CRON_SEARCH_DAYS = 366 * 8  # Long enough for "29 Feb on a Monday"
+
+# Scheduling clauses understood in chat input; the delay and a lone time
+# schedule one run, the others a recurrence
+DELAY_PATTERN = re.compile(r"\b(?:in|after)\s+(\d+)\s*(seconds?|secs?|mins?|minutes?|hours?)\b")
+TIME_PATTERN = re.compile(r"\bat\s+(\d{1,2}:\d{2})\b")
+DAILY_PATTERN = re.compile(r"\b(?:every\s*day|daily|every\s+(?:night|morning|evening))\b")
+WEEKDAYS_PATTERN = re.compile(r"\b(?:every\s+weekday|on\s+weekdays|weekdays)\b")
+SUN_PATTERN = re.compile(r"\b(?:(\d+)\s*(mins?|minutes?|hours?)\s+(before|after)\s+|at\s+|every\s+)(sunrise|sunset)\b")
+CRON_PATTERN = re.compile(r"\bcron\s*:?\s*((?:\S+\s+){4}\S+)")
+
+# Recurrence specs are plain dicts stored in scheduler.json:
+#   {"kind": "daily", "time": "23:00"}
+#   {"kind": "weekdays", "time": "07:00"}            Monday to Friday
+#   {"kind": "sunset", "offset": -30}                minutes relative to the table
+#   {"kind": "cron", "expr": "0 23 * * 1-5"}         minute hour day month weekday
+
+def parse_hhmm(text):
+    return datetime.strptime(text, '%H:%M').time()
+
+def parse_delay(match):
+    """Seconds of a DELAY_PATTERN match."""
+    unit = match.group(2)
+    return int(match.group(1)) * (3600 if unit.startswith("hour") else 60 if unit.startswith("min") else 1)
+
+def parse_time(match):
+    """The HH:MM of a TIME_PATTERN match, or None if it is not a valid time of day."""
+    time_str = match.group(1).zfill(5)
+    try:
+        parse_hhmm(time_str)
+    except ValueError:
+        return None
+    return time_str
+
+def next_time_of_day(time_str, now=None):
+    """The next datetime at HH:MM after now, today or tomorrow."""
+    now = now or datetime.now()
+    candidate = datetime.combine(now.date(), parse_hhmm(time_str))
+    if candidate <= now:
+        candidate += timedelta(days=1)
+    return candidate
+
+def _cron_field(field, low, high):
+    values = set()
+    for part in field.split(','):
+        base, _, step = part.partition('/')
+        if base == '*':
+            start, end = low, high
+        elif '-' in base:
+            start, end = (int(bound) for bound in base.split('-', 1))
+        else:
+            start = end = int(base)
+            if step:
+                end = high
+        step = int(step) if step else 1
+        if start < low or end > high or start > end or step < 1:
+            raise ValueError(f"cron field '{field}' is outside {low}-{high}")
+        values.update(range(start, end + 1, step))
+    return values
+
+def parse_cron(expr):
+    """Return (minutes, hours, days, months, weekdays, day_any, weekday_any); weekdays are Monday=0."""
+    fields = expr.split()
+    if len(fields) != 5:
+        raise ValueError("cron expressions have five fields: minute hour day month weekday")
+    minutes = _cron_field(fields[0], 0, 59)
+    hours = _cron_field(fields[1], 0, 23)
+    days = _cron_field(fields[2], 1, 31)
+    months = _cron_field(fields[3], 1, 12)
+    # Cron counts weekdays from Sunday=0 (7 is Sunday too), datetime from Monday=0
+    weekdays = {(day - 1) % 7 for day in _cron_field(fields[4], 0, 7)}
+    return sorted(minutes), sorted(hours), days, months, weekdays, fields[2] == '*', fields[4] == '*'
+
+def sun_time(kind, day):
+    """Sunrise or sunset on a date, from sun_times.json or the built-in table."""
+    table = read_json(SUN_TABLE_FILE) or DEFAULT_SUN_TABLE
+    return parse_hhmm(table[str(day.month)][kind])
+
+def validate(spec):
+    """Raise ValueError if a recurrence spec is incomplete or malformed."""
+    kind = spec.get("kind")
+    if kind not in KINDS:
+        raise ValueError(f"Unknown recurrence '{kind}', expected one of {', '.join(KINDS)}")
+    if kind in ("daily", "weekdays"):
+        parse_hhmm(spec.get("time") or "")
+    elif kind == "cron":
+        parse_cron(spec.get("expr") or "")
+    else:
+        int(spec.get("offset", 0))
+
+def next_fire(spec, after):
+    """The first datetime (local, naive) strictly after `after` at which spec fires."""
+    kind = spec["kind"]
+    if kind == "daily":
+        return next_time_of_day(spec["time"], after)
+    if kind == "weekdays":
+        candidate = next_time_of_day(spec["time"], after)
+        while candidate.weekday() >= 5:
+            candidate += timedelta(days=1)
+        return candidate
+    if kind in ("sunrise", "sunset"):
+        offset = timedelta(minutes=int(spec.get("offset", 0)))
+        for days in range(3):
+            day = after.date() + timedelta(days=days)
+            candidate = datetime.combine(day, sun_time(kind, day)) + offset
+            if candidate > after:
+                return candidate
+    if kind == "cron":
+        minutes, hours, days, months, weekdays, day_any, weekday_any = parse_cron(spec["expr"])
+        day = after.date()
+        for _ in range(CRON_SEARCH_DAYS):
+            day_match = day.day in days
+            weekday_match = day.weekday() in weekdays
+            # As in cron, a restricted day and weekday match either of them
+            matches = day_match or weekday_match if not (day_any or weekday_any) else day_match and weekday_match
+            if day.month in months and matches:
+                for hour in hours:
+                    if day == after.date() and hour < after.hour:
+                        continue
+                    for minute in minutes:
+                        candidate = datetime(day.year, day.month, day.day, hour, minute)
+                        if candidate > after:
+                            return candidate
+            day += timedelta(days=1)
+    raise ValueError(f"Recurrence {spec} never fires")
+
+def next_fire_time(spec, after=None):
+    """Like next_fire(), on Unix timestamps; after defaults to now."""
+    after = datetime.fromtimestamp(after) if after is not None else datetime.now()
+    return next_fire(spec, after.replace(microsecond=0)).timestamp()
+
+def describe(spec):
+    kind = spec["kind"]
+    if kind == "daily":
+        return f"every day at {spec['time']}"
+    if kind == "weekdays":
+        return f"weekdays at {spec['time']}"
+    if kind == "cron":
+        return f"cron {spec['expr']}"
+    offset = int(spec.get("offset", 0))
+    if offset == 0:
+        return f"every day at {kind}"
+    return f"every day {abs(offset)} min {'before' if offset < 0 else 'after'} {kind}"
+
+def parse_recurrence(text):
+    """Return the recurrence spec of a chat request such as "every day at 23:00", or None."""
+    text = text.lower()
+    match = CRON_PATTERN.search(text)
+    if match:
+        spec = {"kind": "cron", "expr": match.group(1)}
+        try:
+            validate(spec)
+        except ValueError:
+            return None
+        return spec
+    match = SUN_PATTERN.search(text)
+    if match and (DAILY_PATTERN.search(text) or match.group(0).startswith("every")):
+        offset = 0
+        if match.group(1):
+            offset = int(match.group(1)) * (60 if match.group(2).startswith("hour") else 1)
+            offset = -offset if match.group(3) == "before" else offset
+        return {"kind": match.group(4), "offset": offset}
+    time_match = TIME_PATTERN.search(text)
+    time_str = parse_time(time_match) if time_match else None
+    if time_str:
+        if WEEKDAYS_PATTERN.search(text):
+            return {"kind": "weekdays", "time": time_str}
+        if DAILY_PATTERN.search(text):
+            return {"kind": "daily", "time": time_str}
+    return None
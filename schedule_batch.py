@@ -0,0 +1,215 @@
+import csv
+import io
+import json
+import math
+import time
+import uuid
+from datetime import datetime
+from recurrence import validate, next_fire_time, next_time_of_day
+
+# Configuration
+CONFLICT_WINDOW = 60  # Seconds within which two schedules of one actuator must agree
+CONFLICT_HORIZON = 7 * 24 * 3600  # How far ahead recurring schedules are checked
+CONFLICT_MAX_OCCURRENCES = 50  # Occurrences checked per recurring schedule
+# Action types and the actuator they drive
+ACTUATORS = {"fan": "fan", "fan_speed": "fan", "light": "light", "brightness": "light"}
+SWITCH_TYPES = ("fan", "light")
+IMPORT_COLUMNS = "action, delay_seconds | time | repeat (daily, weekdays, sunrise, sunset, cron), offset, cron, rule_set"
+
+def make_entry(actions, rule_set, action_id, now, scheduled_time, schedule_time_str=None, recurrence=None, description=None):
+    """A scheduler entry as stored in scheduler.json."""
+    if recurrence:
+        schedule_type = "Recurring"
+    else:
+        schedule_type = "Specific Time" if schedule_time_str else "Delay (seconds)"
+    return {
+        "id": action_id,
+        "actions": actions,
+        "delay_seconds": scheduled_time - now,
+        "scheduled_time": scheduled_time,
+        "description": description,
+        "schedule_type": schedule_type,
+        "schedule_time_str": schedule_time_str,
+        "recurrence": recurrence,
+        "rule_set": rule_set
+    }
+
+def parse_import(text, fmt):
+    """Rows of an uploaded schedule file; fmt is "csv" or "json" (a list of objects)."""
+    if fmt == "json":
+        rows = json.loads(text)
+        if isinstance(rows, dict):
+            rows = rows.get("scheduled_actions", [rows])
+        if not isinstance(rows, list) or not all(isinstance(row, dict) for row in rows):
+            raise ValueError("JSON imports must be a list of objects")
+        return rows
+    if fmt == "csv":
+        return list(csv.DictReader(io.StringIO(text)))
+    raise ValueError(f"Unsupported import format '{fmt}', use CSV or JSON")
+
+def parse_actions(value, predefined_actions):
+    """
+    Actions of one import row: a predefined action name, a JSON list of
+    actions, or "fan=on; fan_speed=50". Values are checked and normalized
+    to the strings the rest of the system uses.
+    """
+    if isinstance(value, str):
+        names = {name.lower(): actions for name, actions in predefined_actions.items()}
+        if value.lower() in names:
+            value = names[value.lower()]
+        elif value.startswith(("[", "{")):
+            value = json.loads(value)
+        else:
+            value = [dict(zip(("action_type", "action_value"), (part.strip() for part in pair.split("=", 1))))
+                     for pair in value.split(";") if pair.strip()]
+    if isinstance(value, dict):
+        value = [value]
+    if not value:
+        raise ValueError("no actions given")
+    actions = []
+    for action in value:
+        atype, aval = action.get("action_type"), str(action.get("action_value", "")).strip().lower()
+        if atype not in ACTUATORS:
+            raise ValueError(f"unknown action type '{atype}'")
+        if atype in SWITCH_TYPES:
+            if aval not in ("on", "off"):
+                raise ValueError(f"{atype} must be on or off, not '{aval}'")
+        elif not aval.isdigit() or int(aval) > 100:
+            raise ValueError(f"{atype} must be a level from 0 to 100, not '{aval}'")
+        actions.append({"action_type": atype, "action_value": aval})
+    return actions
+
+def build_entry(row, rule_set, predefined_actions, now=None):
+    """Validate one import row and return its scheduler entry (without a description). Raises ValueError."""
+    now = now if now is not None else time.time()
+    row = {key.strip().lower(): value.strip() if isinstance(value, str) else value
+           for key, value in row.items() if key and value not in (None, "")}
+    actions = parse_actions(row.get("actions", row.get("action")), predefined_actions)
+    schedule_time_str = None
+    recurrence = None
+    if "repeat" in row:
+        kind = str(row["repeat"]).lower()
+        recurrence = {"kind": kind}
+        if kind in ("daily", "weekdays"):
+            recurrence["time"] = schedule_time_str = str(row.get("time", ""))
+        elif kind == "cron":
+            recurrence["expr"] = str(row.get("cron", ""))
+        else:
+            recurrence["offset"] = int(row.get("offset", 0))
+        validate(recurrence)
+        scheduled_time = next_fire_time(recurrence, now)
+    elif "time" in row:
+        schedule_time_str = str(row["time"])
+        scheduled_time = next_time_of_day(schedule_time_str, datetime.fromtimestamp(now)).timestamp()
+    elif "delay_seconds" in row:
+        delay = float(row["delay_seconds"])
+        if not math.isfinite(delay) or delay <= 0:
+            raise ValueError("delay_seconds must be a positive number")
+        scheduled_time = now + delay
+    else:
+        raise ValueError("each row needs delay_seconds, time or repeat")
+    return make_entry(actions, row.get("rule_set", rule_set), str(row.get("id") or uuid.uuid4()), now,
+                      scheduled_time, schedule_time_str, recurrence)
+
+def actuator_states(actions):
+    """
+    The effective state each action list leaves every actuator in, as
+    apply_scheduled_action applies it: {actuator: {"on": bool, "level": int}}
+    with only the keys the actions determine. Turning off implies level 0 and
+    a level above 0 implies on.
+    """
+    states = {}
+    for action in actions:
+        atype, aval = action.get("action_type"), str(action.get("action_value", ""))
+        actuator = ACTUATORS.get(atype)
+        if actuator is None:
+            continue
+        state = states.setdefault(actuator, {})
+        if atype in SWITCH_TYPES:
+            state["on"] = aval == "on"
+            if aval != "on":
+                state["level"] = 0
+        elif aval.isdigit():
+            state["level"] = int(aval)
+            if int(aval) > 0:
+                state["on"] = True
+    return states
+
+def _disagree(state, other):
+    return any(state[key] != other[key] for key in state.keys() & other.keys())
+
+def occurrences(entry, horizon_end):
+    """Fire times of an entry up to horizon_end (at most CONFLICT_MAX_OCCURRENCES)."""
+    times = [entry["scheduled_time"]]
+    if entry.get("recurrence"):
+        while len(times) < CONFLICT_MAX_OCCURRENCES:
+            next_time = next_fire_time(entry["recurrence"], times[-1])
+            if next_time > horizon_end:
+                break
+            times.append(next_time)
+    return times
+
+def find_conflicts(new_entries, pending=(), now=None, unchecked=None):
+    """
+    Find schedules that drive the same actuator to different effective
+    states (see actuator_states) within CONFLICT_WINDOW seconds of each
+    other, checking recurring schedules over the next CONFLICT_HORIZON. Only
+    keys both schedules set are compared. Only pairs involving a new entry
+    are reported, as {"id", "other_id", "actuator", "time"} where "id" is
+    the new entry to blame: the later row of two new ones. Pending entries
+    whose occurrences cannot be computed (e.g. a stored recurrence that no
+    longer parses) are left out and, if unchecked is a list, appended to it
+    as (id, error).
+    """
+    now = now if now is not None else time.time()
+    horizon_end = now + CONFLICT_HORIZON
+    rank = {entry["id"]: -1 for entry in pending}
+    rank.update({entry["id"]: i for i, entry in enumerate(new_entries)})
+    events = {}
+    for entry in list(pending) + list(new_entries):
+        try:
+            fire_times = occurrences(entry, horizon_end)
+        except (KeyError, TypeError, ValueError) as e:
+            if rank[entry["id"]] >= 0:
+                raise  # New entries were validated by build_entry
+            if unchecked is not None:
+                unchecked.append((entry["id"], str(e)))
+            continue
+        values = actuator_states(entry.get("actions", []))
+        for fire_time in fire_times:
+            for actuator, value in values.items():
+                events.setdefault(actuator, []).append((fire_time, entry["id"], value))
+    conflicts = []
+    seen = set()
+    for actuator, timeline in events.items():
+        timeline.sort(key=lambda event: event[0])
+        for i, (fire_time, entry_id, value) in enumerate(timeline):
+            for other_time, other_id, other_value in timeline[i + 1:]:
+                if other_time - fire_time > CONFLICT_WINDOW:
+                    break
+                if other_id == entry_id or not _disagree(value, other_value) or max(rank[entry_id], rank[other_id]) < 0:
+                    continue
+                blamed, other = (entry_id, other_id) if rank[entry_id] > rank[other_id] else (other_id, entry_id)
+                if (blamed, other, actuator) not in seen:
+                    seen.add((blamed, other, actuator))
+                    conflicts.append({"id": blamed, "other_id": other, "actuator": actuator, "time": min(fire_time, other_time)})
+    return conflicts
+
+def reject_conflicting(new_entries, conflicts):
+    """
+    Drop the new entries that conflict with a pending schedule or with an
+    earlier row that is itself accepted, in row order, so a row is never
+    rejected because of one that was never scheduled. Returns (accepted,
+    the conflicts that caused a rejection).
+    """
+    blamed = {}
+    for conflict in conflicts:
+        blamed.setdefault(conflict["id"], []).append(conflict)
+    rejected = set()
+    counted = []
+    for entry in new_entries:
+        own = [conflict for conflict in blamed.get(entry["id"], []) if conflict["other_id"] not in rejected]
+        if own:
+            rejected.add(entry["id"])
+            counted.extend(own)
+    return [entry for entry in new_entries if entry["id"] not in rejected], counted
@@ -0,0 +1,187 @@
+import copy
+import heapq
+import os
+import threading
+import time
+from persistence import atomic_write_json, read_json
+from recurrence import next_fire_time
+import metrics
+
+# Configuration
+SCHEDULER_FILE = 'scheduler.json'
+SCHEDULER_LOCK_FILE = SCHEDULER_FILE + '.lock'
+# What to do with actions that came due while the process was down:
+# "run" fires all of them on startup, "skip" drops the ones overdue by more
+# than CATCH_UP_GRACE seconds. A recurring entry fires at most once to catch
+# up (or, when skipped, moves on to its next occurrence).
+CATCH_UP_POLICY = os.getenv("COMFORT_SCHEDULE_CATCH_UP", "run")
+CATCH_UP_GRACE = 300
+
+class Scheduler:
+    """
+    Single-thread scheduler for timed actions.
+
+    Pending entries (the same dicts stored in scheduler.json) live in a
+    min-heap keyed on scheduled_time. Cancelling removes the entry from the
+    id map and leaves a stale heap node behind that is skipped when it
+    reaches the top, so add and cancel stay O(log n) and only one thread
+    waits for the next due time. scheduler.json is rewritten whenever the
+    set of pending entries changes, and is read back on start.
+
+    An entry with a "recurrence" spec (see recurrence.py) is re-armed at
+    its next occurrence as it fires, so it stays one heap node however many
+    times it repeats.
+
+    Delivery is at-least-once: an entry stays in scheduler.json, with the
+    scheduled_time it fired for, until its handler returns, so an action
+    interrupted by a crash is caught up on the next start.
+    """
+
+    def __init__(self, handler, path=SCHEDULER_FILE, lock_file=SCHEDULER_LOCK_FILE):
+        self.handler = handler
+        self.path = path
+        self.lock_file = lock_file
+        self._cond = threading.Condition()
+        self._heap = []
+        self._entries = {}
+        self._in_flight = {}  # id -> entry whose handler is running, kept on disk until it returns
+        self._seq = 0
+        self._thread = None
+        self._stop_event = None
+
+    def _push(self, entry):
+        self._seq += 1
+        self._entries[entry["id"]] = (self._seq, entry)
+        heapq.heappush(self._heap, (entry["scheduled_time"], self._seq, entry["id"]))
+
+    def _rearm(self, entry, after):
+        # Caller holds self._cond; returns whether a recurring entry was pushed again
+        if not entry.get("recurrence"):
+            return False
+        try:
+            self._push({**entry, "scheduled_time": next_fire_time(entry["recurrence"], after)})
+        except (KeyError, ValueError) as e:
+            print(f"Dropping recurring action {entry.get('id')} with a bad recurrence: {e}")
+            return False
+        return True
+
+    def _save(self):
+        # Caller holds self._cond
+        entries = {entry["id"]: entry for entry in self.list()}
+        entries.update(self._in_flight)  # The occurrence being handled, not its re-armed successor
+        saved = sorted(entries.values(), key=lambda e: e["scheduled_time"])
+        atomic_write_json(self.path, {"scheduled_actions": saved}, indent=2, lock_file=self.lock_file)
+
+    def rehydrate(self):
+        """Load pending entries from scheduler.json, applying the catch-up policy."""
+        saved = copy.deepcopy((read_json(self.path) or {}).get('scheduled_actions', []))
+        now = time.time()
+        changed = False
+        with self._cond:
+            for entry in saved:
+                overdue = now - entry.get("scheduled_time", now)
+                if CATCH_UP_POLICY == "skip" and overdue > CATCH_UP_GRACE:
+                    print(f"Skipping missed scheduled action: {entry.get('description')}")
+                    if self._rearm(entry, now):
+                        changed = True
+                    continue
+                self._push(entry)
+            if changed or len(self._entries) != len(saved):
+                self._save()
+            self._cond.notify()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        # Each thread gets its own stop event, so a thread that outlived
+        # stop() (stuck in a handler) still exits instead of running on
+        # next to its replacement
+        self._stop_event = threading.Event()
+        self.rehydrate()
+        self._thread = threading.Thread(target=self._run, args=(self._stop_event,), daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5):
+        """Stop the scheduler thread; pending entries stay in scheduler.json."""
+        with self._cond:
+            if self._stop_event is not None:
+                self._stop_event.set()
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        self._thread = None
+        with self._cond:
+            self._entries.clear()
+            self._heap.clear()
+
+    @property
+    def alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def add(self, entry):
+        with self._cond:
+            self._push(entry)
+            self._save()
+            self._cond.notify()
+
+    def add_many(self, entries):
+        """Add several entries with a single rewrite of scheduler.json."""
+        with self._cond:
+            for entry in entries:
+                self._push(entry)
+            self._save()
+            self._cond.notify()
+
+    def cancel(self, action_id):
+        """Cancel a pending entry by id. Returns the entry, or None if unknown."""
+        with self._cond:
+            item = self._entries.pop(action_id, None)
+            if item is None:
+                return None
+            self._save()
+            return item[1]
+
+    def cancel_all(self):
+        with self._cond:
+            self._entries.clear()
+            self._heap.clear()
+            self._save()
+
+    def list(self):
+        """Return pending entries ordered by scheduled_time."""
+        with self._cond:
+            return sorted((entry for _, entry in self._entries.values()), key=lambda e: e["scheduled_time"])
+
+    def _next_due(self):
+        # Pop stale heap nodes left behind by cancel() or by re-adding an id
+        while self._heap and self._entries.get(self._heap[0][2], (None,))[0] != self._heap[0][1]:
+            heapq.heappop(self._heap)
+        if not self._heap:
+            return None, None
+        scheduled_time, _, action_id = self._heap[0]
+        delay = scheduled_time - time.time()
+        if delay > 0:
+            return None, delay
+        heapq.heappop(self._heap)
+        return self._entries.pop(action_id)[1], 0
+
+    def _run(self, stop_event):
+        while True:
+            with self._cond:
+                if stop_event.is_set():
+                    return
+                entry, delay = self._next_due()
+                if entry is None:
+                    self._cond.wait(delay)
+                    continue
+                # scheduler.json keeps the entry as it is until the handler returns
+                self._in_flight[entry["id"]] = entry
+                self._rearm(entry, max(time.time(), entry["scheduled_time"]))
+            metrics.observe("comfort_scheduler_lag_seconds", max(0.0, time.time() - entry["scheduled_time"]))
+            try:
+                self.handler(entry)
+            except Exception as e:
+                print(f"Error executing scheduled action {entry.get('id')}: {e}")
+            with self._cond:
+                self._in_flight.pop(entry["id"], None)
+                self._save()
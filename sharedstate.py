@@ -0,0 +1,171 @@
+import fcntl
+import math
+import mmap
+import os
+import struct
+import time
+from contextlib import contextmanager
+
+# Configuration
+# The region path comes from COMFORT_SHARED_STATE (state.SHARED_STATE_FILE),
+# e.g. /dev/shm/comfort.state; this module is only imported when it is set
+SHARED_POLL_INTERVAL = 0.02  # Seconds between checks for changes made by other processes
+ROOM_SLOTS = 16  # Rooms that fit in the region; slot 0 is the default room
+ROOM_ID_BYTES = 32  # Longest room id, UTF-8 encoded
+
+MAGIC = b"CAIS"
+LAYOUT_VERSION = 1
+# magic, layout version, sequence counter, room count, writer pid, updated at
+HEADER = struct.Struct("<4sIQIId")
+SEQ = struct.Struct("<Q")
+SEQ_OFFSET = 8
+# room id (UTF-8, NUL padded), temperature, humidity, light_level,
+# fan, fan_speed, light, set_brightness
+ROOM = struct.Struct(f"<{ROOM_ID_BYTES}s3d4i")
+REGION_SIZE = HEADER.size + ROOM_SLOTS * ROOM.size
+
+SENSOR_FIELDS = ("temperature", "humidity", "light_level")
+ACTION_FIELDS = ("fan", "fan_speed", "light", "set_brightness")
+SWITCH_FIELDS = ("fan", "light")  # Stored as 1/0 for "on"/"off"
+MISSING = -1  # Actuator field not set; sensors use NaN
+
+def _encode_action(key, value):
+    if value is None:
+        return MISSING
+    if key in SWITCH_FIELDS:
+        return 1 if value == "on" else 0
+    return int(value)
+
+def check_rooms(room_ids):
+    """Raise ValueError unless the rooms fit in the region."""
+    room_ids = list(room_ids)
+    if len(room_ids) > ROOM_SLOTS:
+        raise ValueError(f"{len(room_ids)} rooms do not fit in the shared state region, at most {ROOM_SLOTS} do")
+    for room_id in room_ids:
+        if len(room_id.encode("utf-8")) > ROOM_ID_BYTES:
+            raise ValueError(f"Room id '{room_id}' is longer than {ROOM_ID_BYTES} bytes")
+
+def encode_rooms(rooms):
+    """
+    Pack rooms ({room_id: {"sensors", "action"}}) into region slots. Raises
+    ValueError unless every room and actuator value fits the layout.
+    """
+    check_rooms(rooms)
+    slots = bytearray(len(rooms) * ROOM.size)
+    for i, (room_id, room) in enumerate(rooms.items()):
+        sensors, action = room.get("sensors", {}), room.get("action", {})
+        try:
+            ROOM.pack_into(
+                slots, i * ROOM.size, room_id.encode("utf-8"),
+                *(float(sensors[key]) if isinstance(sensors.get(key), (int, float)) else math.nan for key in SENSOR_FIELDS),
+                *(_encode_action(key, action.get(key)) for key in ACTION_FIELDS)
+            )
+        except (ValueError, TypeError, struct.error) as e:
+            raise ValueError(f"Room '{room_id}' does not fit the shared state region: {e}") from e
+    return bytes(slots)
+
+def _decode_action(key, value):
+    if key in SWITCH_FIELDS:
+        return "on" if value == 1 else "off"
+    return value
+
+class SharedState:
+    """
+    Fixed-layout state region in a memory-mapped file, shared by processes.
+
+    The region holds the sensor values and actuator states of up to
+    ROOM_SLOTS rooms behind a seqlock: a writer makes the sequence counter
+    odd, updates the fields in place and makes it even again, and a reader
+    unpacks the fields straight from the mapping and retries if the counter
+    was odd or moved meanwhile. Readers therefore never block or parse
+    JSON. Writers from different processes serialize on flock(); each write
+    replaces the rooms it is given.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        with self.locked():
+            if os.fstat(self._fd).st_size < REGION_SIZE:
+                os.ftruncate(self._fd, REGION_SIZE)
+            self._map = mmap.mmap(self._fd, REGION_SIZE)
+            magic, layout = struct.unpack_from("<4sI", self._map, 0)
+            if magic != MAGIC:
+                HEADER.pack_into(self._map, 0, MAGIC, LAYOUT_VERSION, 0, 0, 0, 0.0)
+            elif layout != LAYOUT_VERSION:
+                raise ValueError(f"{path} has layout version {layout}, expected {LAYOUT_VERSION}")
+
+    @contextmanager
+    def locked(self):
+        """Hold the writer lock; readers are not affected."""
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    @property
+    def seq(self):
+        """The sequence counter: 0 for a region nobody has written yet, even when stable."""
+        return SEQ.unpack_from(self._map, SEQ_OFFSET)[0]
+
+    def read(self):
+        """Return (seq, {room_id: {"sensors": {...}, "action": {...}}}) of one consistent version."""
+        while True:
+            before = self.seq
+            if before & 1:
+                time.sleep(0)  # A writer is mid-update
+                continue
+            _, _, _, room_count, _, _ = HEADER.unpack_from(self._map, 0)
+            slots = [ROOM.unpack_from(self._map, HEADER.size + i * ROOM.size) for i in range(min(room_count, ROOM_SLOTS))]
+            if self.seq == before:
+                break
+        rooms = {}
+        for name, *values in slots:
+            sensors = {key: value for key, value in zip(SENSOR_FIELDS, values[:3]) if not math.isnan(value)}
+            action = {key: _decode_action(key, value) for key, value in zip(ACTION_FIELDS, values[3:]) if value != MISSING}
+            rooms[name.rstrip(b"\0").decode("utf-8")] = {"sensors": sensors, "action": action}
+        return before, rooms
+
+    def write(self, rooms):
+        """
+        Replace the region's rooms ({room_id: {"sensors", "action"}}, the
+        default room first). The caller must hold locked(). Raises ValueError,
+        leaving the region untouched, if the rooms do not fit (see
+        encode_rooms). Returns the new sequence number.
+        """
+        slots = encode_rooms(rooms)
+        seq = self.seq
+        SEQ.pack_into(self._map, SEQ_OFFSET, seq + 1)
+        try:
+            self._map[HEADER.size:HEADER.size + len(slots)] = slots
+            HEADER.pack_into(self._map, 0, MAGIC, LAYOUT_VERSION, seq + 1, len(rooms), os.getpid(), time.time())
+        finally:
+            # An odd counter would keep every reader spinning
+            SEQ.pack_into(self._map, SEQ_OFFSET, seq + 2)
+        return seq + 2
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+def state_rooms(data, default_room):
+    """The fixed-layout part of a store state, as rooms for SharedState.write()."""
+    rooms = {default_room: {"sensors": data.get("sensors", {}), "action": data.get("action", {})}}
+    for room_id, room in data.get("rooms", {}).items():
+        rooms[room_id] = {"sensors": room.get("sensors", {}), "action": room.get("action", {})}
+    return rooms
+
+def merge_rooms_into(data, rooms, default_room):
+    """Return data with the sensors and actions of rooms read from the region merged in."""
+    data = dict(data)
+    for room_id, room in rooms.items():
+        if room_id == default_room:
+            target = data
+        else:
+            data["rooms"] = dict(data.get("rooms", {}))
+            target = data["rooms"][room_id] = dict(data["rooms"].get(room_id, {}))
+        for section in ("sensors", "action"):
+            if room[section] or section in target:
+                target[section] = {**target.get(section, {}), **room[section]}
+    return data
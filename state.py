@@ -0,0 +1,307 @@
+import atexit
+import copy
+import os
+import threading
+import time
+from persistence import atomic_write_json, read_json, sync_pending, FileLock
+from journal import Journal, JOURNAL_DIR
+
+# Configuration
+DATA_FILE = 'data.json'
+# The top-level "sensors"/"action" sections belong to this room; any other
+# room lives under data["rooms"][room_id] with the same two sections.
+DEFAULT_ROOM = 'default'
+CHECKPOINT_INTERVAL = 5  # Seconds between write-behind checkpoints of data.json
+# With a shared state region, only the owner process journals and exports
+# data.json; set to 0 for evaluator/publisher processes started on their own.
+STATE_OWNER = os.getenv("COMFORT_STATE_OWNER", "1") != "0"
+# Path of the shared state region; sharedstate (which needs fcntl, missing
+# on Windows) is only imported once a region is in use.
+SHARED_STATE_FILE = os.getenv("COMFORT_SHARED_STATE")
+
+def get_default_data():
+    return {
+        "sensors": {"light_level": 80, "temperature": 32, "humidity": 50},
+        "action": {"fan": "on", "fan_speed": 100, "light": "off", "set_brightness": 0}
+    }
+
+def apply_command(data, record):
+    """
+    Return the state after one journaled command. Commands other than
+    update/merge/merge_rooms (e.g. "schedule") are audit records and leave
+    the state unchanged.
+    """
+    op = record.get("op")
+    if op == "update":
+        return copy.deepcopy(record["data"])
+    if op == "merge":
+        data = dict(data)
+        data[record["section"]] = {**data.get(record["section"], {}), **copy.deepcopy(record["values"])}
+    elif op == "merge_rooms":
+        data = dict(data)
+        rooms = dict(data.get('rooms', {}))
+        for room_id, values in record["values"].items():
+            room = dict(rooms.get(room_id, {}))
+            room[record["section"]] = {**room.get(record["section"], {}), **copy.deepcopy(values)}
+            rooms[room_id] = room
+        data['rooms'] = rooms
+    return data
+
+class StateStore:
+    """
+    In-process owner of the sensor/action state shared by the UI, the rule
+    evaluator and the MQTT publisher.
+
+    Every update replaces the state with a private copy and bumps a version
+    number, so snapshot() can hand out the current dict without copying or
+    locking on the read side; callers must treat snapshots as read-only.
+    data.json is only a write-behind checkpoint, flushed every
+    CHECKPOINT_INTERVAL seconds and on interpreter exit.
+
+    With a Journal, every change is also appended to it as a command
+    tagged with its source ("ui", "chat", "schedule", "rules", "sensors")
+    before it becomes visible, and the state is recovered from the journal
+    on startup, so a crash between checkpoints loses nothing and data.json
+    becomes an export. An edit of data.json made while the process was
+    down is recognised by its mtime and content and applied on top.
+
+    With a SharedState region, every commit also writes the sensors and
+    actions into it, and changes other processes wrote there are merged in
+    (tagged "shared") before the next commit, snapshot or wake-up, so the
+    UI, evaluator and publisher can run as separate processes.
+    """
+
+    def __init__(self, path=DATA_FILE, checkpoint_interval=CHECKPOINT_INTERVAL, journal=None, shared=None):
+        self.path = os.path.abspath(path)  # Checkpoints must not follow a later chdir
+        self.lock_file = path + '.lock'
+        self.checkpoint_interval = checkpoint_interval
+        self._cond = threading.Condition()
+        self._data = None
+        self._version = 0
+        self.committed_at = time.time()  # When the current version was committed
+        self._saved_version = 0
+        self._disk_mtime = None
+        self._checkpointer = None
+        self.journal = journal
+        self.shared = shared
+        self._shared_seq = None
+        self._load()
+
+    def _load(self):
+        recovered = None
+        if self.journal is not None:
+            try:
+                recovered = self.journal.recover(apply_command)
+            except Exception as e:
+                # Never compact over a journal we could not read: that would
+                # overwrite its history. Keep the segment and refuse to start.
+                moved = self.journal.quarantine()
+                raise RuntimeError(
+                    f"Could not recover the state journal in {self.journal.directory}: {e}. "
+                    f"Moved {', '.join(moved) or 'nothing'} aside; restart to recover from the previous segment."
+                ) from e
+        try:
+            self._disk_mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            pass
+        data = read_json(self.path) if recovered is None else None
+        with self._cond:
+            if recovered is not None:
+                self._data = recovered
+                self._version += 1  # May be newer than data.json, export it on the next checkpoint
+            elif data is None:
+                self._data = get_default_data()
+                self._version += 1  # Not on disk yet, the next checkpoint creates it
+            else:
+                self._data = data
+                self._saved_version = self._version
+            if self.journal is not None and recovered is None:
+                self.journal.compact(self._data)
+            if self.shared is not None:
+                from sharedstate import state_rooms
+                with self.shared.locked():
+                    if self.shared.seq == 0:
+                        self._shared_seq = self.shared.write(state_rooms(self._data, DEFAULT_ROOM))
+                    else:
+                        self._import_shared()
+        # With a journal, data.json is an export: only an edit made while the
+        # process was down (neither the mtime nor the content a checkpoint
+        # wrote) is applied on top of the recovered state
+        if recovered is not None and self._disk_mtime is not None:
+            edited = read_json(self.path)
+            if edited is not None and not self.journal.is_export(self._disk_mtime, edited):
+                self._saved_version = self.update(edited, source="data.json")
+                self.journal.mark_exported(self._disk_mtime)
+
+    @property
+    def version(self):
+        return self._version
+
+    def snapshot(self):
+        """Return (version, data) for the current state. Do not mutate data."""
+        with self._cond:
+            if self.shared is not None:
+                self._import_shared()
+            return self._version, self._data
+
+    def load(self):
+        """Return a private, mutable copy of the current state."""
+        return copy.deepcopy(self.snapshot()[1])
+
+    def _commit(self, record, source=None):
+        # Caller holds self._cond
+        if self.shared is None:
+            return self._apply(record, source)
+        from sharedstate import state_rooms
+        with self.shared.locked():
+            self._import_shared()
+            data = apply_command(self._data, record)
+            self._check_rooms(data)
+            version = self._apply(record, source, data)
+            self._shared_seq = self.shared.write(state_rooms(self._data, DEFAULT_ROOM))
+            return version
+
+    def _check_rooms(self, data):
+        # Reject a state the shared region cannot hold before anything is journaled
+        from sharedstate import encode_rooms, state_rooms
+        encode_rooms(state_rooms(data, DEFAULT_ROOM))
+
+    def _import_shared(self):
+        # Caller holds self._cond; a cheap counter read unless another process wrote
+        if self.shared.seq == self._shared_seq:
+            return
+        from sharedstate import merge_rooms_into
+        self._shared_seq, rooms = self.shared.read()
+        data = merge_rooms_into(self._data, rooms, DEFAULT_ROOM)
+        if data != self._data:
+            self._apply({"op": "update", "data": data}, "shared")
+
+    def _apply(self, record, source, data=None):
+        # Caller holds self._cond; journal first, then publish the new state
+        data = apply_command(self._data, record) if data is None else data
+        if self.journal is not None:
+            try:
+                self.journal.append({**record, "source": source})
+                if self.journal.needs_compaction:
+                    self.journal.compact(data)
+            except Exception as e:
+                print(f"Error writing the state journal: {e}")
+        self._data = data
+        self._version += 1
+        self.committed_at = time.time()
+        self._cond.notify_all()
+        return self._version
+
+    def update(self, data, source=None):
+        """Replace the state and wake everyone waiting for a change."""
+        with self._cond:
+            return self._commit({"op": "update", "data": data}, source)
+
+    def merge(self, section, values, source=None):
+        """
+        Atomically merge values into one top-level section (e.g. "sensors")
+        without overwriting concurrent updates to the other sections.
+        """
+        with self._cond:
+            return self._commit({"op": "merge", "section": section, "values": values}, source)
+
+    def merge_rooms(self, section, values_by_room, source=None):
+        """Like merge(), for the same section of several rooms under "rooms"."""
+        with self._cond:
+            return self._commit({"op": "merge_rooms", "section": section, "values": values_by_room}, source)
+
+    def log_command(self, op, source=None, **payload):
+        """Journal a command that does not change the state itself, such as a new schedule."""
+        if self.journal is None:
+            return None
+        with self._cond:
+            try:
+                return self.journal.append({"op": op, "source": source, **payload})
+            except Exception as e:
+                print(f"Error writing the state journal: {e}")
+                return None
+
+    def wait_for_change(self, version, timeout=None):
+        """Block until the version moves past the given one or the timeout expires."""
+        with self._cond:
+            if self.shared is None:
+                self._cond.wait_for(lambda: self._version != version, timeout)
+                return self._version
+            # Other processes cannot notify the condition, poll the region too
+            from sharedstate import SHARED_POLL_INTERVAL
+            deadline = time.monotonic() + timeout if timeout is not None else None
+            while True:
+                self._import_shared()
+                remaining = deadline - time.monotonic() if deadline is not None else SHARED_POLL_INTERVAL
+                if self._version != version or remaining <= 0:
+                    return self._version
+                self._cond.wait(min(remaining, SHARED_POLL_INTERVAL))
+
+    def checkpoint(self):
+        """Write the state to data.json if it changed since the last checkpoint."""
+        version, data = self.snapshot()
+        if version == self._saved_version:
+            return False
+        if self.journal is not None:
+            self.journal.begin_export(data)
+        with FileLock(self.lock_file):
+            atomic_write_json(self.path, data, indent=2, durable=False)
+            self._disk_mtime = os.stat(self.path).st_mtime_ns
+        if self.journal is not None:
+            self.journal.mark_exported(self._disk_mtime)
+        self._saved_version = version
+        return True
+
+    def reload_if_changed(self):
+        """Pick up edits made to data.json outside this process."""
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return False
+        if mtime == self._disk_mtime:
+            return False
+        data = read_json(self.path)
+        if data is None:
+            return False
+        self._disk_mtime = mtime
+        self._saved_version = self.update(data, source="data.json")
+        if self.journal is not None:
+            self.journal.mark_exported(mtime)
+        return True
+
+    def start_checkpointer(self):
+        if self._checkpointer is not None:
+            return
+        self._checkpointer = threading.Thread(target=self._checkpoint_loop, daemon=True)
+        self._checkpointer.start()
+        atexit.register(self.checkpoint)
+
+    def _checkpoint_loop(self):
+        while True:
+            time.sleep(self.checkpoint_interval)
+            try:
+                if self.journal is not None:
+                    self.journal.sync()
+                # Batched fsyncs otherwise only run on the next write, which may never come
+                sync_pending()
+                if not self.checkpoint():
+                    self.reload_if_changed()
+            except Exception as e:
+                print(f"Error checkpointing state: {e}")
+
+# Process-wide store shared by DataManager, background_task and mqtt_background_task
+_store = None
+_store_lock = threading.Lock()
+
+def get_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            shared = None
+            if SHARED_STATE_FILE:
+                from sharedstate import SharedState
+                shared = SharedState(SHARED_STATE_FILE)
+            _store = StateStore(DATA_FILE, journal=Journal(JOURNAL_DIR) if STATE_OWNER else None, shared=shared)
+            if STATE_OWNER:
+                _store.start_checkpointer()
+        return _store
@@ -0,0 +1,81 @@
+"""
+Broker-free replay harness for the MQTT sensor ingestion path.
+
+Feeds a recorded telemetry file (JSON lines of {"t": seconds, "topic": ...,
+"payload": ...}) through mqtt.SensorIngestor against a throwaway state
+store and reports throughput and the resulting sensor values.
+
+    python telemetry_replay.py telemetry_sample.jsonl --speed 0
+    python telemetry_replay.py --generate recording.jsonl --devices 50 --rate 500
+"""
+import argparse
+import json
+import os
+import random
+import tempfile
+import time
+from mqtt import SensorIngestor, SENSOR_TOPIC_PREFIX, SENSOR_METRICS, INGEST_FLUSH_INTERVAL
+from state import StateStore
+
+def load_recording(path):
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def generate_recording(path, devices=10, rate=200, duration=5.0):
+    """Write a synthetic recording of `rate` messages per second from `devices` devices."""
+    base = {"temperature": 28.0, "humidity": 60.0, "light_level": 70.0}
+    with open(path, 'w') as f:
+        for i in range(int(rate * duration)):
+            metric = random.choice(SENSOR_METRICS)
+            device_id = f"esp32-{random.randrange(devices):03d}"
+            value = round(base[metric] + random.uniform(-3, 3), 1)
+            payload = json.dumps({"value": value}) if i % 2 else json.dumps(value)
+            f.write(json.dumps({"t": round(i / rate, 4), "topic": f"{SENSOR_TOPIC_PREFIX}/{device_id}/{metric}", "payload": payload}) + "\n")
+
+def replay(records, ingestor, speed=1.0):
+    """
+    Replay records into the ingestor, flushing every INGEST_FLUSH_INTERVAL of
+    recording time. speed=0 replays as fast as possible.
+    """
+    start = time.monotonic()
+    first = records[0]["t"] if records else 0
+    next_flush = first + INGEST_FLUSH_INTERVAL
+    for record in records:
+        if speed > 0:
+            delay = (record["t"] - first) / speed - (time.monotonic() - start)
+            if delay > 0:
+                time.sleep(delay)
+        while record["t"] >= next_flush:
+            ingestor.flush(now=time.time())
+            next_flush += INGEST_FLUSH_INTERVAL
+        ingestor.ingest(record["topic"], record["payload"])
+    ingestor.flush(now=time.time())
+    return time.monotonic() - start
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recording", help="Recording to replay (or to write with --generate)")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay speed multiplier, 0 for as fast as possible")
+    parser.add_argument("--generate", action="store_true", help="Write a synthetic recording instead of replaying")
+    parser.add_argument("--devices", type=int, default=10)
+    parser.add_argument("--rate", type=int, default=200, help="Messages per second when generating")
+    parser.add_argument("--duration", type=float, default=5.0, help="Seconds of telemetry when generating")
+    args = parser.parse_args()
+
+    if args.generate:
+        generate_recording(args.recording, args.devices, args.rate, args.duration)
+        print(f"Wrote {args.recording}")
+        return
+
+    records = load_recording(args.recording)
+    with tempfile.TemporaryDirectory() as tmp:
+        store = StateStore(os.path.join(tmp, "data.json"))
+        ingestor = SensorIngestor(store)
+        elapsed = replay(records, ingestor, args.speed)
+        _, data = store.snapshot()
+    print(f"Replayed {len(records)} messages in {elapsed:.3f}s ({len(records) / max(elapsed, 1e-9):.0f} msg/s)")
+    print(f"Accepted: {ingestor.received}, rejected: {ingestor.rejected}, state updates: {ingestor.flushes}")
+    print(f"Sensors: {data['sensors']}")
+
+if __name__ == "__main__":
+    main()
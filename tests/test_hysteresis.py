@@ -0,0 +1,22 @@
+from hysteresis import ActionStabilizer
+
+def test_actuator_keys_are_released_together():
+    stabilizer = ActionStabilizer({"min_dwell": {"fan": 10}})
+    current = {"fan": "on", "fan_speed": 50}
+    current = stabilizer.apply_dwell("room", current, {"fan": "on", "fan_speed": 50}, now=0)
+    current = stabilizer.apply_dwell("room", current, {"fan": "on", "fan_speed": 80}, now=20)
+    assert current == {"fan": "on", "fan_speed": 80}
+    # The speed changed on the previous tick, so the whole fan waits out its dwell
+    assert stabilizer.apply_dwell("room", current, {"fan": "off", "fan_speed": 0}, now=25) == current
+    assert stabilizer.apply_dwell("room", current, {"fan": "off", "fan_speed": 0}, now=30) == {"fan": "off", "fan_speed": 0}
+
+def test_one_degree_step_crosses_a_rule_boundary():
+    stabilizer = ActionStabilizer({"min_dwell": 0})
+    def evaluate(rooms):
+        # fixed_rule style bounds: ...-19 keeps the fan off, 20-... turns it on
+        return {room_id: {"fan": "on" if room["sensors"]["temperature"] >= 20 else "off"}
+                for room_id, room in rooms.items()}
+    room = {"sensors": {"temperature": 19}, "action": {"fan": "off"}}
+    assert stabilizer.apply({"room": room}, evaluate, now=0) == {"room": {"fan": "off"}}
+    room["sensors"]["temperature"] = 20
+    assert stabilizer.apply({"room": room}, evaluate, now=1) == {"room": {"fan": "on"}}
@@ -0,0 +1,44 @@
+import json
+
+from intents import ResponseCache, is_action_reply, resolve_local
+
+DATA = {"sensors": {"temperature": 30, "light_level": 40, "humidity": 50},
+        "action": {"fan": "on", "fan_speed": 50, "light": "off", "set_brightness": 0}}
+PREDEFINED = {"Movie Mode": [{"action_type": "light", "action_value": "off"}]}
+FAN_ON = json.dumps([{"action_type": "fan", "action_value": "on"}])
+
+def resolve(text, cache, data=DATA, scheduled=()):
+    return resolve_local(text, data, "fixed_rule", list(scheduled), PREDEFINED, cache)
+
+def test_fast_path_matches_and_misses():
+    cache = ResponseCache()
+    assert json.loads(resolve("Set the fan speed to 70%", cache)[0]) == [{"action_type": "fan_speed", "action_value": "70"}]
+    assert resolve("movie mode", cache)[:2] == (json.dumps(PREDEFINED["Movie Mode"]), "intent")
+    assert resolve("cancel all scheduled actions", cache)[:2] == ("There are no scheduled actions to cancel.", "intent")
+    text, source, key = resolve("I'm feeling warm", cache)
+    assert (text, source) == (None, "model") and key is not None
+    assert resolve("set the fan speed to 170%", cache)[1] == "model"
+
+def test_context_phrases_are_never_cached():
+    cache = ResponseCache()
+    for query in ("make it cooler", "yes", "Yes!", "do that again", "what is scheduled?"):
+        assert resolve(query, cache) == (None, "model", None)
+
+def test_cached_reply_is_keyed_on_state():
+    cache = ResponseCache()
+    _, _, key = resolve("I'm feeling warm", cache)
+    assert is_action_reply(FAN_ON) and not is_action_reply("Sure, anything else?")
+    cache.put(key, FAN_ON)
+    assert resolve("i'm feeling warm!", cache)[:2] == (FAN_ON, "cache")
+    faster = {**DATA, "action": {**DATA["action"], "fan_speed": 80}}
+    assert resolve("I'm feeling warm", cache, data=faster)[:2] == (None, "model")
+    assert resolve("I'm feeling warm", cache, scheduled=[{"id": "a"}])[:2] == (None, "model")
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    assert (cache.get("a"), cache.get("b"), cache.get("c")) == (1, None, 3)
+    assert (cache.hits, cache.misses) == (3, 1)
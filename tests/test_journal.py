@@ -0,0 +1,58 @@
+import os
+
+import pytest
+
+from journal import Journal
+from persistence import atomic_write_json
+from state import StateStore
+
+def test_torn_tail_is_truncated(tmp_path):
+    store = StateStore(str(tmp_path / "data.json"), journal=Journal(str(tmp_path / "journal")))
+    store.merge("sensors", {"temperature": 25})
+    log = store.journal._path
+    with open(log, "ab") as f:
+        f.write(b"\x00\x00\x01\x00torn")
+    recovered = StateStore(str(tmp_path / "data.json"), journal=Journal(str(tmp_path / "journal")))
+    assert recovered.snapshot()[1]["sensors"]["temperature"] == 25
+    assert os.path.getsize(log) == recovered.journal._size
+
+def test_corruption_before_intact_records_is_quarantined(tmp_path):
+    store = StateStore(str(tmp_path / "data.json"), journal=Journal(str(tmp_path / "journal")))
+    store.merge("sensors", {"temperature": 25})
+    first_end = store.journal._size
+    store.merge("sensors", {"temperature": 26})
+    log = store.journal._path
+    with open(log, "r+b") as f:
+        f.seek(first_end - 2)
+        f.write(b"X")  # Inside the first record's payload
+    size = os.path.getsize(log)
+    with pytest.raises(RuntimeError, match="Could not recover"):
+        StateStore(str(tmp_path / "data.json"), journal=Journal(str(tmp_path / "journal")))
+    # Kept whole for inspection, not truncated at the bad record
+    moved = [name for name in os.listdir(tmp_path / "journal") if ".log.corrupt-" in name]
+    assert not os.path.exists(log) and len(moved) == 1
+    assert os.path.getsize(tmp_path / "journal" / moved[0]) == size
+
+def test_unmarked_export_does_not_roll_back(tmp_path):
+    path = str(tmp_path / "data.json")
+    store = StateStore(path, journal=Journal(str(tmp_path / "journal")))
+    store.merge("sensors", {"temperature": 25})
+    store.checkpoint()
+    store.merge("sensors", {"temperature": 26})
+    # A checkpoint that died between writing data.json and marking it exported
+    _, data = store.snapshot()
+    store.journal.begin_export(data)
+    atomic_write_json(path, data, indent=2, durable=False)
+    store.merge("sensors", {"temperature": 27})
+    recovered = StateStore(path, journal=Journal(str(tmp_path / "journal")))
+    assert recovered.snapshot()[1]["sensors"]["temperature"] == 27
+
+def test_offline_edit_is_applied(tmp_path):
+    path = str(tmp_path / "data.json")
+    store = StateStore(path, journal=Journal(str(tmp_path / "journal")))
+    store.checkpoint()
+    _, data = store.snapshot()
+    atomic_write_json(path, {**data, "sensors": {**data["sensors"], "temperature": 18}}, indent=2)
+    os.utime(path, ns=(0, 1))
+    recovered = StateStore(path, journal=Journal(str(tmp_path / "journal")))
+    assert recovered.snapshot()[1]["sensors"]["temperature"] == 18
@@ -0,0 +1,34 @@
+import time
+
+from llm import FakeBackend, LLMPipeline
+
+def wait(request, limit=5):
+    end = time.time() + limit
+    while request.status in ("pending", "running") and time.time() < end:
+        time.sleep(0.01)
+    return request
+
+def ask(backend, session):
+    return lambda on_chunk, deadline: backend.send(session, "hello", on_chunk, timeout=deadline - time.time())[0]
+
+def test_failed_call_is_retried():
+    backend = FakeBackend(responder=lambda prompt: "hi there", failures=1)
+    session = backend.start_session()
+    request = wait(LLMPipeline(timeout=5, retries=1, backoff=0.01).submit(ask(backend, session)))
+    assert (request.status, request.text, request.attempts) == ("done", "hi there", 2)
+    assert len(session.history) == 2
+
+def test_call_is_aborted_at_the_deadline():
+    backend = FakeBackend(responder=lambda prompt: "a slow reply", delay=0.1, chunk_size=1)
+    session = backend.start_session()
+    request = wait(LLMPipeline(timeout=0.3, retries=2, backoff=0.01).submit(ask(backend, session)))
+    assert request.status == "expired" and request.timed_out and request.finished
+    assert request.text is None and 0 < len(request.partial) < len("a slow reply")
+    assert session.history == []
+
+def test_late_reply_is_dropped():
+    def job(on_chunk, deadline):
+        time.sleep(0.2)  # A backend that ignores its timeout
+        return "late"
+    request = wait(LLMPipeline(timeout=0.05, retries=0).submit(job))
+    assert request.status == "expired" and request.text is None
@@ -0,0 +1,81 @@
+import copy
+import random
+
+import pytest
+
+pytest.importorskip("streamlit")
+
+from update import RuleIndex, update_room_actions
+from utils import compact_rules
+
+TIMES = ["", "06:00-18:00", "18:01-05:59"]
+ACTIONS = [{"fan": "on"}, {"fan": "off"}, {"fan": "on", "fan_speed": 50}]
+MINUTES = [0, 6 * 60, 12 * 60, 18 * 60 + 30]
+
+def random_rules(rng):
+    rules = []
+    for _ in range(rng.randint(1, 8)):
+        low = rng.randint(0, 20) / 2
+        rule = {"min": low, "max": low + rng.randint(0, 6) / 2, "time": rng.choice(TIMES),
+                "actions": dict(rng.choice(ACTIONS))}
+        if rng.random() < 0.7:
+            rule["learned"] = True
+        for bound in ("min", "max"):
+            if rng.random() < 0.1:
+                del rule[bound]
+        rules.append(rule)
+    return rules
+
+def evaluate(rules):
+    index = RuleIndex({"temperature": rules})
+    values = [value / 4 for value in range(-4, 64)]
+    return [index.lookup_many("temperature", values, minute) for minute in MINUTES]
+
+def test_compaction_keeps_first_match_results():
+    rng = random.Random(20261017)
+    for _ in range(2000):
+        rules = random_rules(rng)
+        hand_rules = [copy.deepcopy(rule) for rule in rules if not rule.get("learned")]
+        expected = evaluate(copy.deepcopy(rules))
+        compacted = compact_rules(rules)
+        assert [rule for rule in compacted if not rule.get("learned")] == hand_rules
+        # Only values no rule matched may pick up the actions of a rule widened over a gap
+        for before, after in zip(expected, evaluate(compacted)):
+            assert [a for b, a in zip(before, after) if b] == [b for b in before if b], rules
+
+def test_learned_points_merge_across_gaps():
+    rules = [{"min": 10, "max": 20, "time": "06:00-18:00", "actions": {"fan": "off"}}]
+    for value in (30.1, 30.3, 30.2, 30.6, 30.5, 30.4):
+        rule = {"label": f"temperature_{value}_0600-1800", "min": value, "max": value,
+                "time": "06:00-18:00", "actions": {"fan": "on"}}
+        rules.append(rule)
+        compact_rules(rules, rule)
+    assert rules[1:] == [{"label": "temperature_30.1_0600-1800", "min": 30.1, "max": 30.6,
+                          "time": "06:00-18:00", "actions": {"fan": "on"}, "learned": True, "last_used": 0}]
+
+def test_learned_points_far_apart_are_not_merged():
+    rules = [{"label": f"temperature_{value}_", "min": value, "max": value, "actions": {"fan": "on"}} for value in (10, 40, 11)]
+    compact_rules(rules, rules[1])
+    compact_rules(rules, rules[2])
+    assert [(rule["min"], rule["max"]) for rule in rules] == [(10, 11), (40, 40)]
+
+def test_hand_written_rules_are_never_merged():
+    rules = [{"label": "cold", "min": 11, "max": 15, "actions": {"fan": "off", "fan_speed": 0}},
+             {"label": "cool", "min": 16, "max": 19, "actions": {"fan": "off", "fan_speed": 0}},
+             {"label": "hot", "min": 30, "max": 35, "actions": {"fan": "off", "fan_speed": 0}}]
+    expected = copy.deepcopy(rules)
+    learned = {"label": "temperature_12_", "min": 12, "max": 12, "actions": {"fan": "off", "fan_speed": 0}, "learned": True}
+    rules.insert(0, learned)
+    compact_rules(rules, learned)
+    assert rules[1:] == expected and compact_rules(copy.deepcopy(expected)) == expected
+
+def test_ranges_with_a_gap_are_not_merged():
+    rules = [{"min": 18, "max": 19, "actions": {"fan": "off"}, "learned": True},
+             {"min": 20, "max": 20, "actions": {"fan": "off"}, "learned": True},
+             {"min": 8, "max": 8.5, "actions": {"fan": "on"}}, {"min": 17.5, "max": 19.5, "actions": {"fan": "on"}}]
+    assert RuleIndex({"temperature": compact_rules(rules)}).lookup_many("temperature", [19.1], 0) == [{"fan": "on"}]
+
+def test_readings_between_whole_number_ranges_match_the_nearest_rule():
+    rules = {"fixed_rule": {"temperature": [{"max": 30, "actions": {"fan": "off"}}, {"min": 31, "actions": {"fan": "on"}}]}}
+    rooms = {room: {"sensors": {"temperature": value}, "action": {}} for room, value in (("a", 30.4), ("b", 30.6), ("c", 30))}
+    assert update_room_actions(rooms, rules, "fixed_rule") == {"a": {"fan": "off"}, "b": {"fan": "on"}, "c": {"fan": "off"}}
@@ -0,0 +1,14 @@
+from schedule_batch import build_entry, find_conflicts, reject_conflicting
+
+NOW = 1_000_000.0
+
+def row(action_id, action, delay):
+    return build_entry({"id": action_id, "action": action, "delay_seconds": str(delay)}, "fixed_rule", {}, NOW)
+
+def test_row_is_not_rejected_for_a_conflict_with_a_rejected_row():
+    pending = [row("p", "fan=on", 60)]
+    entries = [row("a", "fan=off", 60), row("b", "fan=on", 61), row("c", "fan=off", 62)]
+    accepted, conflicts = reject_conflicting(entries, find_conflicts(entries, pending, NOW))
+    # a loses to the pending schedule, so b only clashes with a and is kept; c then clashes with b
+    assert [entry["id"] for entry in accepted] == ["b"]
+    assert sorted((conflict["id"], conflict["other_id"]) for conflict in conflicts) == [("a", "p"), ("c", "b"), ("c", "p")]
@@ -0,0 +1,27 @@
+import threading
+import time
+
+from persistence import read_json
+from scheduler import Scheduler
+
+def test_fired_entry_stays_saved_until_its_handler_returns(tmp_path):
+    path = str(tmp_path / "scheduler.json")
+    started, release, done = threading.Event(), threading.Event(), threading.Event()
+    def handler(entry):
+        started.set()
+        release.wait(5)
+        done.set()
+    scheduler = Scheduler(handler, path=path, lock_file=path + ".lock")
+    scheduler.start()
+    scheduler.add({"id": "a", "scheduled_time": time.time(), "actions": []})
+    assert started.wait(5)
+    # A crash now must leave the action to be caught up on restart
+    assert [entry["id"] for entry in read_json(path)["scheduled_actions"]] == ["a"]
+    assert scheduler.list() == []
+    release.set()
+    assert done.wait(5)
+    end = time.time() + 5
+    while read_json(path)["scheduled_actions"] and time.time() < end:
+        time.sleep(0.01)
+    assert read_json(path)["scheduled_actions"] == []
+    scheduler.stop()
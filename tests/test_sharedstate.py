@@ -0,0 +1,30 @@
+import pytest
+
+from sharedstate import SharedState, ROOM_SLOTS
+from state import StateStore
+
+def test_invalid_action_is_rejected_and_readers_still_return(tmp_path):
+    shared = SharedState(str(tmp_path / "region"))
+    store = StateStore(str(tmp_path / "data.json"), shared=shared)
+    version = store.version
+    with pytest.raises(ValueError):
+        store.merge("action", {"fan_speed": "high"})
+    with pytest.raises(ValueError):
+        store.merge("action", {"fan_speed": 2 ** 40})
+    assert store.version == version
+    assert shared.seq % 2 == 0
+    _, rooms = shared.read()
+    assert rooms["default"]["action"]["fan_speed"] == 100
+    assert store.snapshot()[1]["action"]["fan_speed"] == 100
+
+def test_write_leaves_region_untouched_on_invalid_rooms(tmp_path):
+    shared = SharedState(str(tmp_path / "region"))
+    with shared.locked():
+        seq = shared.write({"default": {"sensors": {"temperature": 20}, "action": {"fan": "on"}}})
+        with pytest.raises(ValueError):
+            shared.write({"default": {"action": {"fan_speed": "high"}}})
+        with pytest.raises(ValueError):
+            shared.write({f"r{i}": {} for i in range(ROOM_SLOTS + 1)})
+        with pytest.raises(ValueError):
+            shared.write({"é" * 17: {}})
+    assert shared.read() == (seq, {"default": {"sensors": {"temperature": 20.0}, "action": {"fan": "on"}}})
@@ -1,12 +1,19 @@
 import streamlit as st
 import json
 import os
-from filelock import FileLock
+from persistence import atomic_write_json, read_json, FileLock
 import time
 import re
 import uuid
-from utils import execute_delayed_action, json_to_natural_language, load_scheduled_actions, save_scheduled_actions
+from utils import execute_delayed_action, json_to_natural_language, schedule_many
+from schedule_batch import parse_import, IMPORT_COLUMNS
+from recurrence import describe, next_fire_time, next_time_of_day, validate
 from datetime import datetime
+from chat_history import CHAT_WINDOW
+from events import bus
+from workers import get_supervisor
+from history import get_history
+from state import DEFAULT_ROOM
 
 # Path to rules, config, and status files
 RULES_FILE = 'rule.json'
@@ -14,28 +21,28 @@ RULES_LOCK_FILE = RULES_FILE + '.lock'
 CONFIG_FILE = 'config.json'
 CONFIG_LOCK_FILE = CONFIG_FILE + '.lock'
 STATUS_FILE = 'status.json'
-STATUS_LOCK_FILE = STATUS_FILE + '.lock'
+RECURRENCE_KINDS = {"Every day": "daily", "Weekdays": "weekdays", "Sunrise": "sunrise", "Sunset": "sunset", "Cron": "cron"}
+HISTORY_RANGES = {"Last hour": 3600, "Last 24 hours": 24 * 3600, "Last 7 days": 7 * 24 * 3600, "Last 30 days": 30 * 24 * 3600}
 
 # Helper to update config.json when rule_set changes
 def write_config(active_rule_set):
     try:
         with FileLock(CONFIG_LOCK_FILE):
-            with open(CONFIG_FILE, 'w') as cf:
-                json.dump({"active_rule_set": active_rule_set}, cf, indent=4)
+            # Keep other settings such as the hysteresis section
+            config = {}
+            if os.path.exists(CONFIG_FILE):
+                with open(CONFIG_FILE, 'r') as f:
+                    config = json.load(f)
+            config["active_rule_set"] = active_rule_set
+            atomic_write_json(CONFIG_FILE, config, indent=4)
     except Exception as e:
         st.error(f"Could not update config: {e}")
 
 # Helper to load status from status.json
-def load_status(file_path, lock_file):
-    try:
-        with FileLock(lock_file):
-            if os.path.exists(file_path):
-                with open(file_path, 'r') as f:
-                    data = json.load(f)
-                    return data.get('status', 'No status available')
-            return 'No status available'
-    except Exception as e:
-        return f"Error loading status: {e}"
+def load_status(file_path):
+    status = read_json(file_path)
+    return status.get('status', 'No status available') if status else 'No status available'
+
 
 # Helper to update user_preference rules with time ranges
 def update_rule_time(sensor, label, new_time):
@@ -50,14 +57,16 @@ def update_rule_time(sensor, label, new_time):
                     else:
                         rule.pop('time', None)
                     break
-            with open(RULES_FILE, 'w') as f:
-                json.dump(rules, f, indent=4)
+            atomic_write_json(RULES_FILE, rules, indent=4)
         st.success(f"Updated time range for {sensor} rule: {label}")
     except Exception as e:
         st.error(f"Failed to update rule time: {e}")
 
 # Helper to format time for display
 def format_schedule_time(scheduled_action, current_time):
+    if scheduled_action.get("recurrence"):
+        next_run = datetime.fromtimestamp(scheduled_action["scheduled_time"]).strftime('%a %H:%M')
+        return f"{describe(scheduled_action['recurrence'])} (next {next_run})"
     time_left = max(0, scheduled_action["scheduled_time"] - current_time)
     if time_left <= 1:
         return "soon"
@@ -156,13 +165,12 @@ def render_ui(data, data_manager, process_user_input):
             }
             </style>
             """, unsafe_allow_html=True)
-        chat_html = '<div id="chat-container">'
-        sorted_history = sorted(st.session_state.display_history, key=lambda x: x.get("timestamp", 0), reverse=True)
-        for msg in sorted_history:
-            cls = "chat-user" if msg["role"] == "user" else "chat-model"
-            chat_html += f'<div class="{cls}"><strong>{msg["role"].capitalize()}:</strong><br>{msg["text"]}</div>'
-        chat_html += '</div>'
-        st.markdown(chat_html, unsafe_allow_html=True)
+        history = st.session_state.display_history
+        chat_window = st.session_state.setdefault('chat_window', CHAT_WINDOW)
+        if len(history) > chat_window:
+            if st.button(f"Show older messages ({len(history) - chat_window} hidden)", key="chat_show_older"):
+                st.session_state.chat_window = chat_window = chat_window + CHAT_WINDOW
+        st.markdown(history.render_html(chat_window), unsafe_allow_html=True)
 
         # Capture user input
         user_input = st.chat_input("Ask something...")
@@ -188,71 +196,107 @@ def render_ui(data, data_manager, process_user_input):
                 with FileLock(RULES_LOCK_FILE):
                     rules = json.load(open(RULES_FILE, 'r'))
                     rules['user_preference'] = rules['fixed_rule']
-                    with open(RULES_FILE, 'w') as f:
-                        json.dump(rules, f, indent=4)
+                    atomic_write_json(RULES_FILE, rules, indent=4)
                 st.success("User preferences reset to match fixed rules.")
             except Exception as e:
                 st.error(f"Failed to reset preferences: {e}")
 
         with st.expander("⏰ Schedule Editor", expanded=False):
             st.subheader("Schedule New Action")
-            schedule_type = st.radio("Schedule Type:", ["Delay (seconds)", "Specific Time"], key="schedule_type")
+            schedule_type = st.radio("Schedule Type:", ["Delay (seconds)", "Specific Time", "Recurring"], key="schedule_type")
             action_name = st.selectbox("Select Action:", list(PREDEFINED_ACTIONS.keys()), key="schedule_action_select_editor")
 
             schedule_time_str = None
+            recurrence = None
             if schedule_type == "Delay (seconds)":
                 delay_seconds = st.number_input("Delay (seconds):", min_value=1, value=10, key="schedule_delay_input_editor")
-                schedule_time = None
+            elif schedule_type == "Recurring":
+                kind = RECURRENCE_KINDS[st.selectbox("Repeat:", list(RECURRENCE_KINDS), key="schedule_recurrence_kind")]
+                if kind in ("daily", "weekdays"):
+                    schedule_time_str = st.text_input("Time (HH:MM, e.g., 23:00):", key="schedule_recurrence_time")
+                    recurrence = {"kind": kind, "time": schedule_time_str}
+                elif kind == "cron":
+                    recurrence = {"kind": kind, "expr": st.text_input("Cron expression (minute hour day month weekday):", value="0 23 * * *", key="schedule_recurrence_cron")}
+                else:
+                    offset = st.number_input(f"Minutes relative to {kind} (negative for before):", value=0, step=5, key="schedule_recurrence_offset")
+                    recurrence = {"kind": kind, "offset": int(offset)}
+                delay_seconds = None
+                try:
+                    validate(recurrence)
+                    next_run = next_fire_time(recurrence)
+                    delay_seconds = next_run - time.time()
+                    st.caption(f"Runs {describe(recurrence)}, next on {datetime.fromtimestamp(next_run).strftime('%a %d %b %H:%M')}.")
+                except ValueError as e:
+                    if schedule_time_str != "":
+                        st.error(f"Invalid schedule: {e}")
+                    recurrence = None
             else:
                 schedule_time_str = st.text_input("Schedule Time (HH:MM, e.g., 14:30):", key="schedule_time_input")
                 delay_seconds = None
                 if schedule_time_str and not re.match(r'^\d{2}:\d{2}$', schedule_time_str):
                     st.error("Invalid time format. Use HH:MM (e.g., 14:30).")
-                    schedule_time = None
                 else:
                     try:
-                        schedule_time = datetime.strptime(schedule_time_str, '%H:%M').time()
                         now = datetime.now()
-                        schedule_datetime = datetime.combine(now.date(), schedule_time)
-                        if schedule_datetime < now:
-                            schedule_datetime = schedule_datetime.replace(day=now.day + 1)
-                        delay_seconds = (schedule_datetime - now).total_seconds()
+                        delay_seconds = (next_time_of_day(schedule_time_str, now) - now).total_seconds()
                         if delay_seconds < 0:
                             st.error("Scheduled time must be in the future.")
-                            schedule_time = None
                             delay_seconds = None
                     except ValueError:
                         st.error("Invalid time format. Use HH:MM (e.g., 14:30).")
-                        schedule_time = None
                         delay_seconds = None
 
             if st.button("Schedule Action", key="schedule_action_button_editor") and (delay_seconds is not None):
                 actions = PREDEFINED_ACTIONS[action_name]
-                try:
-                    with FileLock(CONFIG_LOCK_FILE):
-                        config = json.load(open(CONFIG_FILE, 'r'))
-                        active_rule_set = config.get('active_rule_set', 'fixed_rule')
-                except Exception:
-                    active_rule_set = 'fixed_rule'
+                active_rule_set = read_json(CONFIG_FILE, {}).get('active_rule_set', 'fixed_rule')
                 action_id = str(uuid.uuid4())
                 description = json_to_natural_language(actions)
-                scheduled_actions = load_scheduled_actions()
-                scheduled_time_epoch = time.time() + delay_seconds
-                if not any(sa["id"] == action_id for sa in scheduled_actions):
-                    scheduled_actions.append({
-                        "id": action_id,
-                        "actions": actions,
-                        "delay_seconds": delay_seconds,
-                        "scheduled_time": scheduled_time_epoch,
-                        "description": description,
-                        "schedule_type": schedule_type,
-                        "schedule_time_str": schedule_time_str if schedule_type == "Specific Time" else None
-                    })
-                    save_scheduled_actions(scheduled_actions)
-                    st.session_state.scheduled_actions = scheduled_actions
+                if recurrence:
+                    display_time = describe(recurrence)
+                else:
                     display_time = schedule_time_str if schedule_type == "Specific Time" else f"in {delay_seconds} seconds"
-                    st.session_state.display_history.append({"role": "model", "text": f"Scheduled to perform actions ({description}) {display_time}.", "timestamp": time.time()})
-                    execute_delayed_action(data, data_manager, actions, delay_seconds, active_rule_set, action_id, schedule_time_str)
+                st.session_state.display_history.append({"role": "model", "text": f"Scheduled to perform actions ({description}) {display_time}.", "timestamp": time.time()})
+                execute_delayed_action(data, data_manager, actions, delay_seconds, active_rule_set, action_id, schedule_time_str if schedule_type != "Delay (seconds)" else None, recurrence)
+
+            st.subheader("Import Schedules")
+            uploaded = st.file_uploader("CSV or JSON file:", type=["csv", "json"], key="schedule_import_file")
+            st.caption(f"One schedule per row or object with: {IMPORT_COLUMNS}. `action` is a predefined action name or e.g. `fan=on; fan_speed=50`.")
+            allow_conflicts = st.checkbox("Also schedule rows that conflict with other schedules", key="schedule_import_conflicts")
+            if uploaded is not None and st.button("Import Schedules", key="schedule_import_button"):
+                try:
+                    # utf-8-sig drops the byte-order mark Excel puts in front of CSV files
+                    rows = parse_import(uploaded.getvalue().decode("utf-8-sig"), uploaded.name.rsplit('.', 1)[-1].lower())
+                except (UnicodeDecodeError, ValueError) as e:
+                    st.error(f"Could not read {uploaded.name}: {e}")
+                else:
+                    active_rule_set = read_json(CONFIG_FILE, {}).get('active_rule_set', 'fixed_rule')
+                    entries, errors, conflicts = schedule_many(rows, active_rule_set, PREDEFINED_ACTIONS, allow_conflicts=allow_conflicts)
+                    st.success(f"Scheduled {len(entries)} of {len(rows)} actions from {uploaded.name}.")
+                    for number, error in errors:
+                        st.warning(f"Row {number}: {error}" if number is not None else error)
+                    verb = "Scheduled anyway" if allow_conflicts else "Skipped"
+                    for conflict in conflicts:
+                        when = datetime.fromtimestamp(conflict["time"]).strftime('%a %H:%M')
+                        st.warning(f"{verb}: {conflict['description']} conflicts with {conflict['other_description']} on the {conflict['actuator']} at {when}.")
+                    if entries:
+                        st.session_state.display_history.append({"role": "model", "text": f"Scheduled {len(entries)} actions from {uploaded.name}.", "timestamp": time.time()})
+
+        with st.expander("📈 Sensor History", expanded=False):
+            rooms = [DEFAULT_ROOM] + sorted(data.get('rooms', {}))
+            room = st.selectbox("Room:", rooms, key="history_room") if len(rooms) > 1 else DEFAULT_ROOM
+            metric = st.selectbox("Sensor:", ["temperature", "humidity", "light_level"], key="history_metric")
+            span = st.selectbox("Range:", list(HISTORY_RANGES), index=1, key="history_range")
+            end = time.time()
+            rows = get_history().query(metric, end - HISTORY_RANGES[span], end, room)
+            if rows:
+                st.line_chart({
+                    "time": [datetime.fromtimestamp(row[0]) for row in rows],
+                    "min": [row[1] for row in rows],
+                    "avg": [row[2] for row in rows],
+                    "max": [row[3] for row in rows],
+                }, x="time")
+            else:
+                st.info("No history recorded for this range yet.")
 
         st.markdown("---")
 
@@ -282,6 +326,25 @@ def render_ui(data, data_manager, process_user_input):
                 st.markdown(f"**Light:** {action_state['light'].capitalize()}")
                 st.markdown(f"**Brightness:** {action_state['set_brightness']}%")
 
+                st.markdown("---")
+                st.subheader("Background Workers")
+                supervisor = get_supervisor()
+                for name, info in supervisor.health().items():
+                    state = "running" if info["alive"] else "stopped"
+                    if info.get("restart_pending"):
+                        state += ", restart pending"
+                    st.markdown(f"**{name.capitalize()}:** {state}, up {int(info['uptime'])}s")
+                if st.button("Restart Workers", key="restart_workers"):
+                    supervisor.restart()
+                    st.success("Background workers restarted.")
+
+                prompt_context = st.session_state.get('prompt_context')
+                if prompt_context and prompt_context.last_prompt_tokens:
+                    st.markdown("---")
+                    st.subheader("Model Usage")
+                    st.markdown(f"**Prompt tokens (last turn):** {prompt_context.last_prompt_tokens}")
+                    st.markdown(f"**Prompt tokens (session):** {sum(prompt_context.turn_tokens)}")
+
         with st.expander("🎛️ Manual Controls", expanded=False):
             st.subheader("Fan Control")
             fan_stat = st.selectbox("Fan:", ["on", "off"], index=["on", "off"].index(st.session_state.get('action_state', data['action'])['fan']), key="fan_select")
@@ -298,7 +361,7 @@ def render_ui(data, data_manager, process_user_input):
                     "light": light_stat,
                     "set_brightness": bright
                 }
-                data_manager.update_data(data)
+                data_manager.update_actions(data['action'])
                 data = data_manager.load_data()
                 st.session_state['action_state'] = data['action']
                 st.success("Settings updated!")
@@ -307,7 +370,8 @@ def render_ui(data, data_manager, process_user_input):
     # Right Column: Status Displays
     with right_col:
         st.subheader("System Update")
-        update_status = load_status(STATUS_FILE, STATUS_LOCK_FILE)
+        status_event = bus.latest("status")
+        update_status = status_event["text"] if status_event else load_status(STATUS_FILE)
         update_status_html = update_status.replace('\n', '<br>')
         st.markdown(f'<div class="status-container"><p>{update_status_html}</p></div>', unsafe_allow_html=True)
 
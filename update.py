@@ -1,121 +1,293 @@
-import json
 import time
 import os
-from filelock import FileLock
+import threading
+from persistence import atomic_write_json, read_json
+from bisect import bisect_left
 from datetime import datetime
+from state import get_store, DEFAULT_ROOM
+from events import bus
+from history import get_history
+from hysteresis import ActionStabilizer
+import metrics
+
+# NumPy is optional and imported on first use, not at startup
+_numpy = {"checked": False, "module": None}
+
+def load_numpy():
+    """Return the numpy module, or None if it is not installed."""
+    if not _numpy["checked"]:
+        try:
+            import numpy
+            _numpy["module"] = numpy
+        except ImportError:  # lookup_many falls back to bisect
+            pass
+        _numpy["checked"] = True
+    return _numpy["module"]
 
 # Configuration
 RULES_FILE = 'rule.json'
-DATA_FILE = 'data.json'
 CONFIG_FILE = 'config.json'
-LOCK_FILE = 'data.json.lock'
-CONFIG_LOCK_FILE = 'config.json.lock'
 STATUS_FILE = 'status.json'
-STATUS_LOCK_FILE = 'status.json.lock'
 UPDATE_INTERVAL = 1  # Update interval in seconds
+RULE_RESOLUTION = 1  # rule.json bounds are whole numbers, with gaps between neighbouring ranges
 
-def load_json(path, lock_file=None):
-    """Load JSON data from a file."""
-    if lock_file:
-        with FileLock(lock_file):
-            with open(path, 'r') as f:
-                return json.load(f)
-    with open(path, 'r') as f:
-        return json.load(f)
-
-def save_json(path, data, lock_file=None):
-    """Save JSON data to a file, preserving formatting."""
-    if lock_file:
-        with FileLock(lock_file):
-            # Optionally, back up the old data
-            backup = path + '.bak'
-            if os.path.exists(path):
-                os.replace(path, backup)
-            with open(path, 'w') as f:
-                json.dump(data, f, indent=4)
-    else:
-        # Optionally, back up the old data
-        backup = path + '.bak'
-        if os.path.exists(path):
-            os.replace(path, backup)
-        with open(path, 'w') as f:
-            json.dump(data, f, indent=4)
-
-def is_time_in_range(time_str, current_time):
-    """Check if current_time (HH:MM) is within the time range (HH:MM-HH:MM)."""
+def parse_time_window(time_str):
+    """
+    Convert an 'HH:MM-HH:MM' window into (start, end) minutes of the day.
+    Returns None for an empty window (always applies) and raises ValueError
+    for a malformed one.
+    """
     if not time_str:
-        return True  # No time range means rule applies all the time
-    try:
-        start_str, end_str = time_str.split('-')
-        start = datetime.strptime(start_str, '%H:%M').time()
-        end = datetime.strptime(end_str, '%H:%M').time()
-        current = datetime.strptime(current_time, '%H:%M').time()
-        
-        if start <= end:
-            return start <= current <= end
-        else:  # Handles ranges that cross midnight (e.g., 22:00-06:00)
-            return current >= start or current <= end
-    except ValueError:
-        return False  # Invalid time format, skip rule
-
-def get_actions_for(sensor_name, value, rules, active_rule_set):
+        return None
+    start_str, end_str = time_str.split('-')
+    start = datetime.strptime(start_str, '%H:%M')
+    end = datetime.strptime(end_str, '%H:%M')
+    return (start.hour * 60 + start.minute, end.hour * 60 + end.minute)
+
+def minute_in_window(window, minute):
+    """Check if a minute of the day falls within a pre-parsed time window."""
+    if window is None:
+        return True
+    start, end = window
+    if start <= end:
+        return start <= minute <= end
+    return minute >= start or minute <= end  # Crosses midnight
+
+class RuleIndex:
     """
-    Determine the actions for a given sensor reading based on the rules and current time.
-    Returns a dict of actions (possibly empty).
+    Compiled form of one rule set for fast lookups.
+
+    The value axis of each sensor is cut at every finite min/max bound into
+    alternating "exact point" and "open gap" slots. Each slot holds the rules
+    covering it, in their original order, so a lookup is a bisect to find the
+    slot followed by a short scan over the time windows of its candidates.
+    The first matching rule wins, exactly like the linear scan it replaces.
     """
-    current_time = datetime.now().strftime('%H:%M')
-    active_rules = rules.get(active_rule_set, {})
-    for entry in active_rules.get(sensor_name, []):
-        minv = entry.get('min', float('-inf'))
-        maxv = entry.get('max', float('inf'))
-        time_range = entry.get('time', '')
-        if minv <= value <= maxv and is_time_in_range(time_range, current_time):
-            return entry.get('actions', {}) or {}
-    return {}
-
-def update_actions(data, rules, active_rule_set):
+
+    def __init__(self, rule_set):
+        self.sensors = {}
+        self._resolved = {}
+        self._bounds = {}  # sensor -> NumPy array of its points, built on first lookup_many
+        for sensor_name, entries in (rule_set or {}).items():
+            self.sensors[sensor_name] = self._compile(entries)
+
+    @staticmethod
+    def _compile(entries):
+        compiled = []
+        bounds = set()
+        for entry in entries:
+            minv = entry.get('min', float('-inf'))
+            maxv = entry.get('max', float('inf'))
+            try:
+                window = parse_time_window(entry.get('time', ''))
+            except ValueError:
+                continue  # Invalid time format, rule never applies
+            if minv > maxv:
+                continue
+            compiled.append((minv, maxv, window, entry.get('actions', {}) or {}))
+            for bound in (minv, maxv):
+                if bound not in (float('-inf'), float('inf')):
+                    bounds.add(bound)
+
+        points = sorted(bounds)
+        slots = [[] for _ in range(2 * len(points) + 1)]
+        for minv, maxv, window, actions in compiled:
+            lo = 0 if minv == float('-inf') else 2 * bisect_left(points, minv) + 1
+            hi = len(slots) - 1 if maxv == float('inf') else 2 * bisect_left(points, maxv) + 1
+            for slot in range(lo, hi + 1):
+                slots[slot].append((window, actions))
+        return points, slots
+
+    def resolve(self, sensor_name, minute):
+        """
+        Return the winning actions of every slot at one minute of the day.
+        The result is cached until the minute changes, so a tick that looks up
+        many readings of the same sensor scans the time windows only once.
+        """
+        cached = self._resolved.get(sensor_name)
+        if cached is not None and cached[0] == minute:
+            return cached[1]
+        _, slots = self.sensors[sensor_name]
+        resolved = []
+        for candidates in slots:
+            resolved.append(next((actions for window, actions in candidates if minute_in_window(window, minute)), {}))
+        self._resolved[sensor_name] = (minute, resolved)
+        return resolved
+
+    def lookup_many(self, sensor_name, values, minute):
+        """Return the actions for many readings of one sensor at minute of day."""
+        compiled = self.sensors.get(sensor_name)
+        if compiled is None:
+            return [{} for _ in values]
+        points, _ = compiled
+        resolved = self.resolve(sensor_name, minute)
+        np = load_numpy()
+        if np is not None and points:
+            readings = np.asarray(values, dtype=float)
+            bounds = self._bounds.get(sensor_name)
+            if bounds is None:
+                bounds = self._bounds[sensor_name] = np.asarray(points, dtype=float)
+            i = np.searchsorted(bounds, readings, side='left')
+            exact = bounds[np.minimum(i, len(bounds) - 1)] == readings
+            slots = 2 * i + exact
+            return [resolved[slot] for slot in slots.tolist()]
+        results = []
+        for value in values:
+            i = bisect_left(points, value)
+            results.append(resolved[2 * i + 1 if i < len(points) and points[i] == value else 2 * i])
+        return results
+
+# Compiled indexes, keyed by rule set name and invalidated when the rules change
+_rule_index_cache = {"rules": None, "indexes": {}}
+
+def get_rule_index(rules, active_rule_set):
+    """Return the compiled RuleIndex for a rule set, compiling it on first use."""
+    if _rule_index_cache["rules"] is not rules:
+        _rule_index_cache["rules"] = rules
+        _rule_index_cache["indexes"] = {}
+    indexes = _rule_index_cache["indexes"]
+    if active_rule_set not in indexes:
+        indexes[active_rule_set] = RuleIndex(rules.get(active_rule_set, {}))
+    return indexes[active_rule_set]
+
+def current_minute():
+    """Return the current minute of the day."""
+    now = datetime.now()
+    return now.hour * 60 + now.minute
+
+def update_room_actions(rooms, rules, active_rule_set):
     """
-    Update only the 'action' section of the data dict, merging new actions
-    without removing others.
+    Compute the merged actions of every room in one pass.
+
+    rooms maps room ids to dicts with 'sensors', 'action' and an optional
+    'rule_set' overriding the active one. Readings are grouped by rule set
+    and sensor so each group is matched with a single lookup_many call, then
+    merged into each room's actions in that room's sensor order, so a later
+    sensor's actions overwrite an earlier one's. A reading no rule matches,
+    such as 30.4 between "max 30" and "min 31", is matched again rounded to
+    RULE_RESOLUTION. Returns {room_id: actions}.
     """
-    current_actions = data.get('action', {}).copy()
-    sensors = data.get('sensors', {})
+    minute = current_minute()
+    groups = {}
+    for room_id, room in rooms.items():
+        rule_set = room.get('rule_set', active_rule_set)
+        for sensor_name, value in room.get('sensors', {}).items():
+            room_ids, values = groups.setdefault((rule_set, sensor_name), ([], []))
+            room_ids.append(room_id)
+            values.append(value)
+
+    matched = {}
+    for (rule_set, sensor_name), (room_ids, values) in groups.items():
+        index = get_rule_index(rules, rule_set)
+        results = index.lookup_many(sensor_name, values, minute)
+        misses = [i for i, (value, actions) in enumerate(zip(values, results))
+                  if not actions and isinstance(value, (int, float))
+                  and round(value / RULE_RESOLUTION) * RULE_RESOLUTION != value]
+        if misses:
+            rounded = [round(values[i] / RULE_RESOLUTION) * RULE_RESOLUTION for i in misses]
+            for i, actions in zip(misses, index.lookup_many(sensor_name, rounded, minute)):
+                results[i] = actions
+        for room_id, actions in zip(room_ids, results):
+            matched[(room_id, sensor_name)] = actions
 
-    for sensor_name, sensor_value in sensors.items():
-        new_actions = get_actions_for(sensor_name, sensor_value, rules, active_rule_set)
-        # Merge: overwrite existing keys, leave others intact
-        for key, val in new_actions.items():
-            current_actions[key] = val
+    updated = {}
+    for room_id, room in rooms.items():
+        current_actions = dict(room.get('action', {}))
+        for sensor_name in room.get('sensors', {}):
+            current_actions.update(matched[(room_id, sensor_name)])
+        updated[room_id] = current_actions
+    return updated
 
-    data['action'] = current_actions
-    return data
+def load_rules():
+    """
+    Return the parsed rule.json. The same object is returned while the file
+    is unchanged, which keeps the compiled RuleIndex cache valid.
+    """
+    rules = read_json(RULES_FILE)
+    if rules is None:
+        raise FileNotFoundError(RULES_FILE)
+    return rules
+
+def file_mtime(path):
+    """Return the modification time of a file, or None if it does not exist."""
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
 
-def background_task():
-    while True:
+def write_status(status_message):
+    bus.publish("status", status_message)
+    # The evaluator is the only writer and readers never lock, so no lock file
+    atomic_write_json(STATUS_FILE, {"status": status_message}, durable=False)
+
+def background_task(stop_event=None):
+    """
+    Re-evaluate the active rules whenever their inputs change.
+
+    Inputs are the mtimes of config.json and rule.json, the version of the
+    shared state store and the current minute (time windows in the rules
+    have minute resolution). The loop wakes every UPDATE_INTERVAL to stat
+    the files, or immediately when the state store changes, and only
+    publishes new actions or rewrites status.json when they actually changed.
+    """
+    stop_event = stop_event or threading.Event()
+    store = get_store()
+    history = get_history()
+    stabilizer = ActionStabilizer()  # Dwell state must outlive a single tick
+    version = None
+    last_inputs = None
+    last_status = None
+    while not stop_event.is_set():
         try:
-            config = load_json(CONFIG_FILE, CONFIG_LOCK_FILE)
-            active_rule_set = config.get('active_rule_set', 'fixed_rule')
-            rules = load_json(RULES_FILE)
-            data = load_json(DATA_FILE, LOCK_FILE)
-
-            updated = update_actions(data, rules, active_rule_set)
-            save_json(DATA_FILE, updated, LOCK_FILE)
-
-            # Save status to status.json with separated sensor and action data
-            status_message = (
-                f"Updated {time.strftime('%H:%M:%S')}\n"
-                f"Sensors: Light: {updated['sensors']['light_level']}, Temp: {updated['sensors']['temperature']}°C, Humidity: {updated['sensors']['humidity']}%\n"
-                f"Actions: Fan: {updated['action']['fan'].capitalize()}, Speed: {updated['action']['fan_speed']}%, Light: {updated['action']['light'].capitalize()}, Brightness: {updated['action']['set_brightness']}%\n"
-                f"Active Rule Set: {active_rule_set}"
-            )
-            with FileLock(STATUS_LOCK_FILE):
-                with open(STATUS_FILE, 'w') as f:
-                    json.dump({"status": status_message}, f)
+            version, data = store.snapshot()
+            history.record({DEFAULT_ROOM: data.get('sensors', {}),
+                            **{room_id: room.get('sensors', {}) for room_id, room in data.get('rooms', {}).items()}})
+            history.maybe_flush()
+            inputs = (file_mtime(CONFIG_FILE), file_mtime(RULES_FILE), version, current_minute())
+            if inputs != last_inputs or stabilizer.due():
+                config = read_json(CONFIG_FILE, {})
+                active_rule_set = config.get('active_rule_set', 'fixed_rule')
+                stabilizer.configure(config.get('hysteresis'))
+                rules = load_rules()
+                rooms = {DEFAULT_ROOM: data, **data.get('rooms', {})}
+
+                with metrics.timed("comfort_eval_seconds"):
+                    room_actions = stabilizer.apply(rooms, lambda filtered: update_room_actions(filtered, rules, active_rule_set))
+                metrics.set_gauge("comfort_actuator_changes_suppressed", stabilizer.suppressed)
+                changed_rooms = {room_id: actions for room_id, actions in room_actions.items()
+                                 if room_id != DEFAULT_ROOM and actions != rooms[room_id].get('action', {})}
+                expected_version = version
+                if room_actions[DEFAULT_ROOM] != data.get('action', {}):
+                    version = store.merge('action', room_actions[DEFAULT_ROOM], source='rules')
+                    expected_version += 1
+                if changed_rooms:
+                    version = store.merge_rooms('action', changed_rooms, source='rules')
+                    expected_version += 1
+                # Our own updates must not count as an external change, but
+                # anything that slipped in between has to be evaluated again
+                if version == expected_version:
+                    inputs = inputs[:2] + (version,) + inputs[3:]
+                last_inputs = inputs
+                updated = {'sensors': data.get('sensors', {}), 'action': room_actions[DEFAULT_ROOM]}
+
+                # Save status to status.json with separated sensor and action data
+                status_body = (
+                    f"Sensors: Light: {updated['sensors']['light_level']}, Temp: {updated['sensors']['temperature']}°C, Humidity: {updated['sensors']['humidity']}%\n"
+                    f"Actions: Fan: {updated['action']['fan'].capitalize()}, Speed: {updated['action']['fan_speed']}%, Light: {updated['action']['light'].capitalize()}, Brightness: {updated['action']['set_brightness']}%\n"
+                    f"Active Rule Set: {active_rule_set}"
+                )
+                if status_body != last_status:
+                    write_status(f"Updated {time.strftime('%H:%M:%S')}\n{status_body}")
+                    last_status = status_body
         except Exception as e:
-            # Save error status to status.json
-            status_message = f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Error during update: {e}"
-            with FileLock(STATUS_LOCK_FILE):
-                with open(STATUS_FILE, 'w') as f:
-                    json.dump({"status": status_message}, f)
+            # Save error status to status.json and retry on the next wake-up
+            last_inputs = None
+            last_status = None
+            write_status(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Error during update: {e}")
+
+        store.wait_for_change(version, UPDATE_INTERVAL)
+    history.flush()
 
-        time.sleep(UPDATE_INTERVAL)
\ No newline at end of file
+# --- For standalone execution (optional) ---
+if __name__ == "__main__":
+    background_task()
@@ -3,7 +3,13 @@ import json
 import time
 import threading
 import os
-from filelock import FileLock
+from persistence import atomic_write_json, FileLock
+from scheduler import Scheduler
+from recurrence import describe, next_fire_time
+from schedule_batch import build_entry, find_conflicts, make_entry, reject_conflicting
+from state import get_store
+from events import bus
+from update import parse_time_window
 from datetime import datetime
 
 # Convert JSON actions to natural language
@@ -41,15 +47,145 @@ def json_to_natural_language(actions):
     
     return ", ".join(unique_messages) if unique_messages else "No changes made"
 
+# Bounds for learned user_preference rules
+MAX_RULES_PER_SENSOR = 200
+USAGE_STAMP_RESOLUTION = 3600  # Seconds; coarse stamps keep repeated actions from forcing a rewrite
+LEARNED_MERGE_GAP = 1  # One step of the whole-number rule.json bounds; learned rules further apart stay separate
+
+def _ranges_touch(a, b):
+    return a.get('min', float('-inf')) <= b.get('max', float('inf')) and \
+        b.get('min', float('-inf')) <= a.get('max', float('inf'))
+
+def _window_segments(time_str):
+    """Minute ranges covered by a rule's time window, split at midnight."""
+    try:
+        window = parse_time_window(time_str)
+    except ValueError:
+        window = None  # Treated as always applying, which only makes merging more cautious
+    if window is None:
+        return [(0, 24 * 60 - 1)]
+    start, end = window
+    return [(start, end)] if start <= end else [(start, 24 * 60 - 1), (0, end)]
+
+def _windows_overlap(a, b):
+    return any(s1 <= e2 and s2 <= e1 for s1, e1 in _window_segments(a) for s2, e2 in _window_segments(b))
+
+def _is_learned(rule):
+    """Learned rules are flagged; older ones are recognised by their <sensor>_<value>_<time> point shape."""
+    if rule.get('learned'):
+        return True
+    value = rule.get('min')
+    return value is not None and value == rule.get('max') and \
+        str(rule.get('label', '')).endswith(f"_{value}_{rule.get('time', '').replace(':', '')}")
+
+def _can_merge(target_rules, i, j):
+    """
+    Whether rule j can be folded into rule i (i < j) without changing what
+    any value matches first. No rule between them may overlap the combined
+    range, and when the two ranges are apart, no rule after i may match
+    inside the gap the widened rule i would start to cover.
+    """
+    first, second = target_rules[i], target_rules[j]
+    span = {"min": min(first.get('min', float('-inf')), second.get('min', float('-inf'))),
+            "max": max(first.get('max', float('inf')), second.get('max', float('inf')))}
+    window = first.get('time', '')
+    for other in target_rules[i + 1:j]:
+        if _ranges_touch(other, span) and _windows_overlap(other.get('time', ''), window):
+            return False
+    if _ranges_touch(first, second):
+        return True
+    gap_low = min(first.get('max', float('inf')), second.get('max', float('inf')))
+    gap_high = max(first.get('min', float('-inf')), second.get('min', float('-inf')))
+    for k in range(i + 1, len(target_rules)):
+        other = target_rules[k]
+        if k == j or not _windows_overlap(other.get('time', ''), window):
+            continue
+        if other.get('min', float('-inf')) < gap_high and other.get('max', float('inf')) > gap_low:
+            return False
+    return True
+
+def _merge_into(first, second):
+    # Both rules are learned, so first keeps its label and becomes the union
+    for bound in ('min', 'max'):
+        low = bound == 'min'
+        values = (first.get(bound, float('-inf') if low else float('inf')),
+                  second.get(bound, float('-inf') if low else float('inf')))
+        value = min(values) if low else max(values)
+        if value in (float('-inf'), float('inf')):
+            first.pop(bound, None)
+        else:
+            first[bound] = value
+    first['learned'] = True
+    first['last_used'] = max(first.get('last_used', 0), second.get('last_used', 0))
+
+def _merge_neighbour(target_rules, focus):
+    """
+    Fold the learned rule focus and another learned rule with the same time
+    window and actions together, if their ranges overlap or are at most
+    LEARNED_MERGE_GAP apart. Returns the surviving rule, or None when
+    nothing could be merged.
+    """
+    if not _is_learned(focus):
+        return None
+    index = next(k for k, rule in enumerate(target_rules) if rule is focus)
+    key = (focus.get('time', ''), focus.get('actions', {}))
+    reach = {"min": focus.get('min', float('-inf')) - LEARNED_MERGE_GAP,
+             "max": focus.get('max', float('inf')) + LEARNED_MERGE_GAP}
+    candidates = [k for k, rule in enumerate(target_rules)
+                  if k != index and _is_learned(rule) and _ranges_touch(rule, reach)
+                  and (rule.get('time', ''), rule.get('actions', {})) == key]
+    for k in candidates:
+        i, j = min(index, k), max(index, k)
+        if _can_merge(target_rules, i, j):
+            _merge_into(target_rules[i], target_rules[j])
+            del target_rules[j]
+            return target_rules[i]
+    return None
+
+# Merge rules with identical time window and actions where first-match results allow it
+def compact_rules(target_rules, rule=None):
+    """
+    Only learned rules are merged; hand-written rules are never rewritten.
+    Two learned rules merge when their ranges overlap or are at most
+    LEARNED_MERGE_GAP apart, so neighbouring learned points grow into one
+    range. Rules are evaluated first-match-wins, so a later rule is only
+    folded into an earlier one when no rule between them overlaps the range
+    it covers and no later rule matches inside the gap. Only rule (the one
+    just matched or created) is compacted when given, otherwise every rule is.
+    """
+    pending = [rule] if rule is not None else list(target_rules)
+    while pending:
+        focus = pending.pop()
+        if not any(other is focus for other in target_rules):
+            continue  # Already folded into another rule
+        survivor = _merge_neighbour(target_rules, focus)
+        if survivor is not None:
+            pending.append(survivor)
+    return target_rules
+
+# Drop the least recently used learned rules beyond MAX_RULES_PER_SENSOR
+def evict_rules(target_rules):
+    excess = len(target_rules) - MAX_RULES_PER_SENSOR
+    if excess <= 0:
+        return target_rules
+    # Only rules created by update_user_preference are learned and evictable
+    learned = [rule for rule in target_rules if _is_learned(rule)]
+    victims = {id(rule) for rule in sorted(learned, key=lambda rule: rule.get('last_used', 0))[:excess]}
+    target_rules[:] = [rule for rule in target_rules if id(rule) not in victims]
+    return target_rules
+
 # Update user_preference in rule.json based on sensor values and actions
 def update_user_preference(data, actions, schedule_time=None):
     with FileLock("rule.json.lock"):
         try:
-            rules = json.load(open("rule.json", 'r'))
+            with open("rule.json", 'r') as f:
+                original = f.read()
+            rules = json.loads(original)
             if 'fixed_rule' in rules:
                 rules['fixed_rule'] = rules.get('fixed_rule', {})
             user_rules = rules['user_preference']
             sensors = data['sensors']
+            touched = {}
             current_time = datetime.now().strftime('%H:%M')
             time_range = schedule_time if schedule_time else ("06:00-18:00" if 6 <= int(current_time.split(':')[0]) <= 18 else "18:01-05:59")
 
@@ -60,11 +196,11 @@ def update_user_preference(data, actions, schedule_time=None):
                 if action_type in ["fan", "fan_speed"]:
                     sensor = "temperature"
                     value = sensors.get("temperature", 32)
-                    target_rules = user_rules.get("temperature", [])
+                    target_rules = user_rules.setdefault("temperature", [])
                 elif action_type in ["light", "brightness"]:
                     sensor = "light_level"
                     value = sensors.get("light_level", 80)
-                    target_rules = user_rules.get("light_level", [])
+                    target_rules = user_rules.setdefault("light_level", [])
                 else:
                     continue
 
@@ -83,11 +219,16 @@ def update_user_preference(data, actions, schedule_time=None):
                         "min": value,
                         "max": value,
                         "time": time_range,
-                        "actions": {}
+                        "actions": {},
+                        "learned": True
                     }
                     target_rules.append(new_rule)
                     matched_rule = new_rule
 
+                if _is_learned(matched_rule):
+                    matched_rule['learned'] = True
+                    matched_rule['last_used'] = int(time.time() // USAGE_STAMP_RESOLUTION * USAGE_STAMP_RESOLUTION)
+                touched.setdefault(sensor, []).append(matched_rule)
                 matched_rule['actions'] = matched_rule.get('actions', {})
                 if action_type == "fan":
                     matched_rule['actions']['fan'] = action_value
@@ -106,115 +247,140 @@ def update_user_preference(data, actions, schedule_time=None):
                     if int(action_value) > 0:
                         matched_rule['actions']['light'] = "on"
 
-            with open("rule.json", 'w') as f:
-                json.dump(rules, f, indent=4)
-        except Exception as e:
-            print(f"Error updating user preferences: {e}")
+            for sensor, matched_rules in touched.items():
+                for matched_rule in matched_rules:
+                    compact_rules(user_rules[sensor], matched_rule)
+                evict_rules(user_rules[sensor])
 
-# Load pending updates from file
-def load_pending_updates():
-    with FileLock("pending_updates.json.lock"):
-        try:
-            if os.path.exists("pending_updates.json"):
-                with open("pending_updates.json", 'r') as f:
-                    return json.load(f)
-            return []
-        except Exception:
-            return []
-
-# Save pending updates to file
-def save_pending_updates(updates):
-    with FileLock("pending_updates.json.lock"):
-        try:
-            with open("pending_updates.json", 'w') as f:
-                json.dump(updates, f, indent=2)
+            # Skip the rewrite when the rules did not actually change
+            if json.dumps(rules, indent=4) != original:
+                atomic_write_json("rule.json", rules, indent=4)
         except Exception as e:
-            print(f"Error saving pending updates: {e}")
+            print(f"Error updating user preferences: {e}")
 
 # Update config.json
 def update_config(rule_set):
-    config = {"active_rule_set": rule_set}
     with FileLock("config.json.lock"):
         try:
-            with open("config.json", 'w') as f:
-                json.dump(config, f, indent=2)
+            # Keep other settings such as the hysteresis section
+            config = {}
+            if os.path.exists("config.json"):
+                with open("config.json", 'r') as f:
+                    config = json.load(f)
+            config["active_rule_set"] = rule_set
+            atomic_write_json("config.json", config, indent=2)
         except Exception as e:
             print(f"Error updating config: {e}")
 
-# Load scheduled actions from scheduler.json
+# Process-wide scheduler, created on first use and rehydrated from scheduler.json
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+def get_scheduler():
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = Scheduler(apply_scheduled_action)
+            _scheduler.start()
+        return _scheduler
+
+# Load pending scheduled actions from the scheduler
 def load_scheduled_actions():
-    with FileLock("scheduler.json.lock"):
-        try:
-            if os.path.exists("scheduler.json"):
-                with open("scheduler.json", 'r') as f:
-                    data = json.load(f)
-                    return data.get('scheduled_actions', [])
-            return []
-        except Exception:
-            return []
-
-# Save scheduled actions to scheduler.json
-def save_scheduled_actions(scheduled_actions):
-    with FileLock("scheduler.json.lock"):
-        try:
-            with open("scheduler.json", 'w') as f:
-                json.dump({"scheduled_actions": scheduled_actions}, f, indent=2)
-        except Exception as e:
-            print(f"Error saving scheduled actions: {e}")
-
-# Execute delayed actions
-def execute_delayed_action(data, data_manager, actions, delay_seconds, rule_set, action_id, schedule_time_str=None):
-    def apply_actions():
-        nonlocal data
-        current_actions = data.get('action', {}).copy()
-        for act in actions:
-            atype, aval = act.get('action_type'), act.get('action_value')
-            if atype == "fan":
-                current_actions['fan'] = aval
-                if aval == 'off': current_actions['fan_speed'] = 0
-            elif atype == "light":
-                current_actions['light'] = aval
-                if aval == 'off': current_actions['set_brightness'] = 0
-            elif atype == "brightness":
-                lvl = int(aval)
-                current_actions['set_brightness'] = lvl
-                if lvl > 0: current_actions['light'] = 'on'
-            elif atype == "fan_speed":
-                lvl = int(aval)
-                current_actions['fan_speed'] = lvl
-                if lvl > 0: current_actions['fan'] = 'on'
-        
-        data['action'] = current_actions
-        update_user_preference(data, actions, schedule_time_str)
-        data_manager.update_data(data)
-        update_config(rule_set)
-        natural_language_response = json_to_natural_language(actions)
-        scheduled_actions = load_scheduled_actions()
-        action = next((sa for sa in scheduled_actions if sa["id"] == action_id), None)
-        display_time = schedule_time_str if schedule_time_str else f"after {delay_seconds} seconds"
-        timestamp = time.time()
-        updates = load_pending_updates()
-        updates.append({"text": f"Action executed at {datetime.now().strftime('%H:%M:%S')} ({display_time}): {natural_language_response}", "timestamp": timestamp})
-        save_pending_updates(updates)
-        scheduled_actions = [sa for sa in scheduled_actions if sa["id"] != action_id]
-        save_scheduled_actions(scheduled_actions)
-        # Removed: st.session_state.scheduled_actions = scheduled_actions
+    return get_scheduler().list()
+
+# Apply the actions of a due scheduled entry (runs on the scheduler thread)
+def apply_scheduled_action(entry):
+    actions = entry["actions"]
+    schedule_time_str = entry.get("schedule_time_str")
+    store = get_store()
+    data = store.load()
+    current_actions = data.get('action', {}).copy()
+    for act in actions:
+        atype, aval = act.get('action_type'), act.get('action_value')
+        if atype == "fan":
+            current_actions['fan'] = aval
+            if aval == 'off': current_actions['fan_speed'] = 0
+        elif atype == "light":
+            current_actions['light'] = aval
+            if aval == 'off': current_actions['set_brightness'] = 0
+        elif atype == "brightness":
+            lvl = int(aval)
+            current_actions['set_brightness'] = lvl
+            if lvl > 0: current_actions['light'] = 'on'
+        elif atype == "fan_speed":
+            lvl = int(aval)
+            current_actions['fan_speed'] = lvl
+            if lvl > 0: current_actions['fan'] = 'on'
 
+    data['action'] = current_actions
+    update_user_preference(data, actions, schedule_time_str)
+    # Only the action section, so readings ingested meanwhile are kept
+    store.merge('action', current_actions, source="schedule")
+    if entry.get("rule_set"):
+        update_config(entry["rule_set"])
+    natural_language_response = json_to_natural_language(actions)
+    if entry.get("recurrence"):
+        display_time = describe(entry["recurrence"])
+    else:
+        display_time = schedule_time_str if schedule_time_str else f"after {entry.get('delay_seconds')} seconds"
+    bus.publish("schedule_executed", f"Action executed at {datetime.now().strftime('%H:%M:%S')} ({display_time}): {natural_language_response}", action_id=entry["id"])
+
+# Schedule actions on the shared scheduler; with a recurrence spec the
+# first run is its next occurrence and delay_seconds is ignored
+def execute_delayed_action(data, data_manager, actions, delay_seconds, rule_set, action_id, schedule_time_str=None, recurrence=None):
     description = json_to_natural_language(actions)
-    scheduled_time = time.time() + delay_seconds
-    scheduled_actions = load_scheduled_actions()
-    scheduled_actions.append({
-        "id": action_id,
-        "actions": actions,
-        "delay_seconds": delay_seconds,
-        "scheduled_time": scheduled_time,
-        "description": description,
-        "schedule_type": "Specific Time" if schedule_time_str else "Delay (seconds)",
-        "schedule_time_str": schedule_time_str
-    })
-    save_scheduled_actions(scheduled_actions)
-    st.session_state.scheduled_actions = scheduled_actions
-    st.session_state.display_history.append({"role": "model", "text": f"Scheduled to perform actions ({description}) {schedule_time_str if schedule_time_str else f'in {delay_seconds} seconds'}."})
-
-    timer = threading.Timer(delay_seconds, apply_actions)
-    timer.start()
\ No newline at end of file
+    scheduler = get_scheduler()
+    now = time.time()
+    scheduled_time = next_fire_time(recurrence, now) if recurrence else now + delay_seconds
+    entry = make_entry(actions, rule_set, action_id, now, scheduled_time, schedule_time_str, recurrence, description)
+    get_store().log_command("schedule", source="ui", entry=entry)
+    scheduler.add(entry)
+    st.session_state.scheduled_actions = scheduler.list()
+    if recurrence:
+        display_time = describe(recurrence)
+    else:
+        display_time = schedule_time_str if schedule_time_str else f'in {delay_seconds} seconds'
+    st.session_state.display_history.append({"role": "model", "text": f"Scheduled to perform actions ({description}) {display_time}."})
+
+# Validate and schedule many rows (e.g. an imported file) with one write of
+# scheduler.json and one journal record. Rows that fail validation are
+# returned as (row number, error), as are rows reusing the id of a pending
+# schedule or an earlier row; rows that conflict with a pending or an
+# earlier row on the same actuator are skipped unless allow_conflicts is set.
+# Pending schedules that cannot be checked for conflicts are reported as
+# (None, error).
+def schedule_many(rows, rule_set, predefined_actions, source="ui", allow_conflicts=False):
+    now = time.time()
+    entries = []
+    errors = []
+    scheduler = get_scheduler()
+    pending = scheduler.list()
+    # The scheduler keys entries by id, so a repeated id would silently replace one
+    taken = {entry["id"]: "a pending schedule" for entry in pending}
+    for number, row in enumerate(rows, 1):
+        try:
+            entry = build_entry(row, rule_set, predefined_actions, now)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            errors.append((number, str(e)))
+            continue
+        if entry["id"] in taken:
+            errors.append((number, f"id '{entry['id']}' is already used by {taken[entry['id']]}"))
+            continue
+        taken[entry["id"]] = f"row {number}"
+        entry["description"] = json_to_natural_language(entry["actions"])
+        entries.append(entry)
+    unchecked = []
+    conflicts = find_conflicts(entries, pending, now, unchecked)
+    for entry_id, error in unchecked:
+        errors.append((None, f"Pending schedule '{entry_id}' was not checked for conflicts: {error}"))
+    by_id = {entry["id"]: entry for entry in pending + entries}
+    for conflict in conflicts:
+        conflict["description"] = by_id[conflict["id"]]["description"]
+        conflict["other_description"] = by_id[conflict["other_id"]]["description"]
+    if conflicts and not allow_conflicts:
+        entries, conflicts = reject_conflicting(entries, conflicts)
+    if entries:
+        get_store().log_command("schedule_many", source=source, entries=entries)
+        scheduler.add_many(entries)
+        st.session_state.scheduled_actions = scheduler.list()
+    return entries, errors, conflicts
@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+from update import background_task
+from mqtt import mqtt_background_task
+from utils import get_scheduler
+import metrics
+
+# Configuration
+RESTART_BACKOFF = 30  # Seconds before a worker that died is started again
+STOP_TIMEOUT = 5  # Seconds to wait for a worker to exit on restart
+# Workers run in this process; drop some when they run as their own
+# processes over a shared state region (COMFORT_SHARED_STATE)
+WORKERS = os.getenv("COMFORT_WORKERS", "evaluator,publisher").split(",")
+
+class Worker:
+    """A background loop run on its own thread, stoppable through an Event."""
+
+    def __init__(self, name, target):
+        self.name = name
+        self.target = target
+        self.thread = None
+        self.stop_event = None
+        self.started_at = None
+        self.starts = 0
+        self.pending_start = False  # Restart requested while the old thread was still running
+
+    @property
+    def alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.target, args=(self.stop_event,), name=self.name, daemon=True)
+        self.thread.start()
+        self.started_at = time.time()
+        self.starts += 1
+        self.pending_start = False
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        if self.stop_event is not None:
+            self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+class WorkerSupervisor:
+    """
+    Owns the process's single rule evaluator, MQTT publisher and scheduler.
+
+    Streamlit runs app.py once per rerun and per browser session, so the
+    workers must not be tied to session state: every session calls
+    ensure_started() on the one supervisor of the process, which starts
+    missing workers and restarts dead ones after RESTART_BACKOFF.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        targets = {"evaluator": background_task, "publisher": mqtt_background_task}
+        self.workers = {name: Worker(name, targets[name]) for name in targets if name in WORKERS}
+        self.scheduler_started_at = None
+
+    def ensure_started(self):
+        with self._lock:
+            now = time.time()
+            for worker in self.workers.values():
+                if worker.alive:
+                    continue
+                if worker.pending_start or worker.started_at is None or now - worker.started_at >= RESTART_BACKOFF:
+                    worker.start()
+            scheduler = get_scheduler()
+            if not scheduler.alive:
+                scheduler.start()
+            if self.scheduler_started_at is None:
+                self.scheduler_started_at = now
+        metrics.start_from_env()
+
+    def restart(self, name=None):
+        """Stop and start one worker (or all of them, including the scheduler)."""
+        with self._lock:
+            names = [name] if name else list(self.workers)
+            for worker_name in names:
+                if worker_name == "scheduler":
+                    continue
+                worker = self.workers[worker_name]
+                worker.stop()
+                # Never run two copies (e.g. two MQTT clients with one client id);
+                # a thread stuck in a long call is replaced once it has exited
+                if worker.alive:
+                    worker.pending_start = True
+                else:
+                    worker.start()
+            if name in (None, "scheduler"):
+                scheduler = get_scheduler()
+                scheduler.stop()
+                scheduler.start()
+                self.scheduler_started_at = time.time()
+
+    def health(self):
+        now = time.time()
+        report = {}
+        for worker in self.workers.values():
+            report[worker.name] = {
+                "alive": worker.alive,
+                "uptime": now - worker.started_at if worker.alive else 0,
+                "starts": worker.starts,
+                "restart_pending": worker.pending_start,
+            }
+        scheduler = get_scheduler()
+        report["scheduler"] = {
+            "alive": scheduler.alive,
+            "uptime": now - self.scheduler_started_at if scheduler.alive and self.scheduler_started_at else 0,
+            "pending": len(scheduler.list()),
+        }
+        return report
+
+# Process-wide supervisor shared by every Streamlit session
+_supervisor = None
+_supervisor_lock = threading.Lock()
+
+def get_supervisor():
+    global _supervisor
+    with _supervisor_lock:
+        if _supervisor is None:
+            _supervisor = WorkerSupervisor()
+        return _supervisor